@@ -0,0 +1,98 @@
+"""Throughput and startup of the local embedding backends.
+
+Run from the ``FastAPI Backend`` directory:
+
+    python benchmarks/bench_embedders.py --repo .. --backends local onnx --threads 1 4 0
+    python benchmarks/bench_embedders.py --backends onnx --onnx-model-dir ./models/minilm
+
+The corpus is every class and function the parsers find under ``--repo``,
+as the sync embeds them, sent in ``--batch`` sized calls. For each backend
+(and each ``--threads`` value for onnx) the table shows the cold start
+(importing the service and loading the model in a fresh interpreter), texts
+per second, and for onnx the mean and minimum cosine against the local
+full-precision vectors when both ran.
+"""
+from __future__ import annotations
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+from graphrag_service import Embedder, Neo4jWriter, _graph_nodes, _parser_for, parse_file  # noqa: E402
+
+_SKIP_DIRS = {".git", "node_modules", "__pycache__", "dist", "build", "out", ".venv", "venv"}
+
+
+def _texts(repo: str):
+    texts = []
+    for dirpath, dirnames, filenames in os.walk(repo):
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if _parser_for(path) is None:
+                continue
+            for kind, node in _graph_nodes(parse_file(path, repo)):
+                texts.append(Neo4jWriter.class_text(node) if kind == "class" else Neo4jWriter.function_text(node))
+    return texts
+
+
+def _cold_start(backend: str, model_dir, threads: int) -> float:
+    code = (
+        "import time; t = time.perf_counter(); import graphrag_service as g; "
+        f"g.Embedder(backend={backend!r}, onnx_model_dir={model_dir!r}, onnx_threads={threads}); "
+        "print(time.perf_counter() - t)"
+    )
+    out = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _cosines(a, b):
+    out = []
+    for x, y in zip(a, b):
+        dot = sum(p * q for p, q in zip(x, y))
+        nx = sum(p * p for p in x) ** 0.5
+        ny = sum(q * q for q in y) ** 0.5
+        out.append(dot / (nx * ny) if nx and ny else 0.0)
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repo", default="..")
+    ap.add_argument("--backends", nargs="+", default=["local", "onnx"], choices=["local", "onnx"])
+    ap.add_argument("--threads", type=int, nargs="+", default=[0], help="onnx intra-op threads (0 = all cores)")
+    ap.add_argument("--onnx-model-dir", default=None)
+    ap.add_argument("--batch", type=int, default=64)
+    ap.add_argument("--limit", type=int, default=2000, help="embed at most this many texts")
+    args = ap.parse_args()
+
+    texts = _texts(args.repo)[:args.limit]
+    print(f"{len(texts)} texts from {os.path.abspath(args.repo)}, batch {args.batch}")
+    print(f"{'backend':<10}{'threads':>8}{'cold s':>9}{'texts/s':>10}{'cos mean':>10}{'cos min':>9}")
+    reference = None
+    for backend in args.backends:
+        for threads in (args.threads if backend == "onnx" else [0]):
+            cold = _cold_start(backend, args.onnx_model_dir, threads)
+            embedder = Embedder(backend=backend, onnx_model_dir=args.onnx_model_dir, onnx_threads=threads)
+            embedder.embed(texts[:args.batch])  # warm-up
+            t0 = time.perf_counter()
+            vecs = []
+            for i in range(0, len(texts), args.batch):
+                vecs.extend(embedder.embed(texts[i:i + args.batch]))
+            rate = len(texts) / (time.perf_counter() - t0)
+            cos = f"{'-':>10}{'-':>9}"
+            if backend == "local":
+                reference = vecs
+            elif reference is not None:
+                c = _cosines(reference, vecs)
+                cos = f"{sum(c) / len(c):>10.4f}{min(c):>9.4f}"
+            label = threads if backend == "onnx" else "-"
+            print(f"{backend:<10}{label:>8}{cold:>9.2f}{rate:>10.1f}{cos}")
+
+
+if __name__ == "__main__":
+    main()
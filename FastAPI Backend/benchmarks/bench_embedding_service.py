@@ -0,0 +1,86 @@
+"""Concurrent query-embedding throughput: in-process Embedder versus EmbeddingService.
+
+Run from the ``FastAPI Backend`` directory:
+
+    python benchmarks/bench_embedding_service.py --concurrency 1 8 32 --workers 1 2
+    python benchmarks/bench_embedding_service.py --backend onnx --onnx-model-dir ./models/minilm
+
+Each of ``--concurrency`` threads embeds one short query at a time, as
+``/api/graph/rag`` does, for ``--queries`` queries in total. ``inline`` calls
+``Embedder.embed`` on the caller's thread; ``svc×N`` goes through an
+EmbeddingService with N worker processes, which coalesces concurrent
+queries into batches. With ``--bulk`` a background thread keeps submitting
+sync-sized bulk batches meanwhile, to show query latency during a sync.
+"""
+from __future__ import annotations
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graphrag_service import Embedder, EmbeddingService  # noqa: E402
+
+
+def _run(embed, bulk_embed, concurrency: int, n: int, bulk: bool):
+    queries = [f"where is the handler for request {i} parsed" for i in range(n)]
+    stop = threading.Event()
+
+    def background():
+        docs = [f"def handler_{i}(request):\n    return parse(request.body)" for i in range(64)]
+        while not stop.is_set():
+            bulk_embed(docs)
+
+    bg = threading.Thread(target=background, daemon=True) if bulk else None
+    if bg is not None:
+        bg.start()
+
+    def one(q):
+        t0 = time.perf_counter()
+        embed([q])
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as ex:
+        lat = sorted(ex.map(one, queries))
+    wall = time.perf_counter() - t0
+    stop.set()
+    if bg is not None:
+        bg.join()
+    return n / wall, statistics.median(lat), lat[int(0.95 * (len(lat) - 1))]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--backend", default=None, help="EMBEDDING_BACKEND to use (default: the environment's)")
+    ap.add_argument("--onnx-model-dir", default=None)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    ap.add_argument("--queries", type=int, default=400)
+    ap.add_argument("--window-ms", type=float, default=5.0)
+    ap.add_argument("--bulk", action="store_true", help="run sync-sized bulk batches in the background")
+    args = ap.parse_args()
+
+    kwargs = {"backend": args.backend, "onnx_model_dir": args.onnx_model_dir}
+    print(f"{'mode':<8}{'callers':>8}{'q/s':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    inline = Embedder(**kwargs)
+    for c in args.concurrency:
+        qps, p50, p95 = _run(inline.embed, inline.embed, c, args.queries, args.bulk)
+        print(f"{'inline':<8}{c:>8}{qps:>9.1f}{p50 * 1000:>9.1f}{p95 * 1000:>9.1f}")
+    for w in args.workers:
+        svc = EmbeddingService(kwargs, workers=w, window_ms=args.window_ms)
+        try:
+            query, bulk = svc.client(), svc.client(bulk=True)
+            for c in args.concurrency:
+                qps, p50, p95 = _run(query.embed, bulk.embed, c, args.queries, args.bulk)
+                print(f"{f'svc×{w}':<8}{c:>8}{qps:>9.1f}{p50 * 1000:>9.1f}{p95 * 1000:>9.1f}")
+        finally:
+            svc.close()
+
+
+if __name__ == "__main__":
+    main()
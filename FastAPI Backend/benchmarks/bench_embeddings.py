@@ -0,0 +1,126 @@
+"""Recall versus size for embedding storage precision and dimension reduction.
+
+Run from the ``FastAPI Backend`` directory (needs numpy):
+
+    python benchmarks/bench_embeddings.py --repo ..
+    python benchmarks/bench_embeddings.py --synthetic 5000 --dim 1536 --dims 1536 512 256
+    python benchmarks/bench_embeddings.py --repo .. --fit-pca pca_256.json --dims 256
+
+The fixed corpus is every class and function the parsers find under
+``--repo``, embedded with the configured ``EMBEDDING_BACKEND``; queries are
+each function's name and docstring. ``--synthetic N`` uses N random unit
+vectors with low-rank structure instead, so no model is needed. Ground truth
+is exact cosine top-k at full precision and dimension; every storage mode
+(float64/float32/float16/int8) is scored at each ``--dims`` value, truncated
+and PCA-reduced, with the cache bytes per vector and the index bytes per
+vector (4 per dimension, 1 with int8 index quantization).
+``--fit-pca`` writes the components for ``embeddings.pca_path``.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graphrag_service import (  # noqa: E402
+    EMBEDDING_STORAGE_MODES, DimensionReducer, Embedder, Neo4jWriter, _graph_nodes, _parser_for,
+    decode_vector, encode_vector, fit_pca, parse_file,
+)
+
+_SKIP_DIRS = {".git", "node_modules", "__pycache__", "dist", "build", "out", ".venv", "venv"}
+
+
+def _corpus(repo: str):
+    docs, queries = [], []
+    for dirpath, dirnames, filenames in os.walk(repo):
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if _parser_for(path) is None:
+                continue
+            for kind, node in _graph_nodes(parse_file(path, repo)):
+                docs.append(Neo4jWriter.class_text(node) if kind == "class" else Neo4jWriter.function_text(node))
+                if kind == "function":
+                    queries.append(f"{node.name}: {node.docstring or node.name}")
+    return docs, queries
+
+
+def _synthetic(n: int, dim: int, n_queries: int, rng: np.random.Generator):
+    # Low-rank signal plus noise, like real embeddings whose variance sits in few directions
+    basis = rng.normal(size=(64, dim))
+    docs = rng.normal(size=(n, 64)) @ basis + 0.3 * rng.normal(size=(n, dim))
+    picks = rng.choice(n, size=n_queries, replace=False)
+    queries = docs[picks] + 0.5 * rng.normal(size=(n_queries, dim))
+    unit = lambda m: m / np.linalg.norm(m, axis=1, keepdims=True)  # noqa: E731
+    return unit(docs), unit(queries)
+
+
+def _topk(docs: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ docs.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def _recall(truth: np.ndarray, got: np.ndarray) -> float:
+    return float(np.mean([len(set(t) & set(g)) / len(t) for t, g in zip(truth, got)]))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repo", default="..")
+    ap.add_argument("--synthetic", type=int, default=0, help="use N synthetic vectors instead of a model")
+    ap.add_argument("--dim", type=int, default=384, help="synthetic vector dimension")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--dims", type=int, nargs="+", default=None, help="reduced dimensions to score")
+    ap.add_argument("--fit-pca", default=None, help="write PCA components for the largest --dims here")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.synthetic:
+        docs, queries = _synthetic(args.synthetic, args.dim, args.queries, rng)
+        print(f"synthetic corpus: {len(docs)} x {docs.shape[1]}, {len(queries)} queries")
+    else:
+        doc_texts, query_texts = _corpus(args.repo)
+        query_texts = query_texts[:args.queries]
+        embedder = Embedder()
+        docs = np.asarray(embedder.embed(doc_texts), dtype=np.float64)
+        queries = np.asarray(embedder.embed(query_texts), dtype=np.float64)
+        print(f"{embedder.backend} corpus from {os.path.abspath(args.repo)}: {len(docs)} x {docs.shape[1]}, "
+              f"{len(queries)} queries")
+    full_dim = docs.shape[1]
+    dims_list = sorted(set(args.dims or [full_dim, full_dim // 2, full_dim // 4]), reverse=True)
+    truth = _topk(docs, queries, args.k)
+
+    pca_path = args.fit_pca or os.path.join(tempfile.mkdtemp(), "pca.json")
+    if args.fit_pca or any(d < full_dim for d in dims_list):
+        with open(pca_path, "w", encoding="utf-8") as f:
+            json.dump(fit_pca(docs.tolist(), max(dims_list)), f)
+    if args.fit_pca:
+        print(f"wrote {max(dims_list)} PCA components to {args.fit_pca}")
+
+    print(f"{'dims':>6} {'method':<9}{'storage':<9}{f'recall@{args.k}':>10}{'cache B/vec':>13}{'index B/vec':>13}")
+    for dims in dims_list:
+        methods = ["truncate", "pca"] if dims < full_dim else ["none"]
+        for method in methods:
+            if method == "none":
+                d_vecs, q_vecs = docs, queries
+            else:
+                reducer = DimensionReducer(dims, method, pca_path)
+                d_vecs = np.asarray(reducer.reduce(docs.tolist()))
+                q_vecs = np.asarray(reducer.reduce(queries.tolist()))
+            for storage in EMBEDDING_STORAGE_MODES:
+                encoded = [encode_vector(v, storage) for v in d_vecs.tolist()]
+                stored = np.asarray([decode_vector(e) for e in encoded])
+                cache_bytes = np.mean([len(json.dumps(e)) for e in encoded])
+                index_bytes = dims * (1 if storage == "int8" else 4)
+                recall = _recall(truth, _topk(stored, q_vecs, args.k))
+                print(f"{dims:>6} {method:<9}{storage:<9}{recall:>10.3f}{cache_bytes:>13.0f}{index_bytes:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Recall, false matches and lookup cost of the near-duplicate SimHash threshold.
+
+Run from the ``FastAPI Backend`` directory:
+
+    python benchmarks/bench_near_duplicates.py --repo ..
+    python benchmarks/bench_near_duplicates.py --repo /path/to/python/Lib --index-size 500000
+
+Every function under ``--repo`` with more than ``--min-lines`` lines is
+edited twice: once by inserting a line taken from another function, once by
+replacing one of its lines the same way. For each ``max_distance`` the table
+shows the share of edited copies whose ``body_simhash`` stays within that many
+bits of the original, the number of pairs of distinct functions that fall
+within it (token Jaccard below 0.6, so not copies of each other), and the
+mean ``SimHashIndex.lookup`` time with ``--index-size`` signatures indexed.
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graphrag_service import _SIMHASH_TOKEN, SimHashIndex, _parser_for, body_simhash, parse_file  # noqa: E402
+
+_SKIP_DIRS = {".git", "node_modules", "__pycache__", "dist", "build", "out", ".venv", "venv"}
+
+
+def _functions(repo: str):
+    out = []
+    for dirpath, dirnames, filenames in os.walk(repo):
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if _parser_for(path) is None:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    src = f.read()
+                fi = parse_file(path, repo, src)
+            except Exception:
+                continue
+            out.extend((fn.name, fn.source) for fn in fi.functions if fn.source)
+    return out
+
+
+def _edit(source: str, pool, replace: bool) -> str:
+    lines = source.splitlines(True)
+    i = random.randrange(1, len(lines))
+    indent = re.match(r"\s*", lines[i]).group(0)
+    new = indent + random.choice(pool).strip() + "\n"
+    return "".join(lines[:i] + [new] + lines[i + 1 if replace else i:])
+
+
+def _distinct_pairs(sigs, bodies, max_d: int):
+    """Pairs of different, dissimilar bodies within ``max_d`` bits, found through ``max_d + 1`` bands."""
+    index = SimHashIndex(os.path.join(tempfile.mkdtemp(), "pairs.json"), max_distance=max_d,
+                         max_entries=len(sigs) + 1)
+    seen = {}
+    for i, sig in enumerate(sigs):
+        if sig and sig not in seen:
+            seen[sig] = i
+            index._insert(sig, str(i), "", str(i))
+    dists = []
+    for bucket in index._buckets:
+        for group in bucket.values():
+            for a in range(len(group)):
+                for b in range(a + 1, len(group)):
+                    d = bin(group[a] ^ group[b]).count("1")
+                    if d <= max_d:
+                        dists.append((min(group[a], group[b]), max(group[a], group[b]), d))
+    out = []
+    for x, y, d in set(dists):
+        tx, ty = set(_SIMHASH_TOKEN.findall(bodies[seen[x]])), set(_SIMHASH_TOKEN.findall(bodies[seen[y]]))
+        if len(tx & ty) / len(tx | ty) < 0.6:
+            out.append(d)
+    return out
+
+
+def _lookup_us(sigs, max_d: int, size: int) -> float:
+    index = SimHashIndex(os.path.join(tempfile.mkdtemp(), "index.json"), max_distance=max_d, max_entries=size)
+    rng = random.Random(0)
+    filler = [rng.getrandbits(64) for _ in range(max(0, size - len(sigs)))]
+    for i, sig in enumerate(list(sigs)[:size] + filler):
+        index._insert(sig, str(i), "", str(i))
+    probes = [rng.getrandbits(64) for _ in range(2000)]
+    t0 = time.perf_counter()
+    for sig in probes:
+        index.lookup(sig)
+    return (time.perf_counter() - t0) / len(probes) * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repo", default="..")
+    ap.add_argument("--min-lines", type=int, default=15)
+    ap.add_argument("--max-functions", type=int, default=3000)
+    ap.add_argument("--distances", type=int, nargs="+", default=[3, 4, 5, 6, 7, 8])
+    ap.add_argument("--index-size", type=int, default=100000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    funcs = _functions(args.repo)
+    random.shuffle(funcs)
+    sigs = [body_simhash(src, name) for name, src in funcs]
+    big = [(name, src) for name, src in funcs if src.count("\n") > args.min_lines][:args.max_functions]
+    pool = [line for _, src in big for line in src.splitlines()[1:] if line.strip()]
+    inserted, replaced = [], []
+    for name, src in big:
+        sig = body_simhash(src, name)
+        inserted.append(bin(sig ^ body_simhash(_edit(src, pool, False), name)).count("1"))
+        replaced.append(bin(sig ^ body_simhash(_edit(src, pool, True), name)).count("1"))
+    false_pairs = _distinct_pairs(sigs, [src for _, src in funcs], max(args.distances))
+
+    print(f"repo {os.path.abspath(args.repo)}: {len(funcs)} functions, {len(big)} over {args.min_lines} lines")
+    print(f"median bits: inserted line {statistics.median(inserted):g}, replaced line {statistics.median(replaced):g}")
+    print(f"{'max_distance':>12}{'inserted':>10}{'replaced':>10}{'false pairs':>13}{'lookup us':>11}")
+    for d in args.distances:
+        print(f"{d:>12}{sum(x <= d for x in inserted) / len(inserted):>10.0%}"
+              f"{sum(x <= d for x in replaced) / len(replaced):>10.0%}"
+              f"{sum(x <= d for x in false_pairs):>13}{_lookup_us(sigs, d, args.index_size):>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""OpenAI embedding client against a local stub server: throughput, splitting and retries.
+
+Run from the ``FastAPI Backend`` directory (needs the openai package, no API key):
+
+    python benchmarks/bench_openai_embeddings.py --texts 5000 --concurrency 1 4 16
+    python benchmarks/bench_openai_embeddings.py --latency-ms 200 --fail-rate 0.2 --max-inputs 256
+
+A stub ``/v1/embeddings`` endpoint is started on localhost. It answers with
+deterministic vectors after ``--latency-ms``, and fails a ``--fail-rate``
+share of requests with 429 (with ``retry-after-ms``) or 503. For each
+``--concurrency`` value, ``--texts`` synthetic function texts are embedded in
+one ``Embedder.embed`` call. The table shows texts per second, requests and
+retries seen by the stub, and the largest request it received. Every vector
+is checked against the one the stub would produce, so a zero or misplaced
+vector fails the run.
+"""
+from __future__ import annotations
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graphrag_service import Embedder  # noqa: E402
+
+_DIM = 1536
+
+
+def _vector(text: str):
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((seed[i % 32] + i) % 251) / 251.0 for i in range(_DIM)]
+
+
+def _b64(vec):
+    return base64.b64encode(struct.pack(f"<{len(vec)}f", *vec)).decode()
+
+
+def _matches(got, want) -> bool:
+    return len(got) == len(want) and all(abs(a - b) < 1e-6 for a, b in zip(got, want))
+
+
+class _Stub:
+    def __init__(self, latency: float, fail_rate: float):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.failures = 0
+        self.max_inputs = 0
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                inputs = req["input"] if isinstance(req["input"], list) else [req["input"]]
+                time.sleep(stub.latency)
+                with stub.lock:
+                    stub.requests += 1
+                    stub.max_inputs = max(stub.max_inputs, len(inputs))
+                    fail = stub.rng.random() < stub.fail_rate
+                    stub.failures += int(fail)
+                if fail:
+                    if stub.rng.random() < 0.5:
+                        self._send(429, {"error": {"message": "rate limited"}}, {"retry-after-ms": "20"})
+                    else:
+                        self._send(503, {"error": {"message": "overloaded"}})
+                    return
+                dims = req.get("dimensions") or _DIM
+                # Like the real API: the SDK asks for base64 float32 unless told otherwise
+                b64 = req.get("encoding_format") == "base64"
+                data = [{"object": "embedding", "index": i,
+                         "embedding": _b64(_vector(t)[:dims]) if b64 else _vector(t)[:dims]}
+                        for i, t in enumerate(inputs)]
+                self._send(200, {"object": "list", "data": data, "model": req["model"],
+                                 "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+        return Handler
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--texts", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--latency-ms", type=float, default=50.0)
+    ap.add_argument("--fail-rate", type=float, default=0.05)
+    ap.add_argument("--max-inputs", type=int, default=128, help="inputs per request")
+    args = ap.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    stub = _Stub(args.latency_ms / 1000.0, args.fail_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stub.handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    texts = [f"# Function: mod.f{i}\n\ndef f{i}(x):\n    return x * {i}" for i in range(args.texts)]
+
+    print(f"stub at {base_url}: {args.latency_ms:g} ms/request, {args.fail_rate:.0%} failures")
+    print(f"{'concurrency':>11}{'texts/s':>10}{'requests':>10}{'retries':>9}{'max inputs':>12}")
+    try:
+        for c in args.concurrency:
+            embedder = Embedder(backend="openai", openai_options={
+                "base_url": base_url, "concurrency": c, "max_inputs": args.max_inputs,
+                "backoff_base": 0.02, "max_retries": 8,
+            })
+            stub.reset()
+            t0 = time.perf_counter()
+            vecs = embedder.embed(texts)
+            rate = len(texts) / (time.perf_counter() - t0)
+            bad = sum(1 for t, v in zip(texts, vecs) if not _matches(v, _vector(t)))
+            if bad or len(vecs) != len(texts):
+                raise SystemExit(f"{bad} vectors do not match their inputs")
+            print(f"{c:>11}{rate:>10.1f}{stub.requests:>10}{stub.failures:>9}{stub.max_inputs:>12}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
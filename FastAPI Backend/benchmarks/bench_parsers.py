@@ -0,0 +1,193 @@
+"""Parser throughput benchmark on generated large source files.
+
+Run from the ``FastAPI Backend`` directory:
+
+    python benchmarks/bench_parsers.py --lines 2000 10000 20000
+    python benchmarks/bench_parsers.py --backend treesitter
+
+Per-line cost should stay flat as files grow; a rising ms/kline column
+means some parser is doing work quadratic in file size. With the
+tree-sitter backend an extra column times the reparse after a one-line
+edit in the middle of the file, which reuses the previous syntax tree.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graphrag_service import TreeSitterParser, parse_file  # noqa: E402
+
+
+def _python(n_classes: int) -> str:
+    out = ["import os", "import json", ""]
+    for c in range(n_classes):
+        out.append(f"class Widget{c}:")
+        out.append(f'    """Widget number {c}."""')
+        for m in range(8):
+            out.append(f"    def method_{m}(self, x):")
+            out.append(f'        """Method {m}."""')
+            out.append(f"        y = helper_{m}(x) + {m}")
+            out.append("        return json.dumps({'y': y})")
+            out.append("")
+    out.append("def main():")
+    out.append("    return 0")
+    return "\n".join(out) + "\n"
+
+
+def _js(n_classes: int) -> str:
+    out = ["import React from 'react';", "const fs = require('fs');", ""]
+    for c in range(n_classes):
+        out.append(f"export class Widget{c} {{")
+        out.append("  render() { return '{'; }")
+        out.append("}")
+        for m in range(8):
+            out.append(f"export function fn{c}_{m}(a, b) {{")
+            out.append(f"  const s = '}}' + a;")
+            out.append(f"  return a + b + {m};")
+            out.append("}")
+            out.append(f"const arrow{c}_{m} = (x) => {{")
+            out.append("  return x * 2;")
+            out.append("};")
+    return "\n".join(out) + "\n"
+
+
+def _java(n_classes: int) -> str:
+    out = ["package bench;", "import java.util.List;", ""]
+    for c in range(n_classes):
+        out.append("/**")
+        out.append(f" * Widget {c}.")
+        out.append(" */")
+        out.append(f"public class Widget{c} {{")
+        out.append(f"    public Widget{c}() {{")
+        out.append("        this.name = \"w\";")
+        out.append("    }")
+        for m in range(8):
+            out.append(f"    /** Method {m}. */")
+            out.append(f"    public int method{m}(int x) {{")
+            out.append(f"        if (x > {m}) {{ return x; }}")
+            out.append("        return 0;")
+            out.append("    }")
+        out.append("}")
+    return "\n".join(out) + "\n"
+
+
+def _csharp(n_classes: int) -> str:
+    out = ["using System;", "using System.Linq;", "", "namespace Bench {"]
+    for c in range(n_classes):
+        out.append("    /// <summary>Widget</summary>")
+        out.append(f"    public class Widget{c} {{")
+        out.append(f"        public Widget{c}(int x) {{")
+        out.append("            X = x;")
+        out.append("        }")
+        for m in range(8):
+            out.append(f"        /// Method {m}")
+            out.append(f"        public int Method{m}(int x) {{")
+            out.append(f"            if (x > {m}) {{ return x; }}")
+            out.append("            return 0;")
+            out.append("        }")
+        out.append("    }")
+    out.append("}")
+    return "\n".join(out) + "\n"
+
+
+def _cpp(n_classes: int) -> str:
+    out = ["#include <vector>", "#include <string>", ""]
+    for c in range(n_classes):
+        out.append(f"/** Widget {c} */")
+        out.append(f"class Widget{c} {{")
+        out.append("public:")
+        out.append(f"    Widget{c}(int x) {{")
+        out.append("        x_ = x;")
+        out.append("    }")
+        for m in range(8):
+            out.append(f"    // method {m}")
+            out.append(f"    int method{m}(int x) const {{")
+            out.append(f"        return x + {m};")
+            out.append("    }")
+        out.append("private:")
+        out.append("    int x_;")
+        out.append("};")
+    return "\n".join(out) + "\n"
+
+
+GENERATORS = {
+    ".py": (_python, 42),
+    ".js": (_js, 57),
+    ".java": (_java, 50),
+    ".cs": (_csharp, 46),
+    ".cpp": (_cpp, 41),
+}
+
+
+def bench(lines_targets, repeat: int, parser=parse_file):
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        for ext, (gen, lines_per_class) in GENERATORS.items():
+            for target in lines_targets:
+                src = gen(max(target // lines_per_class, 1))
+                path = os.path.join(root, f"bench_{target}{ext}")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(src)
+                n_lines = src.count("\n")
+                best = float("inf")
+                fi = None
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    fi = parser(path, root)
+                    best = min(best, time.perf_counter() - t0)
+                nodes = len(fi.classes) + len(fi.functions) + sum(len(c.methods) for c in fi.classes)
+                rows.append((ext, n_lines, best, nodes))
+    return rows
+
+
+def bench_incremental(lines_targets, repeat: int):
+    """Full parse vs reparse after a one-line edit, both through one TreeSitterParser."""
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        for ext, (gen, lines_per_class) in GENERATORS.items():
+            for target in lines_targets:
+                src = gen(max(target // lines_per_class, 1))
+                path = os.path.join(root, f"bench_{target}{ext}")
+                mid = src.index("\n", len(src) // 2) + 1
+                edited = src[:mid] + src[mid:].replace("return", "return  ", 1)
+                full = inc = float("inf")
+                for _ in range(repeat):
+                    ts = TreeSitterParser()
+                    t0 = time.perf_counter()
+                    fi = ts.parse(path, root, src)
+                    full = min(full, time.perf_counter() - t0)
+                    t0 = time.perf_counter()
+                    ts.parse(path, root, edited)
+                    inc = min(inc, time.perf_counter() - t0)
+                if fi is None:
+                    continue
+                nodes = len(fi.classes) + len(fi.functions) + sum(len(c.methods) for c in fi.classes)
+                rows.append((ext, src.count("\n"), full, inc, nodes))
+    return rows
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int, nargs="+", default=[2000, 10000, 20000])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--backend", choices=["regex", "treesitter"], default="regex")
+    args = ap.parse_args()
+    if args.backend == "treesitter":
+        if not TreeSitterParser.available():
+            sys.exit("tree-sitter is not installed; see requirements.txt")
+        print(f"{'ext':<6}{'lines':>8}{'best ms':>12}{'ms/kline':>10}{'edit ms':>10}{'nodes':>8}")
+        for ext, n_lines, full, inc, nodes in bench_incremental(args.lines, args.repeat):
+            print(f"{ext:<6}{n_lines:>8}{full * 1000:>12.1f}{full * 1e6 / max(n_lines, 1):>10.2f}"
+                  f"{inc * 1000:>10.1f}{nodes:>8}")
+        return
+    print(f"{'ext':<6}{'lines':>8}{'best ms':>12}{'ms/kline':>10}{'nodes':>8}")
+    for ext, n_lines, best, nodes in bench(args.lines, args.repeat):
+        print(f"{ext:<6}{n_lines:>8}{best * 1000:>12.1f}{best * 1e6 / max(n_lines, 1):>10.2f}{nodes:>8}")
+
+
+if __name__ == "__main__":
+    main()
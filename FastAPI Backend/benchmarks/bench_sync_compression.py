@@ -0,0 +1,108 @@
+"""Bytes on the wire and wall time for a compressed initial sync.
+
+Run from the ``FastAPI Backend`` directory:
+
+    python benchmarks/bench_sync_compression.py --repo .. --mbps 10 100 1000
+    python benchmarks/bench_sync_compression.py --repo .. --url http://localhost:8000
+
+The sync body for every source file under ``--repo`` is built the way the
+extension sends it, then encoded as identity/gzip/zstd. For each encoding the
+table shows the wire size, the time to compress it, the time to inflate it
+through the server's streaming decoder, and the end-to-end time at each link
+speed (compress + transfer + decompress). With ``--url`` the body is also
+POSTed to a running backend and the measured request time is reported.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from content_encoding import CHUNK_SIZE, Decoder, Encoder, supported_encodings  # noqa: E402
+
+_SOURCE_EXTS = {".py", ".js", ".jsx", ".ts", ".tsx", ".java", ".cs", ".cpp", ".cc", ".hpp", ".h", ".c", ".md"}
+_SKIP_DIRS = {".git", "node_modules", "__pycache__", "dist", "build", "out", ".venv", "venv"}
+
+
+def _payload(repo: str, workspace_id: str) -> bytes:
+    changes = []
+    for dirpath, dirnames, filenames in os.walk(repo):
+        dirnames[:] = [d for d in dirnames if d not in _SKIP_DIRS]
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() not in _SOURCE_EXTS:
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            rel = os.path.relpath(path, repo).replace(os.sep, "/")
+            changes.append({"path": rel, "status": "added", "content": content})
+    return json.dumps({"workspaceId": workspace_id, "changes": changes}).encode("utf-8")
+
+
+def _encode(payload: bytes, encoding: str, level):
+    if encoding == "identity":
+        return payload, 0.0
+    t0 = time.perf_counter()
+    enc = Encoder(encoding, level)
+    out = enc.compress(payload) + enc.finish()
+    return out, time.perf_counter() - t0
+
+
+def _decode(body: bytes, encoding: str) -> float:
+    if encoding == "identity":
+        return 0.0
+    t0 = time.perf_counter()
+    dec = Decoder(encoding)
+    for i in range(0, len(body), CHUNK_SIZE):
+        dec.feed(body[i:i + CHUNK_SIZE])
+    dec.finish()
+    return time.perf_counter() - t0
+
+
+def _post(url: str, body: bytes, encoding: str) -> float:
+    import httpx
+
+    headers = {"Content-Type": "application/json", "Accept-Encoding": ", ".join(supported_encodings())}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    t0 = time.perf_counter()
+    r = httpx.post(url.rstrip("/") + "/api/graph/sync", content=body, headers=headers, timeout=600)
+    r.raise_for_status()
+    return time.perf_counter() - t0
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--repo", default="..")
+    ap.add_argument("--mbps", type=float, nargs="+", default=[10.0, 100.0, 1000.0])
+    ap.add_argument("--gzip-level", type=int, default=6)
+    ap.add_argument("--zstd-level", type=int, default=3)
+    ap.add_argument("--url", default=None, help="also POST each body to this backend")
+    args = ap.parse_args()
+
+    payload = _payload(args.repo, "bench-compression")
+    print(f"repo {os.path.abspath(args.repo)}: {len(payload) / 1024:.0f} KB sync body")
+    levels = {"gzip": args.gzip_level, "zstd": args.zstd_level}
+    cols = "".join(f"{f'@{m:g}Mbps ms':>14}" for m in args.mbps)
+    print(f"{'encoding':<10}{'wire KB':>10}{'ratio':>8}{'enc ms':>9}{'dec ms':>9}{cols}{'POST ms':>10}")
+    for encoding in ["identity"] + supported_encodings()[::-1]:
+        body, enc_s = _encode(payload, encoding, levels.get(encoding))
+        dec_s = _decode(body, encoding)
+        walls = "".join(
+            f"{(enc_s + len(body) * 8 / (m * 1e6) + dec_s) * 1000:>14.1f}" for m in args.mbps
+        )
+        posted = f"{_post(args.url, body, encoding) * 1000:>10.1f}" if args.url else f"{'-':>10}"
+        print(
+            f"{encoding:<10}{len(body) / 1024:>10.1f}{len(payload) / len(body):>8.1f}"
+            f"{enc_s * 1000:>9.1f}{dec_s * 1000:>9.1f}{walls}{posted}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Content-Encoding support for request and response bodies.
+
+``ContentEncodingMiddleware`` inflates ``gzip``/``zstd`` request bodies as
+they arrive, chunk by chunk, and rejects a body once its decompressed size
+passes a limit; responses are compressed for clients that send a matching
+``Accept-Encoding``. Streamed responses are flushed per chunk so progress
+events are not held back in the compressor.
+"""
+from __future__ import annotations
+import json
+import zlib
+from typing import Callable, Iterable, List, Optional
+
+from starlette.exceptions import HTTPException
+
+try:
+    import zstandard  # type: ignore
+except Exception:
+    zstandard = None  # type: ignore
+
+CHUNK_SIZE = 64 * 1024
+# A zstd block regenerates at most 128 KiB from a 4-byte RLE block, so feeding the
+# decompressor this much input at a time caps one call's output at about 8 MiB
+_ZSTD_SLICE = 256
+
+_COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def supported_encodings() -> List[str]:
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+class _Sink:
+    """Collects decoder output, raising once the running total passes ``limit``."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.total = 0
+        self.parts: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.total += len(data)
+        if self.limit and self.total > self.limit:
+            raise BodyTooLarge(self.total)
+        self.parts.append(data)
+        return len(data)
+
+    def take(self) -> bytes:
+        out = b"".join(self.parts)
+        self.parts = []
+        return out
+
+
+class Decoder:
+    """Incremental decoder; ``feed`` returns what the new input decoded to."""
+
+    def __init__(self, encoding: str, limit: int = 0):
+        self.encoding = encoding
+        self.sink = _Sink(limit)
+        if encoding == "gzip":
+            # 32 + MAX_WBITS accepts both gzip and zlib framing
+            self._z = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        elif encoding == "zstd" and zstandard is not None:
+            # decompressobj rather than stream_writer: it reports ``eof`` at the end of a frame
+            self._dctx = zstandard.ZstdDecompressor()
+            self._z = self._dctx.decompressobj()
+        else:
+            raise ValueError(f"unsupported content encoding: {encoding}")
+
+    def feed(self, data: bytes) -> bytes:
+        if self.encoding == "gzip":
+            # Bounded output per call, so a small bomb cannot expand past the limit in one go
+            while data:
+                self.sink.write(self._z.decompress(data, CHUNK_SIZE))
+                data = self._z.unconsumed_tail
+        else:
+            for i in range(0, len(data), _ZSTD_SLICE):
+                chunk = data[i:i + _ZSTD_SLICE]
+                while chunk:
+                    self.sink.write(self._z.decompress(chunk))
+                    chunk = b""
+                    if self._z.eof and self._z.unused_data:
+                        # Concatenated frames: carry on with a fresh decompressor
+                        chunk = self._z.unused_data
+                        self._z = self._dctx.decompressobj()
+        return self.sink.take()
+
+    def finish(self) -> bytes:
+        if self.encoding == "gzip":
+            self.sink.write(self._z.flush())
+            if not self._z.eof:
+                raise ValueError("truncated gzip body")
+        elif not self._z.eof:
+            raise ValueError("truncated zstd body")
+        return self.sink.take()
+
+
+class Encoder:
+    """Incremental encoder; ``compress(data, flush=True)`` emits a decodable chunk."""
+
+    def __init__(self, encoding: str, level: Optional[int] = None):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._z = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "zstd" and zstandard is not None:
+            self._z = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        else:
+            raise ValueError(f"unsupported content encoding: {encoding}")
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        out = self._z.compress(data)
+        if flush:
+            if self.encoding == "gzip":
+                out += self._z.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                out += self._z.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out
+
+    def finish(self) -> bytes:
+        return self._z.flush()
+
+
+def _negotiate(accept: str) -> Optional[str]:
+    offered = {}
+    for part in accept.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for p in params.split(";"):
+            k, _, v = p.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        offered[name.strip().lower()] = q
+    for enc in supported_encodings():
+        if offered.get(enc, offered.get("*", 0.0)) > 0:
+            return enc
+    return None
+
+
+def _header(headers: Iterable, name: bytes) -> str:
+    for k, v in headers:
+        if k.lower() == name:
+            return v.decode("latin-1")
+    return ""
+
+
+class ContentEncodingMiddleware:
+    """Pure ASGI middleware, so streaming request and response bodies stay streamed.
+
+    Request bodies are decoded only on ``decode_paths``; elsewhere a
+    ``Content-Encoding`` header is passed through untouched.
+    """
+
+    def __init__(
+        self,
+        app,
+        decode_paths: Iterable[str] = (),
+        max_body_bytes: int = 0,
+        minimum_size: int = 1024,
+        levels: Optional[dict] = None,
+    ):
+        self.app = app
+        self.decode_paths = set(decode_paths)
+        self.max_body_bytes = max_body_bytes
+        self.minimum_size = minimum_size
+        self.levels = levels or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = scope.get("headers") or []
+        encoding = _header(headers, b"content-encoding").strip().lower()
+        if encoding and encoding != "identity" and scope.get("path") in self.decode_paths:
+            if encoding not in supported_encodings():
+                await _reject(send, 415, f"Unsupported Content-Encoding: {encoding}")
+                return
+            scope = dict(scope)
+            scope["headers"] = [
+                (k, v) for k, v in headers if k.lower() not in (b"content-encoding", b"content-length")
+            ]
+            receive = _decoding_receive(receive, Decoder(encoding, self.max_body_bytes))
+
+        target = _negotiate(_header(headers, b"accept-encoding"))
+        if target is not None:
+            send = _encoding_send(send, target, self.levels.get(target), self.minimum_size)
+        await self.app(scope, receive, send)
+
+
+_DECODE_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def _decoding_receive(receive: Callable, decoder: Decoder) -> Callable:
+    done = False
+
+    async def wrapped():
+        nonlocal done
+        while True:
+            message = await receive()
+            if message["type"] != "http.request" or done:
+                return message
+            more = message.get("more_body", False)
+            # Raised as HTTPException so FastAPI's body parsing passes the status through
+            try:
+                body = decoder.feed(message.get("body", b""))
+                if not more:
+                    body += decoder.finish()
+            except BodyTooLarge:
+                limit_mb = decoder.sink.limit / (1024 * 1024)
+                raise HTTPException(413, f"Decompressed request body exceeds {limit_mb:g} MB")
+            except _DECODE_ERRORS as e:
+                raise HTTPException(400, f"Malformed {decoder.encoding} request body: {e}")
+            done = not more
+            # Skip empty intermediate chunks (input that is still inside the compressor window)
+            if body or not more:
+                return {"type": "http.request", "body": body, "more_body": more}
+
+    return wrapped
+
+
+def _encoding_send(send: Callable, encoding: str, level: Optional[int], minimum_size: int) -> Callable:
+    start = None
+    encoder: Optional[Encoder] = None
+    passthrough = False
+
+    async def wrapped(message):
+        nonlocal start, encoder, passthrough
+        if message["type"] == "http.response.start":
+            hdrs = message.get("headers") or []
+            ctype = _header(hdrs, b"content-type")
+            if _header(hdrs, b"content-encoding") or not ctype.startswith(_COMPRESSIBLE_TYPES):
+                passthrough = True
+                await send(message)
+            else:
+                start = message
+            return
+        if message["type"] != "http.response.body" or passthrough:
+            await send(message)
+            return
+        body = message.get("body", b"")
+        more = message.get("more_body", False)
+        if start is not None:
+            hdrs = [(k, v) for k, v in start.get("headers") or [] if k.lower() != b"content-length"]
+            if not more and len(body) < minimum_size:
+                passthrough = True
+                await send(start)
+                start = None
+                await send(message)
+                return
+            encoder = Encoder(encoding, level)
+            hdrs.append((b"content-encoding", encoding.encode()))
+            hdrs.append((b"vary", b"Accept-Encoding"))
+            if not more:
+                body = encoder.compress(body) + encoder.finish()
+                hdrs.append((b"content-length", str(len(body)).encode()))
+                await send({**start, "headers": hdrs})
+                start = None
+                await send({"type": "http.response.body", "body": body, "more_body": False})
+                return
+            await send({**start, "headers": hdrs})
+            start = None
+        body = encoder.compress(body, flush=more)
+        if not more:
+            body += encoder.finish()
+        await send({"type": "http.response.body", "body": body, "more_body": more})
+
+    return wrapped
+
+
+async def _reject(send: Callable, status: int, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -2,41 +2,76 @@ from __future__ import annotations
 import os
 import re
 import ast
+import dataclasses
+import gzip
+import bisect
+import difflib
 import textwrap
 import hashlib
+import importlib
+import inspect
+import itertools
 import json
+import math
+import multiprocessing
+import shutil
+import struct
+import time
+import asyncio
+import base64
+import queue
+import random
+import threading
+import warnings
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dataclasses import dataclass, field
+from types import SimpleNamespace
 import tempfile
-from typing import List, Dict, Optional, Tuple, Set
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Set
 
 from dotenv import load_dotenv
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, GraphDatabase, Query, READ_ACCESS, WRITE_ACCESS, unit_of_work
 from pydantic import BaseModel, Field, ValidationError
 
-try:
-    from sentence_transformers import SentenceTransformer  # type: ignore
-except Exception:
-    SentenceTransformer = None  # type: ignore
-
-# Defer OpenAI import inside Embedder to avoid stale module-level state
+# Defer SentenceTransformer (PyTorch) and OpenAI imports to Embedder: importing torch alone
+# costs seconds of startup, and the other backends never need it
 
 try:
     from neo4j_graphrag.generation.graphrag import GraphRAG  # type: ignore
     from neo4j_graphrag.retrievers import VectorRetriever  # type: ignore
     from neo4j_graphrag.llm import OpenAILLM  # type: ignore
+    from neo4j_graphrag.types import RetrieverResultItem  # type: ignore
 except Exception:
     GraphRAG = None  # type: ignore
     VectorRetriever = None  # type: ignore
     OpenAILLM = None  # type: ignore
+    RetrieverResultItem = None  # type: ignore
 
 try:
     from diff_match_patch import diff_match_patch  # type: ignore
 except Exception:
     diff_match_patch = None  # type: ignore
 
+try:
+    import fcntl  # type: ignore
+except ImportError:
+    # Windows: FileLock then only excludes threads of the same process
+    fcntl = None  # type: ignore
+
+try:
+    from tree_sitter import Language as TSLanguage, Parser as TSParser, Query as TSQuery  # type: ignore
+except Exception:
+    TSLanguage = TSParser = TSQuery = None  # type: ignore
+try:
+    from tree_sitter import QueryCursor as TSQueryCursor  # type: ignore
+except Exception:
+    TSQueryCursor = None  # type: ignore
+
 
 load_dotenv()
 EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "local")
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "regex")
 
 
 @dataclass
@@ -49,6 +84,10 @@ class FunctionInfo:
     file_path: str
     class_name: Optional[str] = None
     calls: Set[str] = field(default_factory=set)
+    # Last line of the definition; 0 when the parser cannot tell
+    end_lineno: int = 0
+    # SimHash of the body (see body_simhash); 0 when too short to compare
+    simhash: int = 0
 
 
 @dataclass
@@ -60,6 +99,7 @@ class ClassInfo:
     source: str
     file_path: str
     methods: List[FunctionInfo] = field(default_factory=list)
+    end_lineno: int = 0
 
 
 @dataclass
@@ -71,6 +111,183 @@ class FileInfo:
     functions: List[FunctionInfo] = field(default_factory=list)
 
 
+@dataclass
+class RagResult:
+    answer: str
+    partial: bool = False
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class StageTimeout(Exception):
+    """Raised when a RAG stage exceeds its share of the request deadline."""
+
+
+class EmbeddingError(Exception):
+    """Raised when texts could not be embedded, after retries where the backend allows them."""
+
+
+class Deadline:
+    """Wall-clock budget for one request, split into per-stage sub-budgets."""
+    def __init__(self, seconds: float, shares: Optional[Dict[str, float]] = None):
+        self.total = max(float(seconds), 0.0)
+        self.shares = shares or {}
+        self.expires_at = time.monotonic() + self.total
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def budget(self, stage: str) -> float:
+        # A stage may use its configured share of the total, but never more than what is left
+        share = float(self.shares.get(stage, 1.0))
+        return min(self.remaining(), self.total * share)
+
+
+# Worker threads for deadline-bound stages. On expiry the caller stops waiting, but a call
+# that already started is abandoned, not stopped: it keeps its worker until it returns.
+_STAGE_WORKERS = 8
+_STAGE_POOL = ThreadPoolExecutor(max_workers=_STAGE_WORKERS, thread_name_prefix="graphrag-stage")
+# Abandoned calls still running in _STAGE_POOL
+_STAGE_HUNG: Set[Future] = set()
+_STAGE_LOCK = threading.Lock()
+
+
+def _stage_pool() -> ThreadPoolExecutor:
+    global _STAGE_POOL
+    with _STAGE_LOCK:
+        _STAGE_HUNG.difference_update([f for f in _STAGE_HUNG if f.done()])
+        if len(_STAGE_HUNG) >= _STAGE_WORKERS // 2:
+            # Hung calls hold half the workers: give later requests a fresh pool rather than
+            # let them time out in the queue. The old threads exit as their calls return.
+            _STAGE_POOL.shutdown(wait=False)
+            _STAGE_POOL = ThreadPoolExecutor(max_workers=_STAGE_WORKERS, thread_name_prefix="graphrag-stage")
+            _STAGE_HUNG.clear()
+        return _STAGE_POOL
+
+
+def _run_with_timeout(fn: Callable[..., Any], timeout: float, *args, **kwargs) -> Any:
+    if timeout <= 0:
+        raise StageTimeout("no budget left")
+    fut = _stage_pool().submit(fn, *args, **kwargs)
+    try:
+        return fut.result(timeout=timeout)
+    except FutureTimeout:
+        if not fut.cancel():
+            with _STAGE_LOCK:
+                _STAGE_HUNG.add(fut)
+        raise StageTimeout(f"stage exceeded {timeout:.2f}s")
+
+
+_PIPELINE_END = object()
+
+
+def _run_pipeline(source: Iterable[Any], stages: List[Callable[[Iterator[Any]], Iterator[Any]]],
+                  maxsize: int = 16) -> None:
+    """Run generator ``stages`` in their own threads, linked by bounded queues.
+
+    ``source`` is consumed in the calling thread and feeds the first stage; the
+    last stage's output is discarded. A full queue blocks whoever feeds it, which
+    is the backpressure. The first exception stops every stage and is re-raised.
+    """
+    queues = [queue.Queue(maxsize=max(int(maxsize), 1)) for _ in stages]
+    stop = threading.Event()
+    failed: List[BaseException] = []
+
+    def put(q: "queue.Queue[Any]", item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(q: "queue.Queue[Any]") -> Iterator[Any]:
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _PIPELINE_END:
+                return
+            yield item
+
+    def run(stage: Callable[[Iterator[Any]], Iterator[Any]], qin: "queue.Queue[Any]",
+            qout: Optional["queue.Queue[Any]"]) -> None:
+        try:
+            for out in stage(drain(qin)):
+                if qout is not None and not put(qout, out):
+                    return
+        except BaseException as e:
+            failed.append(e)
+            stop.set()
+        finally:
+            if qout is not None:
+                put(qout, _PIPELINE_END)
+
+    threads = [
+        threading.Thread(target=run, args=(stage, queues[i], queues[i + 1] if i + 1 < len(queues) else None),
+                         name=f"graphrag-sync-{i}", daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for item in source:
+            if not put(queues[0], item):
+                break
+    except BaseException as e:
+        failed.append(e)
+        stop.set()
+    finally:
+        put(queues[0], _PIPELINE_END)
+        for t in threads:
+            t.join()
+    if failed:
+        raise failed[0]
+
+
+def _query(cypher: str, timeout: Optional[float] = None):
+    # Neo4j enforces the timeout server-side, so an expired stage also stops its transaction
+    if timeout is None:
+        return cypher
+    return Query(cypher, timeout=max(timeout, 0.001))
+
+
+class SourceBuffer:
+    """Source text plus a line-start offset index, built once per file.
+
+    Gives O(log n) offset -> line lookups and O(1) line-range slicing, so
+    parsers do not rescan the prefix of the file for every match.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        starts = [0]
+        i = text.find("\n")
+        while i != -1:
+            starts.append(i + 1)
+            i = text.find("\n", i + 1)
+        self.line_starts = starts
+
+    def line_of(self, offset: int) -> int:
+        """1-based line number containing ``offset``."""
+        return bisect.bisect_right(self.line_starts, offset)
+
+    def line_start(self, lineno: int) -> int:
+        return self.line_starts[max(lineno, 1) - 1]
+
+    def lines(self, start: int, end: int) -> str:
+        """Text of 1-based lines ``start``..``end`` inclusive, without the final newline."""
+        n = len(self.line_starts)
+        if start < 1 or start > n or end < start:
+            return ""
+        lo = self.line_starts[start - 1]
+        hi = self.line_starts[end] - 1 if end < n else len(self.text)
+        return self.text[lo:hi]
+
+
 def _read_text(path: str) -> str:
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -116,6 +333,14 @@ class _ImportCollector(ast.NodeVisitor):
             self.imports.add(node.module.split(".")[0])
 
 
+# Names written as calls (`name(`): FunctionInfo.calls for the languages parsed without an AST
+_CALL_NAME = re.compile(r"([A-Za-z_$][\w$]*)\s*\(")
+
+
+def _source_calls(source: str) -> Set[str]:
+    return set(_CALL_NAME.findall(source or ""))
+
+
 def _extract_brace_block(source_text: str, open_brace_index: int) -> str:
     if open_brace_index < 0 or open_brace_index >= len(source_text) or source_text[open_brace_index] != '{':
         return ""
@@ -135,50 +360,227 @@ def _extract_brace_block(source_text: str, open_brace_index: int) -> str:
     return ""
 
 
-def _get_preceding_comment(src: str, start_index: int) -> str:
-    """Extract a doc-comment block immediately preceding start_index.
-    Supports /** ... */ (Java/C++), /// XML doc (C#), and stacked // lines.
+# Comments, string literals and (for C++/C#) preprocessor lines; blanked before brace matching
+_CF_LEXEME = re.compile(r"""
+    (?P<line>//[^\n]*)
+  | (?P<block>/\*.*?(?:\*/|\Z))
+  | (?P<text>\"\"\".*?(?:\"\"\"|\Z))
+  | (?P<raw>R"(?P<delim>[^()\s"\\]{0,16})\(.*?\)(?P=delim)")
+  | (?P<verbatim>(?:\$@|@\$|@)"(?:[^"]|"")*")
+  | (?P<str>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<pp>^[ \t]*\#(?:[^\n]*\\\n)*[^\n]*)
+""", re.S | re.M | re.X)
+_NON_NEWLINE = re.compile(r"[^\n]")
+_NON_SPACE = re.compile(r"\S")
+# C++ access labels ("public:") sit between members without a ';' boundary
+_ACCESS_LABEL = re.compile(r"\s*(?:(?:public|private|protected|signals|slots)\s*:(?!:)\s*)*")
+_CF_KEYWORDS = frozenset({
+    "if", "for", "while", "switch", "catch", "return", "sizeof", "new", "delete", "else", "do", "try",
+    "using", "lock", "foreach", "fixed", "synchronized", "checked", "unchecked", "typeof", "nameof",
+    "throw", "static_assert", "decltype", "alignof", "when", "case", "await",
+})
+
+
+@dataclass
+class _Block:
+    open: int
+    close: int
+    header_start: int
+    parent: Optional[int]
+
+
+class _CFamilyScan:
+    """One linear pass over a C-family source file.
+
+    Comments, strings and preprocessor lines are blanked (newlines kept, so
+    offsets stay valid) before braces are matched, which yields the block
+    tree: every ``{...}`` with the start of its header and its parent block.
+    Comment spans are kept so doc comments can be found by bisection.
     """
-    try:
-        i = start_index
-        while i > 0 and src[i - 1].isspace():
-            i -= 1
-        end = src.rfind("*/", 0, i)
-        if end != -1:
-            start = src.rfind("/*", 0, end)
-            if start != -1 and src[end + 2:i].strip() == "":
-                return src[start:end + 2].strip()
-        # Fallback: stack of // or ///
-        lines = []
-        line_end = i
-        while True:
-            line_start = src.rfind('\n', 0, line_end - 1)
-            if line_start == -1:
-                candidate = src[:line_end]
+    def __init__(self, src: str, language: str):
+        self.src = src
+        self.comments: List[Tuple[int, int, bool]] = []
+        allow_pp = language in ("cpp", "csharp")
+
+        def blank(m: "re.Match[str]") -> str:
+            kind = m.lastgroup
+            if kind == "pp" and not allow_pp:
+                return m.group()
+            if kind in ("line", "block"):
+                self.comments.append((m.start(), m.end(), kind == "block"))
+            return _NON_NEWLINE.sub(" ", m.group())
+
+        self.masked = _CF_LEXEME.sub(blank, src)
+        self._comment_ends = [c[1] for c in self.comments]
+        self.blocks: List[_Block] = []
+        stack: List[int] = []
+        boundary = 0
+        masked = self.masked
+        for m in re.finditer(r"[{};]", masked):
+            i = m.start()
+            ch = masked[i]
+            if ch == "{":
+                if language == "cpp" and self._is_init_brace(boundary, i):
+                    stack.append(-1)
+                    continue
+                label = _ACCESS_LABEL.match(masked, boundary, i)
+                start = label.end() if label else boundary
+                self.blocks.append(_Block(i, len(src) - 1, start, stack[-1] if stack and stack[-1] >= 0 else None))
+                stack.append(len(self.blocks) - 1)
+                boundary = i + 1
+            elif ch == "}":
+                if stack:
+                    idx = stack.pop()
+                    if idx < 0:
+                        # Closing a brace initializer inside a constructor's member-init list
+                        continue
+                    self.blocks[idx].close = i
+                boundary = i + 1
             else:
-                candidate = src[line_start + 1:line_end]
-            stripped = candidate.strip()
-            if stripped.startswith('///') or stripped.startswith('//'):
-                lines.append(stripped)
-                if line_start == -1:
-                    break
-                line_end = line_start
-                continue
-            if stripped == "":
-                if line_start == -1:
-                    break
-                line_end = line_start
-                continue
-            break
-        if lines:
-            return "\n".join(reversed(lines))
-    except Exception:
-        pass
-    return ""
+                if stack and stack[-1] < 0:
+                    continue
+                boundary = i + 1
+
+    def _is_init_brace(self, boundary: int, i: int) -> bool:
+        # `Point(int x) : x_{x} {` - braces after a member name in an init list are not blocks
+        j = i - 1
+        while j >= boundary and self.masked[j].isspace():
+            j -= 1
+        if j < boundary or not (self.masked[j].isalnum() or self.masked[j] in "_>"):
+            return False
+        return re.search(r"\)\s*(?:noexcept\s*)?:(?!:)", self.masked[boundary:i]) is not None
+
+    def header(self, block: _Block) -> str:
+        return self.masked[block.header_start:block.open]
+
+    def body(self, block: _Block) -> str:
+        # From the start of the line holding '{' through the matching '}'
+        line_start = self.src.rfind("\n", 0, block.open) + 1
+        return self.src[line_start:block.close + 1]
+
+    def signature(self, block: _Block) -> str:
+        return self.src[block.header_start:block.open].strip()
+
+    def doc_before(self, pos: int) -> str:
+        """Doc comment immediately preceding ``pos``: one /* */ block or a run of // lines."""
+        k = bisect.bisect_right(self._comment_ends, pos) - 1
+        lines: List[str] = []
+        end = pos
+        while k >= 0:
+            c_start, c_end, is_block = self.comments[k]
+            if _NON_SPACE.search(self.src, c_end, end):
+                break
+            if is_block:
+                if not lines:
+                    return self.src[c_start:c_end].strip()
+                break
+            lines.append(self.src[c_start:c_end].strip())
+            end = c_start
+            k -= 1
+        return "\n".join(reversed(lines))
+
+
+_CF_CLASS = {
+    "java": re.compile(r"\bclass\s+([A-Za-z_$][\w$]*)"),
+    "csharp": re.compile(r"\bclass\s+([A-Za-z_]\w*)"),
+    "cpp": re.compile(r"\b(?:class|struct)\s+([A-Za-z_]\w*)"),
+}
+_CF_PARAMS = r"\((?P<params>[^()]*(?:\([^()]*\)[^()]*)*)\)"
+_CF_FUNC = {
+    "java": re.compile(r"^(?P<pre>.*?)\b(?P<name>[A-Za-z_$][\w$]*)\s*" + _CF_PARAMS
+                       + r"\s*(?:throws\s+[\w$.,\s<>]+)?\s*$", re.S),
+    "csharp": re.compile(r"^(?P<pre>.*?)\b(?P<name>[A-Za-z_]\w*)\s*(?:<[^<>()]*>\s*)?" + _CF_PARAMS
+                         + r"\s*(?::\s*(?:base|this)\s*\(.*\))?\s*(?:where\s+.+)?$", re.S),
+    "cpp": re.compile(r"^(?P<pre>.*?)(?P<name>~?\b[A-Za-z_]\w*(?:\s*::\s*~?[A-Za-z_]\w*)*)\s*" + _CF_PARAMS
+                      + r"\s*(?:(?:const|override|final|volatile|noexcept(?:\s*\([^()]*\))?|&&?|->\s*[^{;:]+)\s*)*"
+                      + r"(?::(?!:).*)?$", re.S),
+}
+_CF_NAMESPACE = re.compile(r"\b(?:namespace|extern)\b")
+_CF_BAD_PRE_END = ("=", ".", ",", "(", "?", "!", "|", "&&", "+", "return", "new", "else", "throw", "case", "await")
+
+
+def _cf_function(language: str, header: str) -> Optional["re.Match[str]"]:
+    m = _CF_FUNC[language].match(header)
+    if not m:
+        return None
+    name = re.sub(r"\s+", "", m.group("name"))
+    if name.split("::")[-1].lstrip("~") in _CF_KEYWORDS:
+        return None
+    pre = m.group("pre").strip()
+    if pre.endswith(_CF_BAD_PRE_END) or (pre.split() and pre.split()[-1] in _CF_KEYWORDS):
+        return None
+    return m
+
+
+def _parse_c_family(src: str, rel: str, fi: FileInfo) -> FileInfo:
+    language = fi.language
+    scan = _CFamilyScan(src, language)
+    buf = SourceBuffer(src)
+    file_qual = rel.replace(os.sep, '.')
+    class_re = _CF_CLASS[language]
+    classes: Dict[int, ClassInfo] = {}
+    namespaces: Set[int] = set()
+
+    for idx, blk in enumerate(scan.blocks):
+        header = scan.header(blk)
+        cm = class_re.search(header)
+        # C++: `enum class X` is not a class, and `struct tm* f(...)` is a function returning one
+        if cm and not (language == "cpp" and (re.search(r"\benum\s+(?:class|struct)\b", header)
+                                              or "(" in header[cm.end():])):
+            class_name = cm.group(1)
+            cls_body = scan.body(blk)
+            classes[idx] = ClassInfo(
+                name=class_name,
+                qualname=f"{file_qual}.{class_name}",
+                lineno=buf.line_of(blk.header_start + cm.start()),
+                docstring=scan.doc_before(blk.header_start),
+                source=cls_body[:2000] if cls_body else "",
+                file_path=rel,
+                end_lineno=buf.line_of(blk.close),
+            )
+            fi.classes.append(classes[idx])
+            continue
+        if _CF_NAMESPACE.search(header) and "(" not in header:
+            namespaces.add(idx)
+            continue
+        # Only members of a class, or (C++) free functions at file/namespace scope
+        parent = blk.parent
+        owner = classes.get(parent) if parent is not None else None
+        if owner is None and not (language == "cpp" and (parent is None or parent in namespaces)):
+            continue
+        fm = _cf_function(language, header)
+        if not fm:
+            continue
+        name = re.sub(r"\s+", "", fm.group("name"))
+        pre = fm.group("pre").strip()
+        short = name.split("::")[-1]
+        is_ctor = owner is not None and short.lstrip("~") == owner.name
+        if not pre and not is_ctor and "::" not in name:
+            # A bare `name(...)` with no return type is a macro call, not a definition
+            continue
+        body = scan.body(blk)
+        sig = scan.signature(blk)
+        limit = 1200 if is_ctor else 1500
+        fun = FunctionInfo(
+            name=short,
+            qualname=f"{owner.qualname if owner else file_qual}.{short}",
+            lineno=buf.line_of(blk.header_start + fm.start("name")),
+            docstring=scan.doc_before(blk.header_start),
+            source=(sig + "\n" + (body[:limit] if body else "")).strip(),
+            file_path=rel,
+            class_name=owner.name if owner else None,
+            calls=_source_calls(body),
+            end_lineno=buf.line_of(blk.close),
+        )
+        if owner is not None:
+            owner.methods.append(fun)
+        else:
+            fi.functions.append(fun)
+    return fi
 
 
-def parse_python_file(path: str, repo_root: str) -> FileInfo:
-    src = _read_text(path)
+def parse_python_file(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    src = _read_text(path) if src is None else src
     rel = os.path.relpath(path, repo_root)
     fi = FileInfo(path=rel)
     try:
@@ -189,12 +591,11 @@ def parse_python_file(path: str, repo_root: str) -> FileInfo:
     ic.visit(tree)
     fi.imports = ic.imports
 
+    buf = SourceBuffer(src)
+
     def get_seg(node: ast.AST) -> str:
         try:
-            lines = src.splitlines()
-            start = node.lineno - 1
-            end = getattr(node, "end_lineno", node.lineno)
-            return "\n".join(lines[start:end])
+            return buf.lines(node.lineno, getattr(node, "end_lineno", None) or node.lineno)
         except Exception:
             return ""
 
@@ -209,6 +610,7 @@ def parse_python_file(path: str, repo_root: str) -> FileInfo:
                 docstring=ast.get_docstring(node) or "",
                 source=get_seg(node),
                 file_path=rel,
+                end_lineno=getattr(node, "end_lineno", None) or 0,
             )
             for n in node.body:
                 if isinstance(n, ast.FunctionDef):
@@ -224,6 +626,7 @@ def parse_python_file(path: str, repo_root: str) -> FileInfo:
                         file_path=rel,
                         class_name=cls_name,
                         calls=cc.calls,
+                        end_lineno=getattr(n, "end_lineno", None) or 0,
                     ))
             fi.classes.append(cls_info)
         elif isinstance(node, ast.FunctionDef):
@@ -238,12 +641,14 @@ def parse_python_file(path: str, repo_root: str) -> FileInfo:
                 source=get_seg(node),
                 file_path=rel,
                 calls=cc.calls,
+                end_lineno=getattr(node, "end_lineno", None) or 0,
             ))
     return fi
 
 
-def _parse_js_like(path: str, repo_root: str) -> FileInfo:
-    src = _read_text(path)
+def _parse_js_like(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    src = _read_text(path) if src is None else src
+    buf = SourceBuffer(src)
     rel = os.path.relpath(path, repo_root)
     language = "typescript" if path.endswith((".ts", ".tsx")) else "javascript"
     fi = FileInfo(path=rel, language=language)
@@ -261,7 +666,7 @@ def _parse_js_like(path: str, repo_root: str) -> FileInfo:
         fi.classes.append(ClassInfo(
             name=class_name,
             qualname=qual,
-            lineno=src[:cm.start()].count('\n') + 1,
+            lineno=buf.line_of(cm.start()),
             docstring="",
             source="",
             file_path=rel,
@@ -274,10 +679,12 @@ def _parse_js_like(path: str, repo_root: str) -> FileInfo:
         fi.functions.append(FunctionInfo(
             name=fun_name,
             qualname=fun_qual,
-            lineno=src[:fm.start()].count('\n') + 1,
+            lineno=buf.line_of(fm.start()),
             docstring="",
             source=body or "",
             file_path=rel,
+            calls=_source_calls(body),
+            end_lineno=buf.line_of(src.rfind("\n", 0, brace_pos) + len(body)) if body else 0,
         ))
     for am in re.finditer(r"^\s*(export\s+)?const\s+([A-Za-z0-9_]+)\s*=\s*\([^)]*\)\s*=>\s*\{", src, flags=re.MULTILINE):
         fun_name = am.group(2)
@@ -286,462 +693,2361 @@ def _parse_js_like(path: str, repo_root: str) -> FileInfo:
         fi.functions.append(FunctionInfo(
             name=fun_name,
             qualname=fun_qual,
-            lineno=src[:am.start()].count('\n') + 1,
+            lineno=buf.line_of(am.start()),
             docstring="",
             source=body or "",
             file_path=rel,
+            calls=_source_calls(body),
+            end_lineno=buf.line_of(src.rfind("\n", 0, am.end() - 1) + len(body)) if body else 0,
         ))
     return fi
 
 
-def _parse_java(path: str, repo_root: str) -> FileInfo:
-    src = _read_text(path)
+def _parse_java(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    src = _read_text(path) if src is None else src
     rel = os.path.relpath(path, repo_root)
     fi = FileInfo(path=rel, language="java")
     for m in re.finditer(r"^\s*import\s+([A-Za-z0-9_\.]+)", src, flags=re.MULTILINE):
         mod = m.group(1).split('.')[0]
         if mod:
             fi.imports.add(mod)
-    class_pat = re.compile(r"^\s*(?:@[A-Za-z0-9_\.]+\s*)*(?:public|private|protected)?(?:\s+(?:static|final|abstract))*\s*class\s+([A-Za-zA-Z_][A-Za-z0-9_]*)\b", re.MULTILINE)
-    for cm in class_pat.finditer(src):
-        class_name = cm.group(1)
-        qual = f"{rel.replace(os.sep, '.')}.{class_name}"
-        cls_lineno = src[:cm.start()].count('\n') + 1
-        brace_pos = src.find('{', cm.end())
-        cls_body = _extract_brace_block(src, brace_pos) if brace_pos != -1 else ""
-        cls_doc = _get_preceding_comment(src, cm.start())
-        cls_source = cls_body[:2000] if cls_body else ""
-        cls_info = ClassInfo(
-            name=class_name,
-            qualname=qual,
-            lineno=cls_lineno,
-            docstring=cls_doc,
-            source=cls_source,
-            file_path=rel,
-        )
-        if cls_body:
-            body_offset = brace_pos
-            meth_pattern = re.compile(r"^\s*(public|private|protected)(?:\s+(?:static|final|abstract|synchronized))*\s+[A-Za-z0-9_<>,\[\]\.?]+\s+([A-Za-zA-Z_][A-Za-z0-9_]*)\s*\(([^)]*)\)\s*\{", re.MULTILINE)
-            for mm in meth_pattern.finditer(cls_body):
-                fun_name = mm.group(2)
-                fun_qual = f"{qual}.{fun_name}"
-                open_br = cls_body.find('{', mm.end() - 1)
-                fun_body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_doc = _get_preceding_comment(cls_body, mm.start()) or _get_preceding_comment(src, body_offset + mm.start())
-                sig = cls_body[mm.start():cls_body.find('{', mm.end() - 1)].strip()
-                snippet = (sig + "\n" + (fun_body[:1500] if fun_body else "")).strip()
-                fun_lineno = src[:body_offset + mm.start()].count('\n') + 1
-                cls_info.methods.append(FunctionInfo(
-                    name=fun_name,
-                    qualname=fun_qual,
-                    lineno=fun_lineno,
-                    docstring=fun_doc,
-                    source=snippet,
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-            ctor_pattern = re.compile(rf"^\s*(public|private|protected)(?:\s+(?:static|final|abstract|synchronized))*\s+{re.escape(class_name)}\s*\(([^)]*)\)\s*\{{", re.MULTILINE)
-            for cmc in ctor_pattern.finditer(cls_body):
-                sig = cls_body[cmc.start():cls_body.find('{', cmc.end() - 1)].strip()
-                open_br = cls_body.find('{', cmc.end() - 1)
-                body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_lineno = src[:body_offset + cmc.start()].count('\n') + 1
-                doc = _get_preceding_comment(cls_body, cmc.start()) or _get_preceding_comment(src, body_offset + cmc.start())
-                cls_info.methods.append(FunctionInfo(
-                    name=class_name,
-                    qualname=f"{qual}.{class_name}",
-                    lineno=fun_lineno,
-                    docstring=doc,
-                    source=(sig + "\n" + (body[:1200] if body else "")).strip(),
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-        fi.classes.append(cls_info)
-    return fi
+    return _parse_c_family(src, rel, fi)
 
 
-def _parse_csharp(path: str, repo_root: str) -> FileInfo:
-    src = _read_text(path)
+def _parse_csharp(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    src = _read_text(path) if src is None else src
     rel = os.path.relpath(path, repo_root)
     fi = FileInfo(path=rel, language="csharp")
     for m in re.finditer(r"^\s*using\s+([A-Za-z0-9_\.]+)\s*;", src, flags=re.MULTILINE):
         mod = m.group(1).split('.')[0]
         if mod:
             fi.imports.add(mod)
-    class_pat = re.compile(r"^\s*(?:\[[^\]]+\]\s*)*(?:public|private|protected|internal)?(?:\s+(?:static|partial|sealed|abstract))*\s*class\s+([A-Za-zA-Z_][A-Za-z0-9_]*)\b", re.MULTILINE)
-    for cm in class_pat.finditer(src):
-        class_name = cm.group(1)
-        qual = f"{rel.replace(os.sep, '.')}.{class_name}"
-        cls_lineno = src[:cm.start()].count('\n') + 1
-        brace_pos = src.find('{', cm.end())
-        cls_body = _extract_brace_block(src, brace_pos) if brace_pos != -1 else ""
-        cls_doc = _get_preceding_comment(src, cm.start())
-        cls_source = cls_body[:2000] if cls_body else ""
-        cls_info = ClassInfo(
-            name=class_name,
-            qualname=qual,
-            lineno=cls_lineno,
-            docstring=cls_doc,
-            source=cls_source,
-            file_path=rel,
-        )
-        if cls_body:
-            body_offset = brace_pos
-            meth_pattern = re.compile(r"^\s*(public|private|protected|internal)(?:\s+(?:static|virtual|override|async|sealed|abstract|partial))*\s+[A-Za-z0-9_<>,\[\]\.?]+\s+([A-Za-zA-Z_][A-Za-z0-9_]*)\s*\(([^)]*)\)\s*\{", re.MULTILINE)
-            for mm in meth_pattern.finditer(cls_body):
-                fun_name = mm.group(2)
-                fun_qual = f"{qual}.{fun_name}"
-                open_br = cls_body.find('{', mm.end() - 1)
-                fun_body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_doc = _get_preceding_comment(cls_body, mm.start()) or _get_preceding_comment(src, body_offset + mm.start())
-                sig = cls_body[mm.start():cls_body.find('{', mm.end() - 1)].strip()
-                snippet = (sig + "\n" + (fun_body[:1500] if fun_body else "")).strip()
-                fun_lineno = src[:body_offset + mm.start()].count('\n') + 1
-                cls_info.methods.append(FunctionInfo(
-                    name=fun_name,
-                    qualname=fun_qual,
-                    lineno=fun_lineno,
-                    docstring=fun_doc,
-                    source=snippet,
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-            ctor_pattern = re.compile(rf"^\s*(public|private|protected|internal)(?:\s+(?:static|virtual|override|async|sealed|abstract|partial))*\s+{re.escape(class_name)}\s*\(([^)]*)\)\s*\{{", re.MULTILINE)
-            for cmc in ctor_pattern.finditer(cls_body):
-                sig = cls_body[cmc.start():cls_body.find('{', cmc.end() - 1)].strip()
-                open_br = cls_body.find('{', cmc.end() - 1)
-                body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_lineno = src[:body_offset + cmc.start()].count('\n') + 1
-                doc = _get_preceding_comment(cls_body, cmc.start()) or _get_preceding_comment(src, body_offset + cmc.start())
-                cls_info.methods.append(FunctionInfo(
-                    name=class_name,
-                    qualname=f"{qual}.{class_name}",
-                    lineno=fun_lineno,
-                    docstring=doc,
-                    source=(sig + "\n" + (body[:1200] if body else "")).strip(),
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-        fi.classes.append(cls_info)
-    return fi
+    return _parse_c_family(src, rel, fi)
 
 
-def _parse_cpp(path: str, repo_root: str) -> FileInfo:
-    src = _read_text(path)
+def _parse_cpp(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    src = _read_text(path) if src is None else src
     rel = os.path.relpath(path, repo_root)
     fi = FileInfo(path=rel, language="cpp")
     for m in re.finditer(r"^\s*#\s*include\s*[<\"]([^>\"]+)[>\"]", src, flags=re.MULTILINE):
         mod = m.group(1).split('/')[0]
         if mod:
             fi.imports.add(mod)
-    class_pat = re.compile(r"^\s*(?:template\s*<[^>]+>\s*)*(class|struct)\s+([A-Za-z_][A-Za-z0-9_]*)\b", re.MULTILINE)
-    for cm in class_pat.finditer(src):
-        class_name = cm.group(2)
-        qual = f"{rel.replace(os.sep, '.')}.{class_name}"
-        cls_lineno = src[:cm.start()].count('\n') + 1
-        brace_pos = src.find('{', cm.end())
-        cls_body = _extract_brace_block(src, brace_pos) if brace_pos != -1 else ""
-        cls_doc = _get_preceding_comment(src, cm.start())
-        cls_source = cls_body[:2000] if cls_body else ""
-        cls_info = ClassInfo(
-            name=class_name,
-            qualname=qual,
-            lineno=cls_lineno,
-            docstring=cls_doc,
-            source=cls_source,
-            file_path=rel,
-        )
-        if cls_body:
-            body_offset = brace_pos
-            meth_pattern = re.compile(r"^\s*[A-Za-z_][\w:<>,\s\*&]+\s+([A-Za-z_][\w:]*)\s*\(([^)]*)\)\s*(const\s*)?\{", re.MULTILINE)
-            for mm in meth_pattern.finditer(cls_body):
-                fun_name = mm.group(1).split('::')[-1]
-                fun_qual = f"{qual}.{fun_name}"
-                open_br = cls_body.find('{', mm.end() - 1)
-                fun_body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_doc = _get_preceding_comment(cls_body, mm.start()) or _get_preceding_comment(src, body_offset + mm.start())
-                sig = cls_body[mm.start():cls_body.find('{', mm.end() - 1)].strip()
-                snippet = (sig + "\n" + (fun_body[:1500] if fun_body else "")).strip()
-                fun_lineno = src[:body_offset + mm.start()].count('\n') + 1
-                cls_info.methods.append(FunctionInfo(
-                    name=fun_name,
-                    qualname=fun_qual,
-                    lineno=fun_lineno,
-                    docstring=fun_doc,
-                    source=snippet,
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-            ctor_pattern = re.compile(rf"^\s*~?{re.escape(class_name)}\s*\(([^)]*)\)\s*(const\s*)?\{{", re.MULTILINE)
-            for cmc in ctor_pattern.finditer(cls_body):
-                is_dtor = cls_body[cmc.start():cmc.end()].lstrip().startswith('~')
-                name = f"~{class_name}" if is_dtor else class_name
-                sig = cls_body[cmc.start():cls_body.find('{', cmc.end() - 1)].strip()
-                open_br = cls_body.find('{', cmc.end() - 1)
-                body = _extract_brace_block(cls_body, open_br) if open_br != -1 else ""
-                fun_lineno = src[:body_offset + cmc.start()].count('\n') + 1
-                doc = _get_preceding_comment(cls_body, cmc.start()) or _get_preceding_comment(src, body_offset + cmc.start())
-                cls_info.methods.append(FunctionInfo(
-                    name=name,
-                    qualname=f"{qual}.{name}",
-                    lineno=fun_lineno,
-                    docstring=doc,
-                    source=(sig + "\n" + (body[:1200] if body else "")).strip(),
-                    file_path=rel,
-                    class_name=class_name,
-                ))
-        fi.classes.append(cls_info)
-    func_pattern = re.compile(r"^\s*[A-Za-z_][\w:<>,\s\*&]+\s+([A-Za-z_][\w:]*)\s*\(([^)]*)\)\s*(const\s*)?\{", re.MULTILINE)
-    for fm in func_pattern.finditer(src):
-        fun_name = fm.group(1).split('::')[-1]
-        fun_qual = f"{rel.replace(os.sep, '.')}.{fun_name}"
-        open_br = src.find('{', fm.end() - 1)
-        body = _extract_brace_block(src, open_br) if open_br != -1 else ""
-        doc = _get_preceding_comment(src, fm.start())
-        sig = src[fm.start():src.find('{', fm.end() - 1)].strip()
-        fi.functions.append(FunctionInfo(
-            name=fun_name,
-            qualname=fun_qual,
-            lineno=src[:fm.start()].count('\n') + 1,
-            docstring=doc,
-            source=(sig + "\n" + (body[:1500] if body else "")).strip(),
-            file_path=rel,
-        ))
-    return fi
+    return _parse_c_family(src, rel, fi)
 
 
-def parse_file(path: str, repo_root: str) -> FileInfo:
-    if path.endswith('.py'):
-        return parse_python_file(path, repo_root)
-    if path.endswith('.java'):
-        return _parse_java(path, repo_root)
-    if path.endswith('.js') or path.endswith('.ts') or path.endswith('.tsx'):
-        return _parse_js_like(path, repo_root)
-    if path.endswith('.cs'):
-        return _parse_csharp(path, repo_root)
-    if path.endswith('.cpp') or path.endswith('.cc') or path.endswith('.cxx') or path.endswith('.hpp') or path.endswith('.hh') or path.endswith('.hxx') or path.endswith('.h'):
-        return _parse_cpp(path, repo_root)
-    return FileInfo(path=os.path.relpath(path, repo_root))
+# ---- tree-sitter backend (PARSER_BACKEND=treesitter) ----
 
+# Grammar package and language function per language; .tsx gets its own grammar
+_TS_GRAMMARS: Dict[str, Tuple[str, str]] = {
+    "python": ("tree_sitter_python", "language"),
+    "javascript": ("tree_sitter_javascript", "language"),
+    "typescript": ("tree_sitter_typescript", "language_typescript"),
+    "tsx": ("tree_sitter_typescript", "language_tsx"),
+    "java": ("tree_sitter_java", "language"),
+    "csharp": ("tree_sitter_c_sharp", "language"),
+    "cpp": ("tree_sitter_cpp", "language"),
+}
+_TS_JS = {
+    "classes": {"class_declaration", "abstract_class_declaration"},
+    "functions": {"function_declaration", "generator_function_declaration", "method_definition"},
+    "containers": {"program", "export_statement", "class_body", "lexical_declaration", "variable_declaration"},
+    "imports": """
+        (import_statement source: (string) @src)
+        (call_expression function: (identifier) @fn arguments: (arguments . (string) @src))
+    """,
+    "free_functions": True,
+}
+# Node types per grammar: what is a class, what is a function, and which nodes are walked
+# through (modules, namespaces, exports, templates) on the way to them
+_TS_NODES: Dict[str, Dict[str, Any]] = {
+    "python": {
+        "classes": {"class_definition"},
+        "functions": {"function_definition"},
+        "containers": {"module", "decorated_definition", "block"},
+        "imports": "[(import_statement) (import_from_statement)] @imp",
+        "free_functions": True,
+    },
+    "javascript": _TS_JS,
+    "typescript": _TS_JS,
+    "tsx": _TS_JS,
+    "java": {
+        "classes": {"class_declaration"},
+        "functions": {"method_declaration", "constructor_declaration"},
+        "containers": {"program", "class_body"},
+        "imports": "(import_declaration) @imp",
+        "free_functions": False,
+    },
+    "csharp": {
+        "classes": {"class_declaration"},
+        "functions": {"method_declaration", "constructor_declaration"},
+        "containers": {"compilation_unit", "namespace_declaration", "file_scoped_namespace_declaration",
+                       "declaration_list"},
+        "imports": "(using_directive) @imp",
+        "free_functions": False,
+    },
+    "cpp": {
+        "classes": {"class_specifier", "struct_specifier"},
+        "functions": {"function_definition"},
+        "containers": {"translation_unit", "namespace_definition", "declaration_list", "linkage_specification",
+                       "template_declaration", "field_declaration_list", "field_declaration", "declaration",
+                       "preproc_if", "preproc_ifdef", "preproc_else", "preproc_elif"},
+        "imports": "(preproc_include path: (_) @src)",
+        "free_functions": True,
+    },
+}
+_TS_COMMENTS = frozenset({"comment", "line_comment", "block_comment"})
+# Wrappers whose start (not the wrapped node's) is where a doc comment or signature begins
+_TS_WRAPPERS = frozenset({"export_statement", "template_declaration", "decorated_definition"})
+_TS_PY_CALLS = "(call function: [(identifier) (attribute)] @fn)"
 
-class Embedder:
-    def __init__(self):
-        self.backend = EMBEDDING_BACKEND
-        if self.backend == "local":
-            if SentenceTransformer is None:
-                raise RuntimeError("sentence-transformers not installed; install or set EMBEDDING_BACKEND=openai")
-            self.model = SentenceTransformer("all-MiniLM-L6-v2")
-            self.dim = 384
-        elif self.backend == "openai":
-            # Lazy import: only require openai package if OpenAI backend is selected,
-            # so the server can run with local embeddings without this dependency.
-            try:
-                from openai import OpenAI  # type: ignore
-            except Exception as e:
-                raise RuntimeError("openai package not installed")
-            if not os.getenv("OPENAI_API_KEY"):
-                raise RuntimeError("OPENAI_API_KEY not set")
-            self.model_name = "text-embedding-3-small"
-            self.dim = 1536
+
+def _common_prefix(a: bytes, b: bytes, block: int = 1 << 16) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    # Whole blocks first (compared in C), then narrow down inside the first differing one
+    while i + block <= n and a[i:i + block] == b[i:i + block]:
+        i += block
+    lo, hi = i, min(i + block, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            lo = mid
         else:
-            raise ValueError("EMBEDDING_BACKEND must be 'local' or 'openai'")
+            hi = mid - 1
+    return lo
 
-    def _model_id(self) -> str:
-        if self.backend == "local":
-            return "all-MiniLM-L6-v2"
-        return getattr(self, "model_name", "unknown")
 
-    def cache_key_for_text(self, text: str) -> str:
-        h = hashlib.sha256(text.encode("utf-8")).hexdigest()
-        return f"{self.backend}:{self._model_id()}:{self.dim}:{h}"
+def _ts_point(data: bytes, offset: int) -> Tuple[int, int]:
+    return data.count(b"\n", 0, offset), offset - (data.rfind(b"\n", 0, offset) + 1)
 
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        if self.backend == "local":
-            return self.model.encode(texts, show_progress_bar=False, normalize_embeddings=True).tolist()
-        # Lazy import at call site: keep optional dependency out of module import path
-        # and reflect current environment variables at runtime.
-        from openai import OpenAI  # type: ignore
-        client = OpenAI()
-        resp = client.embeddings.create(model=self.model_name, input=texts)
-        return [d.embedding for d in resp.data]
 
+def _ts_edit(old: bytes, new: bytes) -> Dict[str, Any]:
+    """The single edit turning ``old`` into ``new``: common prefix and suffix are kept."""
+    start = _common_prefix(old, new)
+    limit = min(len(old), len(new)) - start
+    suffix = min(_common_prefix(old[::-1], new[::-1]), limit)
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    return {
+        "start_byte": start, "old_end_byte": old_end, "new_end_byte": new_end,
+        "start_point": _ts_point(old, start),
+        "old_end_point": _ts_point(old, old_end),
+        "new_end_point": _ts_point(new, new_end),
+    }
 
-class GraphRAGEmbedderAdapter:
-    def __init__(self, base_embedder: Embedder):
-        self._base = base_embedder
 
-    def embed_query(self, text: str):
-        return self._base.embed([text])[0]
+def _ts_matches(query: Any, node: Any) -> List[Dict[str, Any]]:
+    if TSQueryCursor is not None:
+        matches = TSQueryCursor(query).matches(node)
+    else:
+        matches = query.matches(node)
+    out = []
+    for _, caps in matches:
+        # Older bindings return a single node per capture, newer ones a list
+        out.append({k: v[0] if isinstance(v, list) else v for k, v in caps.items()})
+    return out
 
 
-class EmbeddingCache:
-    """JSON file-backed cache for embeddings. Keyed by model+text hash."""
-    def __init__(self, path: str, max_entries: int = 200000, flush_interval: int = 50):
-        self.path = path
-        self.max_entries = max_entries
-        self.flush_interval = flush_interval
-        self._data: Dict[str, List[float]] = {}
-        self._order: List[str] = []  # simple FIFO for eviction
-        self._dirty = 0
-        self._load()
+class TreeSitterParser:
+    """``parse_file`` backend on tree-sitter grammars, reparsing incrementally.
 
-    def _load(self) -> None:
-        try:
-            if os.path.exists(self.path):
-                with open(self.path, "r", encoding="utf-8") as f:
-                    obj = json.load(f)
-                    if isinstance(obj, dict):
-                        # ensure values are lists of floats
-                        self._data = {k: list(map(float, v)) for k, v in obj.items() if isinstance(v, list)}
-                        self._order = list(self._data.keys())
-        except Exception:
-            # Corrupt cache; start fresh
-            self._data = {}
-            self._order = []
+    The last tree and source bytes are kept per path (up to ``max_trees`` paths),
+    so parsing a new version of a file edits the old tree and lets tree-sitter
+    reuse every subtree outside the changed range. Produces the same
+    ``FileInfo`` model as the regex parsers.
+    """
+    def __init__(self, max_trees: int = 256):
+        self.max_trees = max_trees
+        self._parsers: Dict[str, Any] = {}
+        self._queries: Dict[Tuple[str, str], Any] = {}
+        self._trees: Dict[str, Tuple[bytes, Any]] = {}
+        self._lock = threading.Lock()
 
-    def flush(self) -> None:
-        try:
-            tmp = self.path + ".tmp"
-            os.makedirs(os.path.dirname(self.path), exist_ok=True)
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(self._data, f)
+    @staticmethod
+    def available() -> bool:
+        return TSParser is not None
+
+    def _grammar(self, language: str) -> Optional[Any]:
+        if language not in self._parsers:
+            module, fn = _TS_GRAMMARS[language]
             try:
-                os.replace(tmp, self.path)
-            finally:
-                if os.path.exists(tmp):
-                    try:
-                        os.remove(tmp)
-                    except Exception:
-                        pass
-            self._dirty = 0
-        except Exception:
-            # ignore flush errors
-            pass
+                lang = TSLanguage(getattr(importlib.import_module(module), fn)())
+                self._parsers[language] = (lang, TSParser(lang))
+            except Exception:
+                self._parsers[language] = None
+        return self._parsers[language]
 
-    def get(self, key: str) -> Optional[List[float]]:
-        try:
-            return self._data.get(key)
-        except Exception:
+    def _query(self, language: str, source: str) -> Any:
+        key = (language, source)
+        if key not in self._queries:
+            self._queries[key] = TSQuery(self._parsers[language][0], source)
+        return self._queries[key]
+
+    def parse(self, path: str, repo_root: str, src: Optional[str] = None) -> Optional[FileInfo]:
+        """Parse ``path``, or return None when no grammar is installed for it."""
+        entry = _parser_for(path)
+        if entry is None or not self.available():
             return None
+        language = entry[0]
+        grammar = "tsx" if path.endswith(".tsx") else language
+        src = _read_text(path) if src is None else src
+        data = src.encode("utf-8")
+        key = os.path.abspath(path)
+        with self._lock:
+            loaded = self._grammar(grammar)
+            if loaded is None:
+                return None
+            prev = self._trees.pop(key, None)
+            if prev is not None and prev[0] == data:
+                tree = prev[1]
+            elif prev is not None:
+                prev[1].edit(**_ts_edit(prev[0], data))
+                tree = loaded[1].parse(data, prev[1])
+            else:
+                tree = loaded[1].parse(data)
+            self._trees[key] = (data, tree)
+            while len(self._trees) > self.max_trees:
+                self._trees.pop(next(iter(self._trees)))
+            return _TSExtract(self, grammar, data, os.path.relpath(path, repo_root),
+                              FileInfo(path=os.path.relpath(path, repo_root), language=language)).run(tree)
 
-    def set(self, key: str, vec: List[float]) -> None:
-        if key in self._data:
-            self._data[key] = vec
-            return
-        # Evict if necessary
-        if len(self._order) >= self.max_entries:
-            old = self._order.pop(0)
-            try:
-                del self._data[old]
-            except KeyError:
-                pass
-        self._data[key] = vec
-        self._order.append(key)
-        self._dirty += 1
-        if self._dirty >= self.flush_interval:
-            self.flush()
+    def forget(self, path: str) -> None:
+        with self._lock:
+            self._trees.pop(os.path.abspath(path), None)
 
 
-class Neo4jWriter:
-    def __init__(self, uri: str, user: str, pwd: str, embedder: Embedder, emb_cache: Optional["EmbeddingCache"] = None):
-        self.driver = GraphDatabase.driver(uri, auth=(user, pwd))
-        self.embedder = embedder
-        self.emb_cache = emb_cache
-        self.ensure_schema()
+class _TSExtract:
+    """Walks one syntax tree into a FileInfo; only declaration-bearing nodes are visited."""
+    def __init__(self, ts: TreeSitterParser, grammar: str, data: bytes, rel: str, fi: FileInfo):
+        self.ts = ts
+        self.grammar = grammar
+        self.spec = _TS_NODES[grammar]
+        self.data = data
+        self.rel = rel
+        self.file_qual = rel.replace(os.sep, '.')
+        self.fi = fi
 
-    def close(self):
-        self.driver.close()
+    def text(self, node: Any) -> str:
+        return self.data[node.start_byte:node.end_byte].decode("utf-8", "replace")
 
-    def run(self, cypher: str, **params):
-        with self.driver.session() as s:
-            result = s.run(cypher, **params)
-            out = list(result)
-            try:
-                result.consume()
-            except Exception:
-                pass
+    def from_line_start(self, start: int, end: int) -> str:
+        return self.data[self.data.rfind(b"\n", 0, start) + 1:end].decode("utf-8", "replace")
+
+    def run(self, tree: Any) -> FileInfo:
+        root = tree.root_node
+        self.imports(root)
+        self.walk(root, None)
+        return self.fi
+
+    def imports(self, root: Any) -> None:
+        lang = self.grammar
+        for caps in _ts_matches(self.ts._query(lang, self.spec["imports"]), root):
+            if lang == "python":
+                self.fi.imports.update(self._py_imports(caps["imp"]))
+                continue
+            if "fn" in caps and self.text(caps["fn"]) != "require":
+                continue
+            if "src" in caps:
+                text = self.text(caps["src"]).strip("'\"`<>")
+                mod = text.split('/')[0]
+                if mod and not (mod.startswith('.') and lang != "cpp"):
+                    self.fi.imports.add(mod)
+                continue
+            text = self.text(caps["imp"])
+            m = re.match(r"(?:import\s+(?:static\s+)?|using\s+)([A-Za-z0-9_\.]+)\s*;", text)
+            if m and m.group(1).split('.')[0]:
+                self.fi.imports.add(m.group(1).split('.')[0])
+
+    def _py_imports(self, node: Any) -> Set[str]:
+        out: Set[str] = set()
+        if node.type == "import_statement":
+            for child in node.named_children:
+                name = child.child_by_field_name("name") if child.type == "aliased_import" else child
+                if name is not None and name.type == "dotted_name":
+                    out.add(self.text(name).split(".")[0])
             return out
+        module = node.child_by_field_name("module_name")
+        if module is not None and module.type == "relative_import":
+            module = next((c for c in module.named_children if c.type == "dotted_name"), None)
+        if module is not None:
+            out.add(self.text(module).split(".")[0])
+        return out
 
-    def ensure_schema(self):
-        # Attempt to migrate old single-property uniqueness constraints to workspace-scoped composites
-        try:
-            rows = self.run("SHOW CONSTRAINTS")
-            for r in rows:
-                name = r.get("name") or r.get("constraintName")
-                labels = r.get("labelsOrTypes") or []
-                props = r.get("properties") or []
-                ctype = (r.get("type") or r.get("constraintType") or "").upper()
-                if "UNIQUE" in ctype:
-                    if labels == ["File"] and props == ["path"]:
-                        try:
-                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
-                        except Exception:
-                            pass
-                    if labels == ["Class"] and props == ["qualname"]:
-                        try:
-                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
-                        except Exception:
-                            pass
-                    if labels == ["Function"] and props == ["qualname"]:
-                        try:
-                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
-                        except Exception:
-                            pass
-        except Exception:
-            pass
+    def walk(self, node: Any, owner: Optional[ClassInfo]) -> None:
+        spec = self.spec
+        for child in node.named_children:
+            t = child.type
+            if t in spec["classes"]:
+                self.add_class(child, owner)
+            elif t in spec["functions"]:
+                self.add_function(child, child.child_by_field_name("name"), owner)
+            elif t == "variable_declarator" and owner is None:
+                value = child.child_by_field_name("value")
+                if value is not None and value.type in ("arrow_function", "function_expression", "function"):
+                    self.add_function(value, child.child_by_field_name("name"), None, anchor=self.anchor(child.parent))
+            elif t in spec["containers"]:
+                self.walk(child, owner)
 
-        # Workspace-scoped uniqueness
-        self.run("""
-        CREATE CONSTRAINT file_ws_unique IF NOT EXISTS
-        FOR (f:File) REQUIRE (f.path, f.workspaceId) IS UNIQUE
-        """)
-        self.run("""
-        CREATE CONSTRAINT class_ws_unique IF NOT EXISTS
-        FOR (c:Class) REQUIRE (c.qualname, c.workspaceId) IS UNIQUE
-        """)
-        self.run("""
-        CREATE CONSTRAINT func_ws_unique IF NOT EXISTS
-        FOR (f:Function) REQUIRE (f.qualname, f.workspaceId) IS UNIQUE
-        """)
-        self.run("""
-        CREATE CONSTRAINT lib_name_unique IF NOT EXISTS
-        FOR (l:Library) REQUIRE l.name IS UNIQUE
-        """)
-        self.run(textwrap.dedent(f"""
-        CREATE VECTOR INDEX function_embedding IF NOT EXISTS
-        FOR (n:Function) ON (n.embedding)
-        OPTIONS {{ indexConfig: {{ `vector.dimensions`: {self.embedder.dim}, `vector.similarity_function`: 'cosine' }} }}
-        """))
-        self.run(textwrap.dedent(f"""
-        CREATE VECTOR INDEX class_embedding IF NOT EXISTS
-        FOR (n:Class) ON (n.embedding)
-        OPTIONS {{ indexConfig: {{ `vector.dimensions`: {self.embedder.dim}, `vector.similarity_function`: 'cosine' }} }}
-        """))
-        try:
-            self.run("CALL db.awaitIndexes(300)")
-        except Exception:
+    def anchor(self, node: Any) -> Any:
+        parent = node.parent
+        while parent is not None and parent.type in _TS_WRAPPERS:
+            node, parent = parent, parent.parent
+        return node
+
+    def doc(self, node: Any) -> str:
+        """Python docstring, or the comment immediately above the declaration."""
+        if self.grammar == "python":
+            body = node.child_by_field_name("body")
+            first = body.named_children[0] if body is not None and body.named_child_count else None
+            if first is None or first.type != "expression_statement" or not first.named_child_count \
+                    or first.named_children[0].type != "string":
+                return ""
             try:
-                self.run("CALL db.awaitIndexes()")
+                value = ast.literal_eval(self.text(first.named_children[0]))
+            except Exception:
+                return ""
+            return inspect.cleandoc(value) if isinstance(value, str) else ""
+        lines: List[str] = []
+        end = node.start_byte
+        prev = node.prev_named_sibling
+        while prev is not None and prev.type in _TS_COMMENTS and not self.data[prev.end_byte:end].strip():
+            text = self.text(prev).strip()
+            if text.startswith("/*"):
+                if not lines:
+                    return text
+                break
+            lines.append(text)
+            end = prev.start_byte
+            prev = prev.prev_named_sibling
+        return "\n".join(reversed(lines))
+
+    def add_class(self, node: Any, owner: Optional[ClassInfo]) -> None:
+        name = node.child_by_field_name("name")
+        body = node.child_by_field_name("body")
+        if name is None or body is None or (owner is not None and self.grammar == "python"):
+            return
+        class_name = self.text(name)
+        if self.grammar == "python":
+            source = self.from_line_start(node.start_byte, node.end_byte)
+        else:
+            source = self.from_line_start(body.start_byte, body.end_byte)[:2000]
+        ci = ClassInfo(
+            name=class_name,
+            qualname=f"{self.file_qual}.{class_name}",
+            lineno=name.start_point[0] + 1,
+            docstring=self.doc(node if self.grammar == "python" else self.anchor(node)),
+            source=source,
+            file_path=self.rel,
+            end_lineno=node.end_point[0] + 1,
+        )
+        self.fi.classes.append(ci)
+        self.walk(body, ci)
+
+    def add_function(self, node: Any, name: Optional[Any], owner: Optional[ClassInfo],
+                     anchor: Optional[Any] = None) -> None:
+        lang = self.grammar
+        body = node.child_by_field_name("body")
+        if lang == "cpp":
+            decl = node.child_by_field_name("declarator")
+            while decl is not None and decl.type != "function_declarator":
+                decl = decl.child_by_field_name("declarator")
+            name = decl.child_by_field_name("declarator") if decl is not None else None
+        if name is None or body is None:
+            return
+        if owner is None and not self.spec["free_functions"]:
+            return
+        full = re.sub(r"\s+", "", self.text(name))
+        short = full.split("::")[-1]
+        is_ctor = owner is not None and short.lstrip("~") == owner.name
+        if lang == "cpp" and node.child_by_field_name("type") is None and not is_ctor and "::" not in full:
+            # A bare `name(...) {` with no return type is a macro call, not a definition
+            return
+        anchor = anchor if anchor is not None else self.anchor(node)
+        calls: Set[str] = set()
+        if lang == "python":
+            source = self.from_line_start(node.start_byte, node.end_byte)
+            for caps in _ts_matches(self.ts._query(lang, _TS_PY_CALLS), node):
+                dotted = self._py_call_name(caps["fn"])
+                if dotted:
+                    calls.add(dotted)
+        elif lang in ("java", "csharp", "cpp"):
+            sig = self.data[anchor.start_byte:body.start_byte].decode("utf-8", "replace").strip()
+            limit = 1200 if is_ctor else 1500
+            source = (sig + "\n" + self.from_line_start(body.start_byte, body.end_byte)[:limit]).strip()
+        else:
+            source = self.from_line_start(body.start_byte, body.end_byte)
+        if lang != "python":
+            calls = _source_calls(self.from_line_start(body.start_byte, body.end_byte))
+        fun = FunctionInfo(
+            name=short,
+            qualname=f"{owner.qualname if owner else self.file_qual}.{short}",
+            lineno=name.start_point[0] + 1,
+            docstring=self.doc(node if lang == "python" else anchor),
+            source=source,
+            file_path=self.rel,
+            class_name=owner.name if owner else None,
+            calls=calls,
+            end_lineno=node.end_point[0] + 1,
+        )
+        if owner is not None:
+            owner.methods.append(fun)
+        else:
+            self.fi.functions.append(fun)
+
+    def _py_call_name(self, node: Any) -> Optional[str]:
+        parts = []
+        while node.type == "attribute":
+            parts.append(self.text(node.child_by_field_name("attribute")))
+            node = node.child_by_field_name("object")
+        if node.type != "identifier":
+            return None
+        parts.append(self.text(node))
+        return ".".join(reversed(parts))
+
+
+_TREE_SITTER: Optional[TreeSitterParser] = None
+
+
+def _tree_sitter() -> Optional[TreeSitterParser]:
+    global _TREE_SITTER
+    if _TREE_SITTER is None and TreeSitterParser.available():
+        _TREE_SITTER = TreeSitterParser()
+    return _TREE_SITTER
+
+
+# Bump whenever a parser's output changes so persisted parse results are invalidated
+PARSER_VERSION = "5"
+
+_SIMHASH_TOKEN = re.compile(r"\w+|[^\w\s]")
+# Bodies shorter than this are too generic (getters, one-line returns) to call duplicates
+_SIMHASH_MIN_TOKENS = 32
+
+
+def body_simhash(source: str, name: str = "") -> int:
+    """64-bit SimHash over the distinct 3-token shingles of ``source``; 0 when it is too short.
+
+    A renamed copy hashes identically: occurrences of the node's own ``name``
+    are masked. An edited copy drifts further; over functions of more than 15
+    lines, one inserted line moves a median of 4 bits and one replaced line
+    about 5, with a long tail (see benchmarks/bench_near_duplicates.py).
+    """
+    tokens = [("\0" if t == name else t) for t in _SIMHASH_TOKEN.findall(source or "")]
+    if len(tokens) < _SIMHASH_MIN_TOKENS:
+        return 0
+    shingles = {" ".join(tokens[i:i + 3]) for i in range(len(tokens) - 2)}
+    digests = b"".join(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest() for sh in shingles)
+    n = len(shingles)
+    try:
+        import numpy as np  # type: ignore
+    except Exception:
+        np = None  # type: ignore
+    if np is not None:
+        # Column j counts shingles with bit 63-j set (unpackbits is most-significant first)
+        ones = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(n, 8), axis=1).sum(axis=0)
+        counts = ones.tolist()
+    else:
+        counts = [0] * 64
+        for i in range(0, len(digests), 8):
+            h = int.from_bytes(digests[i:i + 8], "big")
+            for j in range(64):
+                counts[j] += (h >> (63 - j)) & 1
+    out = 0
+    for j, c in enumerate(counts):
+        if 2 * c > n:
+            out |= 1 << (63 - j)
+    return out
+
+
+def _add_signatures(fi: FileInfo) -> FileInfo:
+    for fn in fi.functions:
+        fn.simhash = body_simhash(fn.source, fn.name)
+    for c in fi.classes:
+        for m in c.methods:
+            m.simhash = body_simhash(m.source, m.name)
+    return fi
+
+_PARSERS: List[Tuple[Tuple[str, ...], str, Callable[..., FileInfo]]] = [
+    ((".py",), "python", parse_python_file),
+    ((".java",), "java", _parse_java),
+    ((".js",), "javascript", _parse_js_like),
+    ((".ts", ".tsx"), "typescript", _parse_js_like),
+    ((".cs",), "csharp", _parse_csharp),
+    ((".cpp", ".cc", ".cxx", ".hpp", ".hh", ".hxx", ".h"), "cpp", _parse_cpp),
+]
+
+
+def _parser_for(path: str) -> Optional[Tuple[str, Callable[..., FileInfo]]]:
+    for exts, language, fn in _PARSERS:
+        if path.endswith(exts):
+            return language, fn
+    return None
+
+
+def parse_file(path: str, repo_root: str, src: Optional[str] = None) -> FileInfo:
+    """Parse ``path``; pass ``src`` to parse text that is not (or no longer) on disk.
+
+    With ``PARSER_BACKEND=treesitter`` the tree-sitter backend is used when its
+    grammar for the file is installed; the regex parsers remain the fallback.
+    """
+    if PARSER_BACKEND == "treesitter":
+        ts = _tree_sitter()
+        fi = ts.parse(path, repo_root, src) if ts is not None else None
+        if fi is not None:
+            return _add_signatures(fi)
+    entry = _parser_for(path)
+    if entry is None:
+        return FileInfo(path=os.path.relpath(path, repo_root))
+    return _add_signatures(entry[1](path, repo_root, src))
+
+
+def _function_to_dict(fn: FunctionInfo) -> Dict[str, Any]:
+    d = dataclasses.asdict(fn)
+    d["calls"] = sorted(fn.calls)
+    return d
+
+
+def file_info_to_dict(fi: FileInfo) -> Dict[str, Any]:
+    return {
+        "path": fi.path,
+        "language": fi.language,
+        "imports": sorted(fi.imports),
+        "classes": [
+            {**{k: v for k, v in dataclasses.asdict(c).items() if k != "methods"},
+             "methods": [_function_to_dict(m) for m in c.methods]}
+            for c in fi.classes
+        ],
+        "functions": [_function_to_dict(f) for f in fi.functions],
+    }
+
+
+def _function_from_dict(d: Dict[str, Any]) -> FunctionInfo:
+    return FunctionInfo(**{**d, "calls": set(d.get("calls") or [])})
+
+
+def file_info_from_dict(d: Dict[str, Any]) -> FileInfo:
+    return FileInfo(
+        path=d["path"],
+        language=d.get("language", "python"),
+        imports=set(d.get("imports") or []),
+        classes=[
+            ClassInfo(**{**{k: v for k, v in c.items() if k != "methods"},
+                         "methods": [_function_from_dict(m) for m in c.get("methods") or []]})
+            for c in d.get("classes") or []
+        ],
+        functions=[_function_from_dict(f) for f in d.get("functions") or []],
+    )
+
+
+def _rebase_file_info(fi: FileInfo, rel: str) -> FileInfo:
+    """Re-point a parse result at another path (same content, different file)."""
+    if fi.path == rel:
+        return fi
+    old_prefix = fi.path.replace(os.sep, '.')
+    new_prefix = rel.replace(os.sep, '.')
+
+    def requal(q: str) -> str:
+        return new_prefix + q[len(old_prefix):] if q.startswith(old_prefix) else q
+
+    fi.path = rel
+    for c in fi.classes:
+        c.qualname = requal(c.qualname)
+        c.file_path = rel
+        for m in c.methods:
+            m.qualname = requal(m.qualname)
+            m.file_path = rel
+    for f in fi.functions:
+        f.qualname = requal(f.qualname)
+        f.file_path = rel
+    return fi
+
+
+def _changed_line_ranges(old: str, new: str) -> List[Tuple[int, int]]:
+    """1-based, inclusive line ranges of ``new`` that differ from ``old``.
+
+    A pure deletion is reported as the lines on both sides of the removed text,
+    so a node that lost its trailing lines still counts as touched.
+    """
+    ranges: List[Tuple[int, int]] = []
+    sm = difflib.SequenceMatcher(None, old.splitlines(), new.splitlines(), autojunk=False)
+    for tag, _i1, _i2, j1, j2 in sm.get_opcodes():
+        if tag == "equal":
+            continue
+        start = max(j1, 1) if j1 == j2 else j1 + 1
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], j2, j1 + 1))
+        else:
+            ranges.append((start, max(j2, j1 + 1)))
+    return ranges
+
+
+def _span_touched(node: Any, ranges: List[Tuple[int, int]]) -> bool:
+    end = getattr(node, "end_lineno", 0)
+    if not end:
+        # Span unknown (older parser or language without block ends): assume it changed
+        return True
+    # Ranges are sorted and disjoint: only the last one starting at or before `end` can overlap
+    i = bisect.bisect_right(ranges, (end, float("inf")))
+    return i > 0 and ranges[i - 1][1] >= node.lineno
+
+
+@dataclass
+class _GraphPlan:
+    """Graph writes for one parsed file: nodes to upsert (with embeddings once computed) and qualnames to drop."""
+    fi: FileInfo
+    nodes: List[Tuple[str, Any]]
+    gone: List[str]
+    upsert_file: bool = True
+    embs: List[List[float]] = field(default_factory=list)
+    # Near-duplicate group per node (None when it has no signature), set with embs
+    groups: List[Optional[str]] = field(default_factory=list)
+    # Unchanged nodes whose lines shifted: (kind, qualname, lineno, end_lineno) spans to update in place
+    moved: List[Tuple[str, str, int, int]] = field(default_factory=list)
+
+
+def _graph_nodes(fi: FileInfo) -> List[Tuple[str, Any]]:
+    """The (kind, node) pairs ``apply_changes`` writes for a file, pseudo functions included."""
+    nodes: List[Tuple[str, Any]] = [("class", c) for c in fi.classes]
+    nodes += [("function", fn) for fn in fi.functions]
+    # Fallback: if no functions parsed, create pseudo functions from classes for RAG visibility
+    if not fi.functions and fi.classes:
+        for c in fi.classes:
+            nodes.append(("function", FunctionInfo(
+                name=c.name,
+                qualname=c.qualname + ".__class__",
+                lineno=c.lineno,
+                docstring=c.docstring,
+                source=c.source,
+                file_path=fi.path,
+                class_name=None,
+                calls=set(),
+                end_lineno=c.end_lineno,
+                simhash=body_simhash(c.source, c.name),
+            )))
+    return nodes
+
+
+class FileLock:
+    """Exclusive lock shared by threads and by worker processes, held with ``flock`` on ``path``.
+
+    Re-entrant within a thread, so a caller holding a workspace's lock can
+    call service methods that take it again.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking=blocking):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError:
+                self._thread_lock.release()
+                raise
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                self._thread_lock.release()
+                if blocking:
+                    raise
+                return False
+            self._fd = fd
+        self._depth += 1
+        return True
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fd, self._fd = self._fd, None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.release()
+
+
+class ShardedStore:
+    """Base for the on-disk stores: one file per hex digest under ``<root>/<digest[:2]>/``.
+
+    Entries are written to a per-process, per-thread temporary file and renamed
+    into place, so concurrent writers (threads or worker processes) never
+    expose a partial entry. ``_evict_lru`` trims by mtime, which readers
+    refresh on every hit.
+    """
+    suffix = ""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + self.suffix)
+
+    @staticmethod
+    def _replace_atomic(path: str, write: Callable[[str], None]) -> None:
+        """Call ``write`` on a temporary file next to ``path``, then rename it over ``path``."""
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _files(self) -> Iterator[Tuple[str, os.stat_result]]:
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                p = os.path.join(dirpath, fn)
+                try:
+                    yield p, os.stat(p)
+                except OSError:
+                    continue
+
+    def _evict_lru(self, max_bytes: int = 0, max_entries: int = 0) -> int:
+        entries = [(st.st_mtime, st.st_size, p) for p, st in self._files()]
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        if not ((max_bytes and total > max_bytes) or (max_entries and count > max_entries)):
+            return 0
+        # Trim to 90% so eviction is not re-triggered on the next few writes
+        byte_target = int(max_bytes * 0.9) if max_bytes else total
+        count_target = int(max_entries * 0.9) if max_entries else count
+        removed = 0
+        for _, size, p in sorted(entries):
+            if total <= byte_target and count <= count_target:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+            count -= 1
+            removed += 1
+        return removed
+
+
+class ParseCache(ShardedStore):
+    """On-disk cache of parse results keyed by content hash, parser version, backend and language.
+
+    One gzip'd JSON file per entry. When the store grows past ``max_bytes``
+    the least recently used entries are removed.
+    """
+    suffix = ".json.gz"
+
+    def __init__(self, root: str, max_bytes: int = 256 * 1024 * 1024, check_every: int = 200):
+        super().__init__(root)
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._writes = 0
+
+    @staticmethod
+    def key(content_hash: str, language: str) -> str:
+        return hashlib.sha256(f"{PARSER_VERSION}:{PARSER_BACKEND}:{language}:{content_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, content_hash: str, language: str, rel: str) -> Optional[FileInfo]:
+        p = self._path(self.key(content_hash, language))
+        try:
+            with gzip.open(p, "rt", encoding="utf-8") as f:
+                fi = file_info_from_dict(json.load(f))
+            os.utime(p, None)
+        except Exception:
+            return None
+        return _rebase_file_info(fi, rel)
+
+    def put(self, content_hash: str, language: str, fi: FileInfo) -> None:
+        def write(tmp: str) -> None:
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as f:
+                json.dump(file_info_to_dict(fi), f, separators=(",", ":"))
+
+        try:
+            self._replace_atomic(self._path(self.key(content_hash, language)), write)
+        except Exception:
+            return
+        self._writes += 1
+        if self._writes % self.check_every == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        return self._evict_lru(max_bytes=self.max_bytes)
+
+
+class SourceStore(ShardedStore):
+    """Content-addressed store for class/function source text kept out of the graph.
+
+    Graph nodes carry only ``source_hash`` and their span; the text lives here,
+    one file per SHA-256, written once. Over ``max_bytes`` the least recently
+    read entries are removed; readers fall back to the node's span in the
+    workspace mirror.
+    """
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024, check_every: int = 1000):
+        super().__init__(root)
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._writes = 0
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def put(self, text: str) -> str:
+        digest = self.digest(text)
+        p = self._path(digest)
+        if os.path.exists(p):
+            return digest
+
+        def write(tmp: str) -> None:
+            with open(tmp, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+
+        try:
+            self._replace_atomic(p, write)
+        except OSError:
+            return digest
+        self._writes += 1
+        if self.max_bytes and self._writes % self.check_every == 0:
+            self.evict()
+        return digest
+
+    def get_many(self, digests: Iterable[str]) -> Dict[str, str]:
+        out: Dict[str, str] = {}
+        for digest in set(d for d in digests if d):
+            p = self._path(digest)
+            try:
+                with open(p, "r", encoding="utf-8", newline="") as f:
+                    out[digest] = f.read()
+                os.utime(p, None)
+            except OSError:
+                continue
+        return out
+
+    def evict(self) -> int:
+        return self._evict_lru(max_bytes=self.max_bytes)
+
+
+# Never parsed: vendored/venv/build trees and well-known generated or minified files
+_DEFAULT_IGNORE_PATTERNS = [
+    "node_modules/", ".git/", ".venv/", "venv/", "env/", "ENV/", "Lib/", "lib/", "site-packages/",
+    "dist/", "build/", "out/", "__pycache__/", ".python_packages/",
+    "*.min.js", "*.min.css", "*.bundle.js", "*.map", "*_pb2.py", "*_pb2_grpc.py", "*.pb.h", "*.pb.cc",
+    "*.g.cs", "*.g.i.cs", "*.designer.cs", "*.Designer.cs", "*.generated.*",
+]
+_BINARY_CHARS = re.compile(r"[\x01-\x08\x0e-\x1f\ufffd]")
+_GENERATED_MARKER = re.compile(r"@generated|<auto-generated|Code generated .{0,80}DO NOT EDIT|"
+                               r"[Aa]uto-?generated (?:file|code)|Generated by the protocol buffer compiler")
+
+
+def _gitignore_regex(pattern: str) -> Optional[str]:
+    """Translate one .gitignore line into a regex over '/'-separated relative paths."""
+    pattern = pattern.strip()
+    if not pattern or pattern.startswith("#"):
+        return None
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    # A slash anywhere but at the end anchors the pattern to the workspace root
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if ch == "*":
+            out.append("[^/]*")
+        elif ch == "?":
+            out.append("[^/]")
+        elif ch == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                out.append(re.escape(ch))
+            else:
+                body = pattern[i + 1:j]
+                out.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+                i = j
+        else:
+            out.append(re.escape(ch))
+        i += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    # A directory pattern matches everything below it; a plain one the path itself or below it
+    suffix = "/.*" if dir_only else "(?:/.*)?"
+    return prefix + "".join(out) + suffix
+
+
+class AdmissionFilter:
+    """Cheap checks run before a mirrored file is parsed.
+
+    Paths are matched against .gitignore-style patterns compiled into one
+    regex; content is rejected when it is too large, binary (NUL bytes or high
+    byte entropy), minified (very long lines) or marked as generated. Each
+    check returns the skip reason, or None to admit the file.
+    """
+    def __init__(self, patterns: List[str], max_bytes: int = 1024 * 1024, max_line_length: int = 5000,
+                 max_avg_line_length: int = 300, max_entropy: float = 6.0, sample_bytes: int = 64 * 1024):
+        self.patterns = list(patterns)
+        self.max_bytes = max_bytes
+        self.max_line_length = max_line_length
+        self.max_avg_line_length = max_avg_line_length
+        self.max_entropy = max_entropy
+        self.sample_bytes = sample_bytes
+        include: List[str] = []
+        exclude: List[str] = []
+        for p in self.patterns:
+            negate = p.strip().startswith("!")
+            rx = _gitignore_regex(p.strip()[1:] if negate else p)
+            if rx is not None:
+                (exclude if negate else include).append(rx)
+        self._ignore = re.compile("^(?:" + "|".join(include) + ")$") if include else None
+        self._unignore = re.compile("^(?:" + "|".join(exclude) + ")$") if exclude else None
+
+    @staticmethod
+    def _has_long_line(text: str, limit: int) -> bool:
+        # One pass over the newlines, stopping at the first line of ``limit`` or more characters
+        start = 0
+        while True:
+            end = text.find("\n", start)
+            if end < 0:
+                return len(text) - start >= limit
+            if end - start >= limit:
+                return True
+            start = end + 1
+
+    def with_patterns(self, extra: List[str]) -> "AdmissionFilter":
+        if not extra:
+            return self
+        return AdmissionFilter(self.patterns + list(extra), self.max_bytes, self.max_line_length,
+                               self.max_avg_line_length, self.max_entropy, self.sample_bytes)
+
+    def path_reason(self, rel: str) -> Optional[str]:
+        if self._ignore is not None and self._ignore.match(rel):
+            if self._unignore is None or not self._unignore.match(rel):
+                return "ignored"
+        return None
+
+    def content_reason(self, text: str) -> Optional[str]:
+        if self.max_bytes and len(text) > self.max_bytes:
+            return "size"
+        sample = text[:self.sample_bytes]
+        if "\x00" in sample or len(_BINARY_CHARS.findall(sample)) > len(sample) // 20:
+            return "binary"
+        # Only ASCII is judged by entropy: encoded blobs are ASCII, while UTF-8 prose in
+        # comments legitimately spreads over many byte values
+        if self.max_entropy and sample.isascii() and self._entropy(sample) > self.max_entropy:
+            return "binary"
+        if sample and self.max_avg_line_length and len(sample) / (sample.count("\n") + 1) > self.max_avg_line_length:
+            return "minified"
+        if self.max_line_length and self._has_long_line(text, max(int(self.max_line_length), 1)):
+            return "minified"
+        if _GENERATED_MARKER.search(sample, 0, 2048):
+            return "generated"
+        return None
+
+    @staticmethod
+    def _entropy(sample: str) -> float:
+        data = sample.encode("utf-8", "replace")
+        n = len(data)
+        return -sum(c / n * math.log2(c / n) for c in Counter(data).values())
+
+
+EMBEDDING_STORAGE_MODES = ("float64", "float32", "float16", "int8")
+
+
+def encode_vector(vec: List[float], storage: str = "float64") -> Any:
+    """Cache form of ``vec``: a JSON list for float64, otherwise ``"<mode>:<base64>"``.
+
+    int8 is symmetric scalar quantization with a per-vector scale,
+    ``"int8:<scale>:<base64>"``; values are ``round(x / scale)`` in [-127, 127].
+    """
+    n = len(vec)
+    try:
+        if storage == "float32":
+            return "float32:" + base64.b64encode(struct.pack(f"<{n}f", *vec)).decode("ascii")
+        if storage == "float16":
+            return "float16:" + base64.b64encode(struct.pack(f"<{n}e", *vec)).decode("ascii")
+        if storage == "int8":
+            scale = max((abs(x) for x in vec), default=0.0) / 127.0 or 1.0
+            q = [max(-127, min(127, round(x / scale))) for x in vec]
+            return f"int8:{scale!r}:" + base64.b64encode(struct.pack(f"<{n}b", *q)).decode("ascii")
+    except (OverflowError, struct.error):
+        # float16 cannot hold the value; keep it exact rather than corrupt it
+        pass
+    return [float(x) for x in vec]
+
+
+def decode_vector(value: Any) -> Optional[List[float]]:
+    if isinstance(value, list):
+        return [float(x) for x in value]
+    if not isinstance(value, str):
+        return None
+    mode, _, rest = value.partition(":")
+    try:
+        if mode == "int8":
+            scale_text, _, payload = rest.partition(":")
+            scale = float(scale_text)
+            raw = base64.b64decode(payload)
+            return [q * scale for q in struct.unpack(f"<{len(raw)}b", raw)]
+        raw = base64.b64decode(rest)
+        if mode == "float32":
+            return list(struct.unpack(f"<{len(raw) // 4}f", raw))
+        if mode == "float16":
+            return list(struct.unpack(f"<{len(raw) // 2}e", raw))
+    except (ValueError, struct.error):
+        return None
+    return None
+
+
+def _normalized(vec: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vec))
+    return [x / norm for x in vec] if norm > 0 else list(vec)
+
+
+class DimensionReducer:
+    """Maps model vectors to ``dims`` dimensions, renormalized for cosine search.
+
+    ``truncate`` keeps the leading dimensions (Matryoshka-style; exact for
+    models trained that way, such as text-embedding-3). ``pca`` projects onto
+    components fitted offline with ``fit_pca`` and saved as JSON
+    (``{"mean": [...], "components": [[...], ...]}``).
+    """
+    def __init__(self, dims: int, method: str = "truncate", pca_path: Optional[str] = None):
+        self.dims = dims
+        self.method = method
+        self.mean: Optional[List[float]] = None
+        self.components: Optional[List[List[float]]] = None
+        if method == "pca":
+            if not pca_path or not os.path.exists(pca_path):
+                raise RuntimeError(f"embeddings.reduction is 'pca' but no PCA file at {pca_path!r}")
+            with open(pca_path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+            self.mean = [float(x) for x in obj["mean"]]
+            self.components = [[float(x) for x in row] for row in obj["components"][:dims]]
+            if len(self.components) < dims:
+                raise RuntimeError(f"PCA file has {len(self.components)} components, {dims} configured")
+        elif method != "truncate":
+            raise ValueError("embeddings.reduction must be 'truncate' or 'pca'")
+
+    def reduce(self, vecs: List[List[float]]) -> List[List[float]]:
+        if self.method == "truncate":
+            return [_normalized(list(v[:self.dims])) for v in vecs]
+        try:
+            import numpy as np  # type: ignore
+        except Exception:
+            np = None  # type: ignore
+        if np is not None:
+            proj = (np.asarray(vecs, dtype=np.float64) - np.asarray(self.mean)) @ np.asarray(self.components).T
+            return [_normalized(row) for row in proj.tolist()]
+        out = []
+        for v in vecs:
+            centered = [x - m for x, m in zip(v, self.mean)]
+            out.append(_normalized([sum(c * x for c, x in zip(row, centered)) for row in self.components]))
+        return out
+
+
+def fit_pca(vecs: List[List[float]], dims: int) -> Dict[str, Any]:
+    """Top ``dims`` principal components of ``vecs`` (needs numpy), in DimensionReducer's file format."""
+    import numpy as np  # type: ignore
+    x = np.asarray(vecs, dtype=np.float64)
+    mean = x.mean(axis=0)
+    _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+    return {"mean": mean.tolist(), "components": vt[:dims].tolist()}
+
+
+ONNX_MODEL_REPO = "Xenova/all-MiniLM-L6-v2"
+_ONNX_SUB_BATCH = 32
+
+
+class OnnxEncoder:
+    """all-MiniLM-L6-v2 exported to ONNX and int8-quantized, run on ONNX Runtime's CPU provider.
+
+    ``model_dir`` holds ``tokenizer.json`` and ``model_quantized.onnx`` (also
+    looked for under ``onnx/``); a bare ``model.onnx`` is quantized once with
+    dynamic int8 weights. With no directory the files are fetched from
+    ``ONNX_MODEL_REPO`` through huggingface_hub. Token states are mean-pooled
+    over the attention mask and L2-normalized, as SentenceTransformer does for
+    this model, so vectors stay 384-d.
+    """
+    def __init__(self, model_dir: Optional[str] = None, threads: int = 0, max_length: int = 256):
+        try:
+            import numpy as np  # type: ignore
+            import onnxruntime as ort  # type: ignore
+            from tokenizers import Tokenizer  # type: ignore
+        except Exception:
+            raise RuntimeError("onnxruntime, tokenizers and numpy are required for EMBEDDING_BACKEND=onnx")
+        self._np = np
+        if not model_dir:
+            try:
+                from huggingface_hub import snapshot_download  # type: ignore
+            except Exception:
+                raise RuntimeError("set embeddings.onnx_model_dir or install huggingface_hub to download the model")
+            model_dir = snapshot_download(ONNX_MODEL_REPO, allow_patterns=["tokenizer.json", "onnx/model_quantized.onnx"])
+        self.model_path = self._quantized_model(model_dir)
+        tok_path = next((p for p in (os.path.join(model_dir, "tokenizer.json"),
+                                     os.path.join(model_dir, "onnx", "tokenizer.json")) if os.path.exists(p)), None)
+        if tok_path is None:
+            raise RuntimeError(f"no tokenizer.json in {model_dir}")
+        self.tokenizer = Tokenizer.from_file(tok_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.no_padding()
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        opts.inter_op_num_threads = 1
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.model_path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self.session.get_inputs()}
+
+    @staticmethod
+    def _quantized_model(model_dir: str) -> str:
+        for sub in ("", "onnx"):
+            path = os.path.join(model_dir, sub, "model_quantized.onnx")
+            if os.path.exists(path):
+                return path
+        for sub in ("", "onnx"):
+            src = os.path.join(model_dir, sub, "model.onnx")
+            if os.path.exists(src):
+                from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+                dst = os.path.join(model_dir, sub, "model_quantized.onnx")
+                tmp = dst + f".tmp{os.getpid()}"
+                quantize_dynamic(src, tmp, weight_type=QuantType.QInt8)
+                os.replace(tmp, dst)
+                return dst
+        raise RuntimeError(f"no model_quantized.onnx or model.onnx in {model_dir}")
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        np = self._np
+        encs = self.tokenizer.encode_batch(texts)
+        # Similar lengths share a sub-batch, so little compute goes to padding
+        order = sorted(range(len(encs)), key=lambda i: len(encs[i].ids))
+        out: List[Optional[List[float]]] = [None] * len(encs)
+        for start in range(0, len(order), _ONNX_SUB_BATCH):
+            idx = order[start:start + _ONNX_SUB_BATCH]
+            width = max(len(encs[i].ids) for i in idx)
+            ids = np.zeros((len(idx), width), dtype=np.int64)
+            mask = np.zeros((len(idx), width), dtype=np.int64)
+            types = np.zeros((len(idx), width), dtype=np.int64)
+            for row, i in enumerate(idx):
+                n = len(encs[i].ids)
+                ids[row, :n] = encs[i].ids
+                mask[row, :n] = 1
+                types[row, :n] = encs[i].type_ids
+            feed = {"input_ids": ids, "attention_mask": mask, "token_type_ids": types}
+            hidden = self.session.run(None, {k: v for k, v in feed.items() if k in self._inputs})[0]
+            if hidden.ndim == 3:
+                m = mask[:, :, None].astype(hidden.dtype)
+                hidden = (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+            hidden = hidden / np.clip(np.linalg.norm(hidden, axis=1, keepdims=True), 1e-12, None)
+            for row, i in enumerate(idx):
+                out[i] = hidden[row].astype(np.float64).tolist()
+        return out  # type: ignore[return-value]
+
+
+_OPENAI_RETRY_STATUS = {408, 409, 429}
+
+
+class OpenAIEmbeddingClient:
+    """Embeddings over one pooled OpenAI client, shared by every call.
+
+    Inputs are split into requests of at most ``max_inputs`` texts and
+    ``max_request_tokens`` tokens (each text clipped to ``max_input_tokens``),
+    which run at most ``concurrency`` at a time across all callers. Connection
+    errors, timeouts, 408/409/429 and 5xx responses are retried with
+    exponential backoff and jitter, honouring ``Retry-After``; anything else,
+    or running out of retries, raises EmbeddingError. ``base_url`` (or
+    ``OPENAI_BASE_URL``) can point the client at a local stub server.
+    """
+    def __init__(self, model: str, base_url: Optional[str] = None, concurrency: int = 4, max_retries: int = 5,
+                 timeout: float = 60.0, max_inputs: int = 2048, max_request_tokens: int = 300000,
+                 max_input_tokens: int = 8191, backoff_base: float = 0.5, backoff_cap: float = 30.0):
+        import httpx  # type: ignore
+        from openai import OpenAI  # type: ignore
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.max_inputs = max(1, max_inputs)
+        self.max_request_tokens = max_request_tokens
+        self.max_input_tokens = max_input_tokens
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        # Retries are ours (they see Retry-After and the shared concurrency bound), so the SDK's are off
+        self.client = OpenAI(base_url=base_url or None, timeout=timeout, max_retries=0,
+                             http_client=httpx.Client(limits=limits, timeout=timeout))
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="openai-embed")
+        try:
+            import tiktoken  # type: ignore
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            self._encoding = None
+
+    def _clip(self, text: str) -> Tuple[str, int]:
+        """``text`` cut to the per-input token limit, and its token count."""
+        if not text:
+            # The API rejects empty strings
+            return " ", 1
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) > self.max_input_tokens:
+                return self._encoding.decode(tokens[:self.max_input_tokens]), self.max_input_tokens
+            return text, len(tokens)
+        # Without tiktoken, assume a token per 3 characters (code tokenizes denser than prose)
+        if len(text) > self.max_input_tokens * 3:
+            text = text[:self.max_input_tokens * 3]
+        return text, len(text) // 3 + 1
+
+    def _requests(self, texts: List[str]) -> List[List[str]]:
+        out: List[List[str]] = []
+        cur: List[str] = []
+        cur_tokens = 0
+        for text in texts:
+            clipped, n = self._clip(text)
+            if cur and (len(cur) >= self.max_inputs or cur_tokens + n > self.max_request_tokens):
+                out.append(cur)
+                cur, cur_tokens = [], 0
+            cur.append(clipped)
+            cur_tokens += n
+        if cur:
+            out.append(cur)
+        return out
+
+    def _retry_delay(self, attempt: int, error: Exception) -> Optional[float]:
+        """Seconds to wait before retrying ``error``, or None when it is not transient."""
+        import openai  # type: ignore
+        if isinstance(error, openai.APIStatusError):
+            if error.status_code not in _OPENAI_RETRY_STATUS and error.status_code < 500:
+                return None
+            headers = getattr(error.response, "headers", None) or {}
+            for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+                try:
+                    return min(self.backoff_cap, float(headers.get(name)) * scale)
+                except (TypeError, ValueError):
+                    pass
+        elif not isinstance(error, openai.APIConnectionError):
+            return None
+        return min(self.backoff_cap, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    def _create(self, texts: List[str], dimensions: Optional[int]) -> List[List[float]]:
+        extra = {"dimensions": dimensions} if dimensions else {}
+        attempt = 0
+        while True:
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=texts, **extra)
+                data = sorted(resp.data, key=lambda d: d.index)
+                if len(data) != len(texts):
+                    raise EmbeddingError(f"OpenAI returned {len(data)} embeddings for {len(texts)} inputs")
+                return [list(d.embedding) for d in data]
+            except EmbeddingError:
+                raise
+            except Exception as e:
+                delay = self._retry_delay(attempt, e) if attempt < self.max_retries else None
+                if delay is None:
+                    raise EmbeddingError(f"OpenAI embeddings failed after {attempt + 1} attempt(s): {e}") from e
+                attempt += 1
+                time.sleep(delay)
+
+    def embed(self, texts: List[str], dimensions: Optional[int] = None) -> List[List[float]]:
+        if not texts:
+            return []
+        futures = [self._pool.submit(self._create, chunk, dimensions) for chunk in self._requests(texts)]
+        out: List[List[float]] = []
+        for fut in futures:
+            out.extend(fut.result())
+        return out
+
+
+class Embedder:
+    """Embeds texts with the configured backend.
+
+    ``load=False`` builds only the dimension/cache-key description, for a
+    process whose embedding runs elsewhere (see EmbeddingService).
+    """
+    def __init__(self, dimensions: int = 0, reduction: str = "truncate", pca_path: Optional[str] = None,
+                 backend: Optional[str] = None, onnx_model_dir: Optional[str] = None, onnx_threads: int = 0,
+                 openai_options: Optional[Dict[str, Any]] = None, load: bool = True):
+        self.backend = backend or EMBEDDING_BACKEND
+        if self.backend == "local":
+            if load:
+                try:
+                    from sentence_transformers import SentenceTransformer  # type: ignore
+                except Exception:
+                    raise RuntimeError("sentence-transformers not installed; install or set EMBEDDING_BACKEND=onnx/openai")
+                self.model = SentenceTransformer("all-MiniLM-L6-v2")
+            self.dim = 384
+        elif self.backend == "onnx":
+            if load:
+                self.model = OnnxEncoder(onnx_model_dir, threads=onnx_threads)
+            self.dim = 384
+        elif self.backend == "openai":
+            # Lazy import: only require openai package if OpenAI backend is selected,
+            # so the server can run with local embeddings without this dependency.
+            self.model_name = "text-embedding-3-small"
+            if load:
+                try:
+                    import openai  # type: ignore  # noqa: F401
+                except Exception as e:
+                    raise RuntimeError("openai package not installed")
+                if not os.getenv("OPENAI_API_KEY"):
+                    raise RuntimeError("OPENAI_API_KEY not set")
+                self.client = OpenAIEmbeddingClient(self.model_name, **(openai_options or {}))
+            self.dim = 1536
+        else:
+            raise ValueError("EMBEDDING_BACKEND must be 'local', 'onnx' or 'openai'")
+        self.model_dim = self.dim
+        self.reducer: Optional[DimensionReducer] = None
+        if dimensions and dimensions < self.model_dim:
+            self.reducer = DimensionReducer(dimensions, reduction, pca_path)
+            self.dim = dimensions
+
+    def _model_id(self) -> str:
+        if self.backend == "local":
+            return "all-MiniLM-L6-v2"
+        if self.backend == "onnx":
+            # Same model and 384 dims; int8 weights shift vectors slightly, so they are cached apart
+            return "all-MiniLM-L6-v2-int8"
+        return getattr(self, "model_name", "unknown")
+
+    def cache_key_for_text(self, text: str) -> str:
+        h = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        dim = self.dim if self.reducer is None or self.reducer.method == "truncate" else f"pca{self.dim}"
+        return f"{self.backend}:{self._model_id()}:{dim}:{h}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if self.backend == "local":
+            vecs = self.model.encode(texts, show_progress_bar=False, normalize_embeddings=True).tolist()
+        elif self.backend == "onnx":
+            vecs = self.model.encode(texts)
+        else:
+            if self.reducer is not None and self.reducer.method == "truncate":
+                # text-embedding-3 models shorten server-side (Matryoshka), so fewer bytes come back
+                return self.client.embed(texts, dimensions=self.dim)
+            vecs = self.client.embed(texts)
+        return self.reducer.reduce(vecs) if self.reducer is not None else vecs
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed, texts)
+
+
+def _embedding_worker(idx: int, kwargs: Dict[str, Any], requests, results) -> None:
+    """Worker process loop: embeds each text list it is sent until it receives None."""
+    try:
+        embedder = Embedder(**kwargs)
+    except Exception as e:
+        results.put((idx, "failed", f"{type(e).__name__}: {e}"))
+        return
+    results.put((idx, "ready", embedder.dim))
+    while True:
+        texts = requests.get()
+        if texts is None:
+            return
+        try:
+            results.put((idx, "ok", embedder.embed(texts)))
+        except Exception as e:
+            results.put((idx, "error", f"{type(e).__name__}: {e}"))
+
+
+class EmbeddingService:
+    """Embedding in worker processes, with concurrent requests coalesced into batches.
+
+    ``submit`` returns a Future. A dispatcher thread waits for an idle worker,
+    then drains queued requests (lingering up to ``window_ms`` when more than
+    one is waiting, until ``max_batch`` texts) and sends them as one batch; the
+    vectors are split back per request. Bulk requests (sync) are only taken when no interactive one
+    (queries) is waiting, so a large sync does not queue ahead of RAG users.
+    A worker that dies fails its batch and is restarted.
+    """
+    def __init__(self, embedder_kwargs: Dict[str, Any], workers: int = 1, max_batch: int = 64,
+                 window_ms: float = 5.0, start_timeout: float = 600.0):
+        # spawn, not fork: the parent has driver/pool threads that a forked child would inherit mid-state
+        self._ctx = multiprocessing.get_context("spawn")
+        self._kwargs = dict(embedder_kwargs)
+        self.spec = Embedder(**self._kwargs, load=False)
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._interactive: "queue.Queue[Tuple[List[str], Any]]" = queue.Queue()
+        self._bulk: "queue.Queue[Tuple[List[str], Any]]" = queue.Queue()
+        self._wakeup = threading.Condition()
+        self._free: "queue.Queue[int]" = queue.Queue()
+        self._results = self._ctx.Queue()
+        self._procs: List[Any] = [None] * max(1, workers)
+        self._requests: List[Any] = [None] * len(self._procs)
+        self._busy: Dict[int, List[Tuple[Any, int]]] = {}
+        self._busy_lock = threading.Lock()
+        self._closed = False
+        self._failure: Optional[str] = None
+        for idx in range(len(self._procs)):
+            self._start_worker(idx)
+        deadline = time.monotonic() + start_timeout
+        for _ in self._procs:
+            try:
+                idx, kind, payload = self._results.get(timeout=max(0.1, deadline - time.monotonic()))
+            except queue.Empty:
+                self.close()
+                raise RuntimeError("embedding workers did not start in time")
+            if kind != "ready":
+                self.close()
+                raise RuntimeError(f"embedding worker failed to start: {payload}")
+            self._free.put(idx)
+        self._threads = [
+            threading.Thread(target=self._dispatch, name="embedding-dispatch", daemon=True),
+            threading.Thread(target=self._collect, name="embedding-collect", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def dim(self) -> int:
+        return self.spec.dim
+
+    def _start_worker(self, idx: int) -> None:
+        self._requests[idx] = self._ctx.Queue()
+        proc = self._ctx.Process(target=_embedding_worker, args=(idx, self._kwargs, self._requests[idx], self._results),
+                                 name=f"embedding-worker-{idx}", daemon=True)
+        proc.start()
+        self._procs[idx] = proc
+
+    def client(self, bulk: bool = False) -> "EmbeddingClient":
+        return EmbeddingClient(self, bulk)
+
+    def submit(self, texts: List[str], bulk: bool = False):
+        fut: "Future[List[List[float]]]" = Future()
+        if self._closed or self._failure:
+            fut.set_exception(RuntimeError(self._failure or "embedding service is closed"))
+            return fut
+        if not texts:
+            fut.set_result([])
+            return fut
+        (self._bulk if bulk else self._interactive).put((list(texts), fut))
+        with self._wakeup:
+            self._wakeup.notify()
+        return fut
+
+    def _take(self, timeout: Optional[float], queues: Tuple[Any, ...]) -> Optional[Tuple[List[str], Any, Any]]:
+        # Earlier queues first; wait (up to timeout) only when all are empty
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._wakeup:
+            while True:
+                for q in queues:
+                    try:
+                        return q.get_nowait() + (q,)
+                    except queue.Empty:
+                        pass
+                if self._closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._wakeup.wait(remaining)
+
+    def _dispatch(self) -> None:
+        while not self._closed:
+            idx = self._free.get()
+            if idx < 0:
+                return
+            with self._busy_lock:
+                # A token for a worker that died while idle, or a duplicate after its restart
+                if idx in self._busy or not self._procs[idx].is_alive():
+                    continue
+            first = self._take(None, (self._interactive, self._bulk))
+            if first is None:
+                return
+            # Batches hold one kind, so a query never waits on a sync-sized batch it joined
+            source = first[2]
+            batch = [first[:2]]
+            count = len(first[0])
+            stop = time.monotonic() + self.window
+            while count < self.max_batch:
+                # Linger for the window only once a second request shows there is concurrency,
+                # so a lone query is not delayed
+                nxt = self._take(stop - time.monotonic() if len(batch) > 1 else 0, (source,))
+                if nxt is None:
+                    break
+                batch.append(nxt[:2])
+                count += len(nxt[0])
+            # Requests already cancelled by their caller (timed out) are dropped here
+            live = [(texts, fut) for texts, fut in batch if fut.set_running_or_notify_cancel()]
+            if not live:
+                self._free.put(idx)
+                continue
+            with self._busy_lock:
+                self._busy[idx] = [(fut, len(texts)) for texts, fut in live]
+            self._requests[idx].put([t for texts, _ in live for t in texts])
+
+    def _collect(self) -> None:
+        while not self._closed:
+            try:
+                idx, kind, payload = self._results.get(timeout=0.5)
+            except queue.Empty:
+                self._reap()
+                continue
+            except (EOFError, OSError):
+                return
+            if kind == "ready":
+                self._free.put(idx)
+                continue
+            if kind == "failed":
+                # A restarted worker could not rebuild its model; fail fast instead of queueing forever
+                self._failure = f"embedding worker failed to restart: {payload}"
+                self._fail_queued(self._failure)
+                continue
+            with self._busy_lock:
+                parts = self._busy.pop(idx, [])
+            self._free.put(idx)
+            offset = 0
+            for fut, n in parts:
+                if kind == "ok":
+                    fut.set_result(payload[offset:offset + n])
+                else:
+                    fut.set_exception(RuntimeError(f"embedding failed: {payload}"))
+                offset += n
+
+    def _reap(self) -> None:
+        for idx, proc in enumerate(self._procs):
+            if self._closed or proc is None or proc.is_alive():
+                continue
+            with self._busy_lock:
+                parts = self._busy.pop(idx, [])
+            for fut, _ in parts:
+                fut.set_exception(RuntimeError(f"embedding worker exited with code {proc.exitcode}"))
+            self._start_worker(idx)
+
+    def _fail_queued(self, message: str) -> None:
+        for q in (self._interactive, self._bulk):
+            while True:
+                try:
+                    _, fut = q.get_nowait()
+                except queue.Empty:
+                    break
+                if fut.set_running_or_notify_cancel():
+                    fut.set_exception(RuntimeError(message))
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        self._free.put(-1)
+        self._fail_queued("embedding service is closed")
+        with self._busy_lock:
+            parts = [p for ps in self._busy.values() for p in ps]
+            self._busy.clear()
+        for fut, _ in parts:
+            fut.set_exception(RuntimeError("embedding service is closed"))
+        for req in self._requests:
+            if req is not None:
+                req.put(None)
+        for proc in self._procs:
+            if proc is not None:
+                proc.join(timeout)
+                if proc.is_alive():
+                    proc.terminate()
+
+
+class EmbeddingClient:
+    """Embedder-shaped view of an EmbeddingService, for code that calls ``embed``."""
+    def __init__(self, service: EmbeddingService, bulk: bool = False):
+        self.service = service
+        self.bulk = bulk
+        self.backend = service.spec.backend
+        self.dim = service.spec.dim
+        self.model_dim = service.spec.model_dim
+        self.reducer = service.spec.reducer
+
+    def cache_key_for_text(self, text: str) -> str:
+        return self.service.spec.cache_key_for_text(text)
+
+    def submit(self, texts: List[str]):
+        return self.service.submit(texts, bulk=self.bulk)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self.submit(texts).result()
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.wrap_future(self.submit(texts))
+
+
+class GraphRAGEmbedderAdapter:
+    def __init__(self, base_embedder: Embedder, known: Optional[Dict[str, List[float]]] = None):
+        self._base = base_embedder
+        # Query vectors already computed upstream, so retrieval does not embed twice
+        self._known = known or {}
+
+    def embed_query(self, text: str):
+        if text in self._known:
+            return self._known[text]
+        return self._base.embed([text])[0]
+
+
+# Written against neo4j-graphrag 1.0.0 (requirements.txt), whose get_search_results takes
+# (query_vector, query_text, top_k, filters); any version without a top_k parameter falls
+# back to the plain VectorRetriever
+_VECTOR_SEARCH_SIGNATURE = (inspect.signature(VectorRetriever.get_search_results)
+                            if VectorRetriever is not None else None)
+
+if _VECTOR_SEARCH_SIGNATURE is not None and "top_k" in _VECTOR_SEARCH_SIGNATURE.parameters:
+    class DedupVectorRetriever(VectorRetriever):  # type: ignore[misc, valid-type]
+        """VectorRetriever that keeps only the best hit per near-duplicate group (``dup_group``)."""
+        def get_search_results(self, *args: Any, **kwargs: Any):
+            # Bound through the parent's signature, so top_k is found however it was passed
+            bound = _VECTOR_SEARCH_SIGNATURE.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            top_k = bound.arguments["top_k"]
+            bound.arguments["top_k"] = top_k * _DUP_OVERFETCH
+            raw = super().get_search_results(*bound.args[1:], **bound.kwargs)
+            seen: Set[str] = set()
+            records = []
+            for record in raw.records:
+                node = record.get("node") or {}
+                group = (node.get("dup_group") if isinstance(node, dict) else None) or record.get("id")
+                if group is not None and group in seen:
+                    continue
+                seen.add(group)
+                records.append(record)
+            raw.records = records[:top_k]
+            return raw
+else:
+    DedupVectorRetriever = None  # type: ignore
+
+
+class EmbeddingCache(ShardedStore):
+    """On-disk cache for embeddings, keyed by model+text hash and shared by all worker processes.
+
+    One file per entry, named by the SHA-256 of the key, so no worker has to
+    hold the whole cache in memory. Past ``max_entries`` the least recently
+    used entries are removed.
+
+    Vectors are held and persisted in ``storage`` precision (see encode_vector);
+    entries written under another mode are still readable. A single-file JSON
+    cache at ``legacy_path`` is imported once and then removed.
+    """
+    def __init__(self, root: str, max_entries: int = 200000, check_every: int = 1000,
+                 storage: str = "float64", legacy_path: Optional[str] = None):
+        if storage not in EMBEDDING_STORAGE_MODES:
+            raise ValueError(f"embedding storage must be one of {EMBEDDING_STORAGE_MODES}")
+        super().__init__(root)
+        self.max_entries = max_entries
+        self.check_every = check_every
+        self.storage = storage
+        self._writes = 0
+        if legacy_path and os.path.exists(legacy_path):
+            self._import(legacy_path)
+
+    def _path(self, key: str) -> str:
+        return super()._path(hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _import(self, legacy_path: str) -> None:
+        # Every worker starts with the same legacy file; the first to get the lock imports it
+        with FileLock(self.root + ".lock"):
+            try:
+                with open(legacy_path, "r", encoding="utf-8") as f:
+                    obj = json.load(f)
+            except FileNotFoundError:
+                return
+            except Exception:
+                obj = {}
+            if isinstance(obj, dict):
+                for k, v in obj.items():
+                    if isinstance(v, (list, str)):
+                        # Plain float lists (older caches) are re-encoded in the configured precision
+                        self._write(k, v if isinstance(v, str) else encode_vector(list(map(float, v)), self.storage))
+            try:
+                os.remove(legacy_path)
+            except OSError:
+                pass
+
+    def _write(self, key: str, value: Any) -> None:
+        def write(tmp: str) -> None:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+
+        try:
+            self._replace_atomic(self._path(key), write)
+        except OSError:
+            pass
+
+    def flush(self) -> None:
+        """Entries are written as they are set; kept for callers that flush after a batch."""
+
+    def get(self, key: str) -> Optional[List[float]]:
+        p = self._path(key)
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(p, None)
+            return decode_vector(value)
+        except Exception:
+            return None
+
+    def roundtrip(self, vec: List[float]) -> List[float]:
+        """``vec`` as it reads back from the cache, so fresh and cached vectors agree."""
+        if self.storage == "float64":
+            return vec
+        return decode_vector(encode_vector(vec, self.storage)) or vec
+
+    def set(self, key: str, vec: List[float]) -> None:
+        self._write(key, encode_vector(vec, self.storage))
+        self._writes += 1
+        if self._writes % self.check_every == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        return self._evict_lru(max_entries=self.max_entries)
+
+
+class SimHashIndex:
+    """Near-duplicate lookup over 64-bit SimHashes, persisted as JSON.
+
+    Each signature maps to its duplicate group, the embedding cache key of
+    the text first embedded for it, and the node that text belonged to
+    (``<workspace>:<qualname>``). Signatures are bucketed by
+    ``max_distance + 1`` bands, so any signature within ``max_distance``
+    differing bits shares a band with its match (pigeonhole) and is found
+    without a scan.
+    """
+    def __init__(self, path: str, max_distance: int = 5, max_entries: int = 500000, flush_interval: int = 200):
+        self.path = path
+        self.max_distance = max(0, min(max_distance, 15))
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        n = self.max_distance + 1
+        width = 64 // n
+        self._bands = [(i * width, 64 - i * width if i == n - 1 else width) for i in range(n)]
+        self._entries: Dict[int, Tuple[str, str, str]] = {}
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(path + ".lock")
+        self._dirty = 0
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return
+        with self._lock:
+            for sig, (group, key, owner) in data.items():
+                self._insert(int(sig, 16), group, key, owner)
+
+    def _band_keys(self, sig: int) -> List[int]:
+        return [(sig >> shift) & ((1 << width) - 1) for shift, width in self._bands]
+
+    def _insert(self, sig: int, group: str, key: str, owner: str) -> None:
+        if sig in self._entries:
+            return
+        if len(self._entries) >= self.max_entries:
+            # FIFO eviction, as in EmbeddingCache (dicts keep insertion order)
+            old = next(iter(self._entries))
+            del self._entries[old]
+            for bucket, bk in zip(self._buckets, self._band_keys(old)):
+                sigs = bucket.get(bk)
+                if sigs is not None and old in sigs:
+                    sigs.remove(old)
+                    if not sigs:
+                        del bucket[bk]
+        self._entries[sig] = (group, key, owner)
+        for bucket, bk in zip(self._buckets, self._band_keys(sig)):
+            bucket.setdefault(bk, []).append(sig)
+
+    def lookup(self, sig: int, owner: str = "") -> Optional[Tuple[str, str]]:
+        """(group, cache key) of the closest indexed signature within max_distance bits, if any.
+
+        Signatures indexed for ``owner`` itself are skipped: an edited function
+        is close to its own previous body, whose vector no longer fits it.
+        """
+        with self._lock:
+            hit = self._entries.get(sig)
+            if hit is not None and hit[2] != owner:
+                return hit[:2]
+            best, best_d = None, self.max_distance + 1
+            for bucket, bk in zip(self._buckets, self._band_keys(sig)):
+                for other in bucket.get(bk, ()):
+                    d = bin(sig ^ other).count("1")
+                    if d < best_d and self._entries[other][2] != owner:
+                        best, best_d = other, d
+            return self._entries[best][:2] if best is not None else None
+
+    def add(self, sig: int, group: str, key: str, owner: str) -> None:
+        with self._lock:
+            self._insert(sig, group, key, owner)
+            self._dirty += 1
+            if self._dirty < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        try:
+            with self._file_lock:
+                # Other worker processes flush to the same file: take in their signatures first
+                self._load()
+                with self._lock:
+                    data = {f"{sig:016x}": list(v) for sig, v in self._entries.items()}
+                    self._dirty = 0
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.tmp{os.getpid()}"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+
+class WorkspaceAccessLog:
+    """JSON file-backed last-access timestamps (epoch seconds) per workspace id.
+
+    Worker processes share the file: a flush merges in the other workers'
+    times (the latest wins), so each worker also sees their accesses.
+    """
+    def __init__(self, path: str, flush_interval_seconds: float = 60.0):
+        self.path = path
+        self.flush_interval_seconds = flush_interval_seconds
+        self._data: Dict[str, float] = {}
+        self._forgotten: Set[str] = set()
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(path + ".lock")
+        self._last_flush = 0.0
+        self._data = self._read()
+
+    def _read(self) -> Dict[str, float]:
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    obj = json.load(f)
+                    if isinstance(obj, dict):
+                        return {k: float(v) for k, v in obj.items() if isinstance(v, (int, float))}
+        except Exception:
+            pass
+        return {}
+
+    def flush(self) -> None:
+        try:
+            with self._file_lock:
+                stored = self._read()
+                with self._lock:
+                    for wid, ts in stored.items():
+                        if wid not in self._forgotten and ts > self._data.get(wid, 0.0):
+                            self._data[wid] = ts
+                    self._forgotten.clear()
+                    snapshot = dict(self._data)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp, self.path)
+            self._last_flush = time.time()
+        except Exception:
+            pass
+
+    def touch(self, workspace_id: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._data[workspace_id] = now
+        # Accesses are frequent; persist at most once per interval
+        if now - self._last_flush >= self.flush_interval_seconds:
+            self.flush()
+
+    def last_access(self, workspace_id: str) -> Optional[float]:
+        with self._lock:
+            return self._data.get(workspace_id)
+
+    def forget(self, workspace_id: str) -> None:
+        with self._lock:
+            self._data.pop(workspace_id, None)
+            self._forgotten.add(workspace_id)
+
+
+class MerkleManifest:
+    """Hash tree over one workspace mirror.
+
+    A file's hash is the SHA-256 of its bytes; a directory's is the SHA-256 of
+    its children's ``<f|d> <name> <hash>`` lines sorted by name, so equal
+    subtrees hash equal and a client only needs to descend where a hash
+    differs. The per-file index (hash, size, mtime) is persisted beside the
+    mirror, so on restart only files whose stat changed are re-hashed.
+    Directory hashes are cached and invalidated along the path of each update.
+    When another worker process rewrites the index, the tree is reloaded.
+    """
+    def __init__(self, root: str, index_path: str):
+        self.root = root
+        self.index_path = index_path
+        self._files: Dict[str, Tuple[str, int, int]] = {}
+        self._children: Dict[str, Dict[str, str]] = {"": {}}  # dir -> {name: "f" | "d"}
+        self._dir_hashes: Dict[str, str] = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._dirty = False
+        self._index_stat: Optional[Tuple[int, int]] = None
+
+    def _stat_index(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self) -> None:
+        index: Dict[str, Any] = {}
+        self._index_stat = self._stat_index()
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+            if isinstance(obj, dict) and obj.get("v") == 1:
+                index = obj.get("files") or {}
+        except Exception:
+            index = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                p = os.path.join(dirpath, fn)
+                rel = os.path.relpath(p, self.root).replace("\\", "/")
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                prev = index.get(rel)
+                if prev and prev[1] == st.st_size and prev[2] == st.st_mtime_ns:
+                    self._insert(rel, (prev[0], st.st_size, st.st_mtime_ns))
+                    continue
+                try:
+                    with open(p, "rb") as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                except OSError:
+                    continue
+                self._insert(rel, (digest, st.st_size, st.st_mtime_ns))
+                self._dirty = True
+        if len(index) != len(self._files):
+            self._dirty = True
+        self._loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded and not self._dirty and self._stat_index() != self._index_stat:
+            self._files.clear()
+            self._children = {"": {}}
+            self._dir_hashes.clear()
+            self._loaded = False
+        if not self._loaded:
+            self._load()
+
+    def _invalidate(self, rel: str) -> None:
+        parts = rel.split("/")
+        for i in range(len(parts)):
+            self._dir_hashes.pop("/".join(parts[:i]), None)
+
+    def _insert(self, rel: str, entry: Tuple[str, int, int]) -> None:
+        parts = rel.split("/")
+        for i in range(len(parts) - 1):
+            parent, child = "/".join(parts[:i]), "/".join(parts[:i + 1])
+            self._children.setdefault(parent, {})[parts[i]] = "d"
+            self._children.setdefault(child, {})
+        self._children["/".join(parts[:-1])][parts[-1]] = "f"
+        self._files[rel] = entry
+        self._invalidate(rel)
+
+    def record(self, rel: str, digest: str) -> None:
+        """Note that ``rel`` was just written with content hashing to ``digest``."""
+        try:
+            st = os.stat(os.path.join(self.root, rel))
+        except OSError:
+            self.remove(rel)
+            return
+        with self._lock:
+            self._ensure_loaded()
+            self._insert(rel, (digest, st.st_size, st.st_mtime_ns))
+            self._dirty = True
+
+    def hash_of(self, rel: str) -> Optional[str]:
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._files.get(rel)
+            return entry[0] if entry else None
+
+    def remove(self, rel: str) -> Optional[str]:
+        """Forget ``rel``; returns the hash it had."""
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._files.pop(rel, None)
+            if entry is None:
+                return None
+            self._invalidate(rel)
+            self._dirty = True
+            parts = rel.split("/")
+            # Drop directories left empty, bottom-up
+            for i in range(len(parts) - 1, -1, -1):
+                parent = "/".join(parts[:i])
+                self._children[parent].pop(parts[i], None)
+                if i == 0 or self._children[parent]:
+                    break
+                del self._children[parent]
+            return entry[0]
+
+    def _dir_hash(self, rel_dir: str) -> str:
+        cached = self._dir_hashes.get(rel_dir)
+        if cached is not None:
+            return cached
+        h = hashlib.sha256()
+        for name, kind in sorted(self._children.get(rel_dir, {}).items()):
+            child = f"{rel_dir}/{name}" if rel_dir else name
+            digest = self._files[child][0] if kind == "f" else self._dir_hash(child)
+            h.update(f"{kind} {name} {digest}\n".encode("utf-8"))
+        out = h.hexdigest()
+        self._dir_hashes[rel_dir] = out
+        return out
+
+    def root_hash(self) -> str:
+        with self._lock:
+            self._ensure_loaded()
+            return self._dir_hash("")
+
+    def children(self, rel_dir: str = "") -> Optional[Dict[str, Any]]:
+        """Hash of ``rel_dir`` and of each direct child; None when it is not a directory."""
+        rel_dir = rel_dir.strip("/")
+        with self._lock:
+            self._ensure_loaded()
+            if rel_dir not in self._children:
+                return None
+            entries = []
+            for name, kind in sorted(self._children[rel_dir].items()):
+                child = f"{rel_dir}/{name}" if rel_dir else name
+                entries.append({
+                    "name": name,
+                    "type": "file" if kind == "f" else "dir",
+                    "hash": self._files[child][0] if kind == "f" else self._dir_hash(child),
+                })
+            return {"path": rel_dir, "hash": self._dir_hash(rel_dir), "children": entries}
+
+    def files(self) -> Dict[str, str]:
+        with self._lock:
+            self._ensure_loaded()
+            return {rel: entry[0] for rel, entry in self._files.items()}
+
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {rel: list(entry) for rel, entry in self._files.items()}
+            self._dirty = False
+        try:
+            tmp = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"v": 1, "files": snapshot}, f, separators=(",", ":"))
+            os.replace(tmp, self.index_path)
+            with self._lock:
+                if not self._dirty:
+                    self._index_stat = self._stat_index()
+        except Exception:
+            pass
+
+
+class ContentStore(ShardedStore):
+    """Content-addressed blobs shared by every workspace mirror.
+
+    A blob lives at ``<root>/<sha[:2]>/<sha>`` and mirror files are hard links
+    to it, so identical content is stored once however many workspaces or
+    paths hold it, and the link count doubles as the reference count. Blobs
+    are never modified in place: updating a mirror path links the new blob
+    over it. Where hard links are unavailable the mirror gets a copy.
+    """
+    def put(self, data: bytes, digest: Optional[str] = None) -> str:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        p = self._path(digest)
+        if os.path.exists(p):
+            return digest
+
+        def write(tmp: str) -> None:
+            with open(tmp, "wb") as f:
+                f.write(data)
+
+        self._replace_atomic(p, write)
+        return digest
+
+    def write(self, dest: str, data: bytes, digest: Optional[str] = None) -> str:
+        """Point ``dest`` at the blob for ``data``, storing the blob first if it is new."""
+        digest = self.put(data, digest)
+
+        def link(tmp: str) -> None:
+            try:
+                os.link(self._path(digest), tmp)
+            except FileNotFoundError:
+                # Released by a concurrent delete between put and link
+                os.link(self._path(self.put(data, digest)), tmp)
+            except OSError:
+                shutil.copyfile(self._path(digest), tmp)
+
+        self._replace_atomic(dest, link)
+        return digest
+
+    def release(self, digest: Optional[str]) -> None:
+        """Drop the blob once no mirror file links to it any more."""
+        if not digest:
+            return
+        p = self._path(digest)
+        try:
+            if os.stat(p).st_nlink <= 1:
+                os.remove(p)
+        except OSError:
+            pass
+
+    def gc(self) -> int:
+        removed = 0
+        for p, st in self._files():
+            if st.st_nlink > 1:
+                continue
+            try:
+                os.remove(p)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+
+class Neo4jWriter:
+    def __init__(self, uri: str, user: str, pwd: str, embedder: Embedder, emb_cache: Optional["EmbeddingCache"] = None,
+                 source_store: Optional[SourceStore] = None):
+        self.pool_size = int(os.getenv("NEO4J_MAX_POOL_SIZE", "100"))
+        # Upper bound on how long managed transactions keep retrying transient errors
+        self.max_retry_seconds = float(os.getenv("NEO4J_MAX_RETRY_SECONDS", "15"))
+        self.driver = GraphDatabase.driver(uri, auth=(user, pwd), **self._driver_config())
+        self._uri = uri
+        self._auth = (user, pwd)
+        self._async_driver = None
+        self.embedder = embedder
+        self.emb_cache = emb_cache
+        # With a source store, nodes keep source_hash + span instead of the source text
+        self.source_store = source_store
+        self.ensure_schema()
+
+    def close(self):
+        self.driver.close()
+
+    @property
+    def async_driver(self):
+        # Created lazily so it binds to the server's event loop, not the importing thread
+        if self._async_driver is None:
+            self._async_driver = AsyncGraphDatabase.driver(self._uri, auth=self._auth, **self._driver_config())
+        return self._async_driver
+
+    async def aclose(self):
+        if self._async_driver is not None:
+            await self._async_driver.close()
+            self._async_driver = None
+
+    def _driver_config(self) -> Dict[str, Any]:
+        return {"max_connection_pool_size": self.pool_size, "max_transaction_retry_time": self.max_retry_seconds}
+
+    async def _aexecute(self, write: bool, cypher: str, timeout: Optional[float], params: Dict[str, Any]):
+        async def work(tx):
+            result = await tx.run(cypher, **params)
+            return [r async for r in result]
+
+        if timeout is not None:
+            work = unit_of_work(timeout=max(timeout, 0.001))(work)
+        async with self.async_driver.session(default_access_mode=WRITE_ACCESS if write else READ_ACCESS) as s:
+            if write:
+                return await s.execute_write(work)
+            return await s.execute_read(work)
+
+    async def aread(self, cypher: str, timeout: Optional[float] = None, **params):
+        return await self._aexecute(False, cypher, timeout, params)
+
+    async def awrite(self, cypher: str, timeout: Optional[float] = None, **params):
+        return await self._aexecute(True, cypher, timeout, params)
+
+    def _execute(self, write: bool, cypher: str, timeout: Optional[float], params: Dict[str, Any]):
+        # Managed transactions: the driver retries transient errors (leader switch,
+        # deadlock, lost connection) for up to max_retry_seconds, and the access
+        # mode lets a cluster route reads to followers instead of the writer.
+        def work(tx):
+            return list(tx.run(cypher, **params))
+
+        if timeout is not None:
+            work = unit_of_work(timeout=max(timeout, 0.001))(work)
+        with self.driver.session(default_access_mode=WRITE_ACCESS if write else READ_ACCESS) as s:
+            if write:
+                return s.execute_write(work)
+            return s.execute_read(work)
+
+    def read(self, cypher: str, timeout: Optional[float] = None, **params):
+        return self._execute(False, cypher, timeout, params)
+
+    def write(self, cypher: str, timeout: Optional[float] = None, **params):
+        return self._execute(True, cypher, timeout, params)
+
+    def run(self, cypher: str, timeout: Optional[float] = None, **params):
+        # Auto-commit; only for schema and admin statements that cannot run in a managed transaction
+        with self.driver.session() as s:
+            result = s.run(_query(cypher, timeout), **params)
+            out = list(result)
+            try:
+                result.consume()
+            except Exception:
+                pass
+            return out
+
+    def ensure_schema(self):
+        # Attempt to migrate old single-property uniqueness constraints to workspace-scoped composites
+        try:
+            rows = self.run("SHOW CONSTRAINTS")
+            for r in rows:
+                name = r.get("name") or r.get("constraintName")
+                labels = r.get("labelsOrTypes") or []
+                props = r.get("properties") or []
+                ctype = (r.get("type") or r.get("constraintType") or "").upper()
+                if "UNIQUE" in ctype:
+                    if labels == ["File"] and props == ["path"]:
+                        try:
+                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
+                        except Exception:
+                            pass
+                    if labels == ["Class"] and props == ["qualname"]:
+                        try:
+                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
+                        except Exception:
+                            pass
+                    if labels == ["Function"] and props == ["qualname"]:
+                        try:
+                            self.run(f"DROP CONSTRAINT `{name}` IF EXISTS")
+                        except Exception:
+                            pass
+        except Exception:
+            pass
+
+        # Workspace-scoped uniqueness
+        self.run("""
+        CREATE CONSTRAINT file_ws_unique IF NOT EXISTS
+        FOR (f:File) REQUIRE (f.path, f.workspaceId) IS UNIQUE
+        """)
+        self.run("""
+        CREATE CONSTRAINT class_ws_unique IF NOT EXISTS
+        FOR (c:Class) REQUIRE (c.qualname, c.workspaceId) IS UNIQUE
+        """)
+        self.run("""
+        CREATE CONSTRAINT func_ws_unique IF NOT EXISTS
+        FOR (f:Function) REQUIRE (f.qualname, f.workspaceId) IS UNIQUE
+        """)
+        self.run("""
+        CREATE INDEX function_name IF NOT EXISTS
+        FOR (f:Function) ON (f.name)
+        """)
+        self.run("""
+        CREATE CONSTRAINT lib_name_unique IF NOT EXISTS
+        FOR (l:Library) REQUIRE l.name IS UNIQUE
+        """)
+        self._ensure_vector_index("function_embedding", "Function")
+        self._ensure_vector_index("class_embedding", "Class")
+        try:
+            self.run("CALL db.awaitIndexes(300)")
+        except Exception:
+            try:
+                self.run("CALL db.awaitIndexes()")
             except Exception:
                 pass
 
+    def _ensure_vector_index(self, name: str, label: str) -> None:
+        """Create the vector index at the embedder's (possibly reduced) dimension.
+
+        An index built for another dimension is dropped and recreated; nodes
+        embedded at the old size need a replace sync to be indexed again. With
+        int8 storage the index's own scalar quantization is enabled where the
+        server supports it.
+        """
+        dim = self.embedder.dim
+        try:
+            rows = self.run("SHOW VECTOR INDEXES YIELD name, options WHERE name = $name RETURN options", name=name)
+            for r in rows:
+                existing = ((r.get("options") or {}).get("indexConfig") or {}).get("vector.dimensions")
+                if existing is not None and int(existing) != dim:
+                    self.run(f"DROP INDEX `{name}` IF EXISTS")
+        except Exception:
+            pass
+        config = f"`vector.dimensions`: {dim}, `vector.similarity_function`: 'cosine'"
+        quantize = getattr(self.emb_cache, "storage", "float64") == "int8"
+        for extra in ([", `vector.quantization.enabled`: true"] if quantize else []) + [""]:
+            try:
+                self.run(textwrap.dedent(f"""
+                CREATE VECTOR INDEX {name} IF NOT EXISTS
+                FOR (n:{label}) ON (n.embedding)
+                OPTIONS {{ indexConfig: {{ {config}{extra} }} }}
+                """))
+                return
+            except Exception:
+                # Servers before 5.23 reject the quantization setting
+                if not extra:
+                    raise
+
     def clear_file(self, rel_path: str, workspace_id: Optional[str] = None):
         if workspace_id is None:
-            self.run("""
+            self.write("""
             MATCH (f:File {path:$p})
             OPTIONAL MATCH (f)-[:CONTAINS]->(n)
             DETACH DELETE n, f
             """, p=rel_path)
         else:
-            self.run("""
+            self.write("""
             MATCH (f:File {path:$p, workspaceId:$wid})
             OPTIONAL MATCH (f)-[:CONTAINS]->(n)
             DETACH DELETE n, f
             """, p=rel_path, wid=workspace_id)
 
+    def delete_nodes(self, qualnames: List[str], workspace_id: Optional[str] = None):
+        """Remove Class/Function nodes that disappeared from a file that is otherwise kept."""
+        if not qualnames:
+            return
+        if workspace_id is None:
+            self.write("""
+            MATCH (n) WHERE (n:Class OR n:Function) AND n.qualname IN $qs AND n.workspaceId IS NULL
+            DETACH DELETE n
+            """, qs=list(qualnames))
+        else:
+            self.write("""
+            MATCH (n) WHERE (n:Class OR n:Function) AND n.qualname IN $qs AND n.workspaceId = $wid
+            DETACH DELETE n
+            """, qs=list(qualnames), wid=workspace_id)
+
+    def delete_workspace(self, workspace_id: str, batch_size: int = 5000,
+                         progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+        """Delete one workspace's File/Class/Function nodes and their relationships.
+
+        Deletion runs as ``CALL { ... } IN TRANSACTIONS`` so each batch commits on
+        its own and heap use stays bounded; other workspaces and the shared
+        Library nodes are left alone.
+        """
+        batch = max(int(batch_size), 1)
+        deleted: Dict[str, int] = {}
+        # Functions and classes first, so each File delete only detaches its remaining edges
+        for label in ("Function", "Class", "File"):
+            rows = self.run(
+                f"""
+                MATCH (n:{label}) WHERE n.workspaceId = $wid
+                CALL {{ WITH n DETACH DELETE n }} IN TRANSACTIONS OF {batch} ROWS
+                RETURN count(*) AS c
+                """,
+                wid=workspace_id,
+            )
+            deleted[label] = int(rows[0]["c"]) if rows else 0
+            if progress is not None:
+                progress(label, deleted[label])
+        return deleted
+
     def upsert_file(self, fi: FileInfo, workspace_id: Optional[str]):
         if workspace_id is None:
-            self.run(
+            self.write(
                 """
                 MERGE (f:File {path:$path})
                 SET f.language = $lang
@@ -749,7 +3055,7 @@ class Neo4jWriter:
                 path=fi.path, lang=fi.language,
             )
         else:
-            self.run(
+            self.write(
                 """
                 MERGE (f:File {path:$path, workspaceId:$wid})
                 SET f.language = $lang
@@ -757,8 +3063,8 @@ class Neo4jWriter:
                 path=fi.path, lang=fi.language, wid=workspace_id,
             )
         for lib in fi.imports:
-            self.run("MERGE (l:Library {name:$name})", name=lib)
-            self.run(
+            self.write("MERGE (l:Library {name:$name})", name=lib)
+            self.write(
                 """
                 MATCH (f:File {path:$path}), (l:Library {name:$lib})
                 MERGE (f)-[:IMPORTS]->(l)
@@ -767,81 +3073,175 @@ class Neo4jWriter:
             )
 
     def _emb(self, text: str) -> List[float]:
-        try:
-            # Try cache first
-            if self.emb_cache is not None:
-                key = self.embedder.cache_key_for_text(text)
-                cached = self.emb_cache.get(key)
-                if cached is not None and isinstance(cached, list) and len(cached) == getattr(self.embedder, 'dim', len(cached)):
-                    return cached
-            vec = self.embedder.embed([text])[0]
-            if self.emb_cache is not None:
-                key = self.embedder.cache_key_for_text(text)
-                self.emb_cache.set(key, vec)
-            return vec
-        except Exception:
-            # Fallback to zero vector to avoid failing sync when embeddings backend is unavailable
-            return [0.0] * getattr(self.embedder, 'dim', 384)
+        return self.embed_many([text])[0]
+
+    def cached_embedding(self, key: str) -> Optional[List[float]]:
+        """The cached vector under ``key`` when it matches the embedder's dimension."""
+        if self.emb_cache is None:
+            return None
+        cached = self.emb_cache.get(key)
+        if isinstance(cached, list) and len(cached) == getattr(self.embedder, 'dim', 384):
+            return cached
+        return None
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch in one backend call; cached texts are not sent.
+
+        When the backend fails the texts get an empty list: their nodes are
+        written without an embedding and marked ``embedding_pending`` (see
+        pending_embeddings), rather than given a zero vector that would match
+        every query equally.
+        """
+        out: List[Optional[List[float]]] = [None] * len(texts)
+        missing: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            cached = self.cached_embedding(self.embedder.cache_key_for_text(text))
+            if cached is not None:
+                out[i] = cached
+                continue
+            missing.setdefault(text, []).append(i)
+        if missing:
+            try:
+                vecs = self.embedder.embed(list(missing))
+            except Exception:
+                # The sync still writes the nodes; they are re-embedded once the backend recovers
+                vecs = [[] for _ in missing]
+            else:
+                if self.emb_cache is not None:
+                    for text, vec in zip(missing, vecs):
+                        self.emb_cache.set(self.embedder.cache_key_for_text(text), vec)
+                    vecs = [self.emb_cache.roundtrip(vec) for vec in vecs]
+            for (text, idxs), vec in zip(missing.items(), vecs):
+                for i in idxs:
+                    out[i] = vec
+        return out  # type: ignore[return-value]
+
+    @staticmethod
+    def class_text(ci: ClassInfo) -> str:
+        return "\n\n".join([
+            f"# Class: {ci.qualname}", ci.docstring or "", ci.source or "",
+        ])
+
+    @staticmethod
+    def function_text(fun: FunctionInfo) -> str:
+        sig_hint = f"def {fun.name}(...)"
+        return "\n\n".join([
+            f"# Function: {fun.qualname}", fun.docstring or "", sig_hint, fun.source or "",
+        ])
+
+    def _source_params(self, node: Any) -> Dict[str, Any]:
+        src = node.source or ""
+        if self.source_store is None:
+            return {"src": src, "sh": SourceStore.digest(src), "ln": node.lineno, "eln": node.end_lineno}
+        return {"src": None, "sh": self.source_store.put(src), "ln": node.lineno, "eln": node.end_lineno}
+
+    @staticmethod
+    def _call_names(fun: FunctionInfo) -> List[str]:
+        # Dotted calls (`self.save`, `os.path.join`) link by their last part, like Function.name
+        return sorted({c.rsplit(".", 1)[-1] for c in fun.calls})
+
+    @staticmethod
+    def _pending(emb: List[float]) -> Optional[bool]:
+        # true marks a node whose embedding failed; null removes the flag once it has one
+        return True if not emb else None
+
+    def set_embeddings(self, label: str, rows: List[Dict[str, Any]], workspace_id: Optional[str]) -> None:
+        """Store re-computed ``{"q": qualname, "emb": vector}`` rows and clear their pending flag."""
+        self.write(
+            f"""
+            UNWIND $rows AS row
+            MATCH (n:{label} {{qualname: row.q}})
+            WHERE n.workspaceId = $wid OR ($wid IS NULL AND n.workspaceId IS NULL)
+            SET n.embedding = row.emb
+            REMOVE n.embedding_pending
+            """,
+            rows=rows, wid=workspace_id,
+        )
+
+    def set_spans(self, spans: List[Tuple[str, str, int, int]], workspace_id: Optional[str]) -> None:
+        """Move ``(kind, qualname, lineno, end_lineno)`` nodes to new lines; source and embedding stay."""
+        for kind, label in (("class", "Class"), ("function", "Function")):
+            rows = [{"q": q, "ln": ln, "eln": eln} for k, q, ln, eln in spans if k == kind]
+            if not rows:
+                continue
+            self.write(
+                f"""
+                UNWIND $rows AS row
+                MATCH (n:{label} {{qualname: row.q}})
+                WHERE n.workspaceId = $wid OR ($wid IS NULL AND n.workspaceId IS NULL)
+                SET n.lineno = row.ln, n.end_lineno = row.eln
+                """,
+                rows=rows, wid=workspace_id,
+            )
 
-    def upsert_class(self, fi: FileInfo, ci: ClassInfo, workspace_id: Optional[str]):
-        text = "\n\n".join([
-            f"# Class: {ci.qualname}", ci.docstring or "", ci.source or "",
-        ])
-        emb = self._emb(text)
+    def upsert_class(self, fi: FileInfo, ci: ClassInfo, workspace_id: Optional[str],
+                     emb: Optional[List[float]] = None):
+        if emb is None:
+            emb = self._emb(self.class_text(ci))
         if workspace_id is None:
-            self.run(
+            self.write(
                 """
                 MERGE (c:Class {qualname:$qual})
-                SET c.name=$name, c.docstring=$doc, c.source=$src, c.file_path=$fp, c.embedding=$emb
+                SET c.name=$name, c.docstring=$doc, c.source=$src, c.source_hash=$sh, c.lineno=$ln,
+                    c.end_lineno=$eln, c.file_path=$fp, c.embedding=$emb, c.embedding_pending=$pending
                 WITH c
                 MATCH (f:File {path:$fp})
                 MERGE (f)-[:CONTAINS]->(c)
                 """,
-                qual=ci.qualname, name=ci.name, doc=ci.docstring, src=ci.source, fp=fi.path, emb=emb,
+                qual=ci.qualname, name=ci.name, doc=ci.docstring, fp=fi.path, emb=emb or None,
+                pending=self._pending(emb), **self._source_params(ci),
             )
         else:
-            self.run(
+            self.write(
                 """
                 MERGE (c:Class {qualname:$qual, workspaceId:$wid})
-                SET c.name=$name, c.docstring=$doc, c.source=$src, c.file_path=$fp, c.embedding=$emb
+                SET c.name=$name, c.docstring=$doc, c.source=$src, c.source_hash=$sh, c.lineno=$ln,
+                    c.end_lineno=$eln, c.file_path=$fp, c.embedding=$emb, c.embedding_pending=$pending
                 WITH c
                 MATCH (f:File {path:$fp, workspaceId:$wid})
                 MERGE (f)-[:CONTAINS]->(c)
                 """,
-                qual=ci.qualname, name=ci.name, doc=ci.docstring, src=ci.source, fp=fi.path, emb=emb, wid=workspace_id,
+                qual=ci.qualname, name=ci.name, doc=ci.docstring, fp=fi.path, emb=emb or None,
+                pending=self._pending(emb), wid=workspace_id, **self._source_params(ci),
             )
 
-    def upsert_function(self, fi: FileInfo, fun: FunctionInfo, workspace_id: Optional[str]):
-        sig_hint = f"def {fun.name}(...)"
-        text = "\n\n".join([
-            f"# Function: {fun.qualname}", fun.docstring or "", sig_hint, fun.source or "",
-        ])
-        emb = self._emb(text)
+    def upsert_function(self, fi: FileInfo, fun: FunctionInfo, workspace_id: Optional[str],
+                        emb: Optional[List[float]] = None, dup_group: Optional[str] = None):
+        if emb is None:
+            emb = self._emb(self.function_text(fun))
         if workspace_id is None:
-            self.run(
+            self.write(
                 """
                 MERGE (fn:Function {qualname:$qual})
-                SET fn.name=$name, fn.docstring=$doc, fn.source=$src, fn.file_path=$fp, fn.class_name=$cls, fn.embedding=$emb
+                SET fn.name=$name, fn.docstring=$doc, fn.source=$src, fn.source_hash=$sh, fn.lineno=$ln,
+                    fn.end_lineno=$eln, fn.call_names=$calls, fn.file_path=$fp, fn.class_name=$cls, fn.embedding=$emb,
+                    fn.embedding_pending=$pending, fn.dup_group=$dg
                 WITH fn
                 MATCH (f:File {path:$fp})
                 MERGE (f)-[:CONTAINS]->(fn)
                 """,
-                qual=fun.qualname, name=fun.name, doc=fun.docstring, src=fun.source, fp=fi.path, cls=fun.class_name, emb=emb,
+                qual=fun.qualname, name=fun.name, doc=fun.docstring, fp=fi.path, cls=fun.class_name, emb=emb or None,
+                pending=self._pending(emb), dg=dup_group,
+                calls=self._call_names(fun), **self._source_params(fun),
             )
         else:
-            self.run(
+            self.write(
                 """
                 MERGE (fn:Function {qualname:$qual, workspaceId:$wid})
-                SET fn.name=$name, fn.docstring=$doc, fn.source=$src, fn.file_path=$fp, fn.class_name=$cls, fn.embedding=$emb
+                SET fn.name=$name, fn.docstring=$doc, fn.source=$src, fn.source_hash=$sh, fn.lineno=$ln,
+                    fn.end_lineno=$eln, fn.call_names=$calls, fn.file_path=$fp, fn.class_name=$cls, fn.embedding=$emb,
+                    fn.embedding_pending=$pending, fn.dup_group=$dg
                 WITH fn
                 MATCH (f:File {path:$fp, workspaceId:$wid})
                 MERGE (f)-[:CONTAINS]->(fn)
                 """,
-                qual=fun.qualname, name=fun.name, doc=fun.docstring, src=fun.source, fp=fi.path, cls=fun.class_name, emb=emb, wid=workspace_id,
+                qual=fun.qualname, name=fun.name, doc=fun.docstring, fp=fi.path, cls=fun.class_name, emb=emb or None,
+                pending=self._pending(emb), dg=dup_group, wid=workspace_id,
+                calls=self._call_names(fun), **self._source_params(fun),
             )
         if fun.class_name:
             if workspace_id is None:
-                self.run(
+                self.write(
                     """
                     MATCH (c:Class {qualname:$cqual}), (fn:Function {qualname:$fqual})
                     MERGE (c)-[:DECLARES]->(fn)
@@ -849,7 +3249,7 @@ class Neo4jWriter:
                     cqual=f"{fi.path.replace(os.sep, '.')}.{fun.class_name}", fqual=fun.qualname,
                 )
             else:
-                self.run(
+                self.write(
                     """
                     MATCH (c:Class {qualname:$cqual, workspaceId:$wid}), (fn:Function {qualname:$fqual, workspaceId:$wid})
                     MERGE (c)-[:DECLARES]->(fn)
@@ -860,7 +3260,7 @@ class Neo4jWriter:
     def link_calls(self, workspace_id: Optional[str]):
         # Delete only relationships within the same workspace to avoid cross-workspace links
         if workspace_id is None:
-            self.run(
+            self.write(
                 """
                 MATCH (a:Function)-[r:CALLS]->(b:Function)
                 WHERE a.workspaceId IS NULL AND b.workspaceId IS NULL
@@ -868,36 +3268,173 @@ class Neo4jWriter:
                 """,
             )
         else:
-            self.run(
+            self.write(
                 """
                 MATCH (a:Function {workspaceId:$wid})-[r:CALLS]->(b:Function {workspaceId:$wid})
                 DELETE r
                 """,
                 wid=workspace_id,
             )
-        self.run(
+        # Callers list the names they call, so this is a name lookup rather than a scan of every source
+        self.write(
             """
-            MATCH (callee:Function)
+            MATCH (caller:Function)
+            WHERE $wid IS NULL OR caller.workspaceId = $wid
+            UNWIND coalesce(caller.call_names, []) AS name
+            MATCH (callee:Function {name:name})
             WHERE $wid IS NULL OR callee.workspaceId = $wid
-            WITH collect({name: callee.name, q: callee.qualname}) AS targets
-            UNWIND targets AS t
+            MERGE (caller)-[:CALLS]->(callee)
+            """,
+            wid=workspace_id,
+        )
+        # Nodes written before call_names existed still carry their source; partial syncs never
+        # rewrite them, so they are matched by scanning that source as before
+        self.write(
+            """
             MATCH (caller:Function)
-            WHERE (($wid IS NULL OR caller.workspaceId = $wid) AND caller.source CONTAINS (t.name + "("))
-            WITH caller, t
-            MATCH (callee:Function {qualname:t.q})
+            WHERE ($wid IS NULL OR caller.workspaceId = $wid)
+                  AND caller.call_names IS NULL AND caller.source IS NOT NULL
+            MATCH (callee:Function)
+            WHERE ($wid IS NULL OR callee.workspaceId = $wid) AND caller.source CONTAINS (callee.name + "(")
             MERGE (caller)-[:CALLS]->(callee)
             """,
             wid=workspace_id,
         )
 
 
+# Graph digest queries, in the order their lines appear in the digest
+_DIGEST_QUERIES: List[Tuple[str, str]] = [
+    ("languages", """
+    MATCH (f:File)
+    WHERE $wid IS NULL OR f.workspaceId = $wid
+    RETURN f.language AS lang, count(*) AS c
+    ORDER BY c DESC
+    LIMIT 5
+    """),
+    ("libraries", """
+    MATCH (f:File)-[:IMPORTS]->(l:Library)
+    WHERE $wid IS NULL OR f.workspaceId = $wid
+    RETURN l.name AS lib, count(*) AS c
+    ORDER BY c DESC
+    LIMIT 8
+    """),
+    ("entry_points", """
+    MATCH (fn:Function)
+    WHERE ($wid IS NULL OR fn.workspaceId = $wid)
+      AND (toLower(fn.name) CONTAINS 'main' OR toLower(fn.qualname) CONTAINS 'application')
+    RETURN fn.qualname AS q
+    LIMIT 10
+    """),
+    ("hubs", """
+    MATCH (f:Function)
+    WHERE $wid IS NULL OR f.workspaceId = $wid
+    OPTIONAL MATCH (f)-[r:CALLS]->() WITH f, count(r) AS out
+    OPTIONAL MATCH ()-[r2:CALLS]->(f) WITH f, out, count(r2) AS in
+    RETURN f.qualname AS q, in+out AS deg
+    ORDER BY deg DESC
+    LIMIT 10
+    """),
+]
+
+# Over-fetch so that collapsing near-duplicate functions to their best hit still fills k
+_DUP_OVERFETCH = 3
+
+_VECTOR_SEARCH_CYPHER = """
+CALL db.index.vector.queryNodes('function_embedding', $kk, $v) YIELD node, score
+WITH node, score WHERE ($wid IS NULL OR node.workspaceId = $wid)
+WITH coalesce(node.dup_group, elementId(node)) AS grp, node, score ORDER BY score DESC
+WITH grp, collect(node)[0] AS node, max(score) AS score
+RETURN node.qualname AS q, score
+ORDER BY score DESC
+LIMIT $k
+"""
+
+
+def _normalize_rel(path: str) -> str:
+    """Workspace-relative '/' path: leading './' and '/' dropped, '..' cannot escape the mirror.
+
+    Dotfiles such as .gitignore keep their leading dot.
+    """
+    return "/".join(p for p in path.replace("\\", "/").split("/") if p not in ("", ".", ".."))
+
+
+def _delta_block_size(size: int) -> int:
+    """rsync's rule of thumb: blocks of about sqrt(size) bytes, so signature and delta stay small."""
+    return min(64 * 1024, max(512, int(math.sqrt(size)) // 64 * 64))
+
+
+def _weak_checksum(block: bytes) -> int:
+    """rsync rolling checksum: a = sum(x_i), b = sum((n - i) * x_i), both mod 2**16."""
+    a = sum(block) & 0xFFFF
+    b = sum(itertools.accumulate(block)) & 0xFFFF
+    return a | (b << 16)
+
+
+def block_signature(data: bytes, block_size: int = 0) -> Dict[str, Any]:
+    """Per-block weak (rolling) and strong (md5) checksums of every full block of ``data``."""
+    block_size = block_size or _delta_block_size(len(data))
+    weak, strong = [], []
+    for off in range(0, len(data) - block_size + 1, block_size):
+        block = data[off:off + block_size]
+        weak.append(_weak_checksum(block))
+        strong.append(hashlib.md5(block).hexdigest())
+    return {"size": len(data), "hash": hashlib.sha256(data).hexdigest(),
+            "block_size": block_size, "weak": weak, "strong": strong}
+
+
+def apply_block_delta(base: bytes, block_size: int, delta: Iterable[Any], max_size: int = 0) -> bytes:
+    """Rebuild a file from ``base`` and a delta of ``[first_block, n_blocks]`` copies and base64 literals.
+
+    Raises ValueError once the result would pass ``max_size`` bytes (0 = no
+    limit): a few repeated copies in a small delta can expand without bound.
+    """
+    out = bytearray()
+    n_blocks = len(base) // block_size
+    for op in delta:
+        if isinstance(op, str):
+            size = len(op) // 4 * 3
+        else:
+            first, count = int(op[0]), int(op[1])
+            if first < 0 or count < 0 or first + count > n_blocks:
+                raise ValueError(f"block range {first}+{count} outside base of {n_blocks} blocks")
+            size = count * block_size
+        if max_size and len(out) + size > max_size:
+            raise ValueError(f"delta expands past {max_size} bytes")
+        if isinstance(op, str):
+            out += base64.b64decode(op)
+        else:
+            out += base[first * block_size:(first + count) * block_size]
+    return bytes(out)
+
+
+def _digest_line(label: str, rows) -> str:
+    if label == "languages":
+        body = ", ".join([f"{r['lang']}({r['c']})" for r in rows if r.get('lang')])
+        return f"languages: {body}" if body else ""
+    if label == "libraries":
+        body = ", ".join([str(r["lib"]) for r in rows])
+        return f"libraries: {body}" if body else ""
+    if label == "entry_points":
+        entries = [str(r["q"]) for r in rows]
+        return "entry_points: " + "; ".join(entries) if entries else ""
+    body = ", ".join([str(r["q"]) for r in rows])
+    return f"{label}: {body}" if body else ""
+
+
+def _elapsed(started: float) -> float:
+    return round(time.monotonic() - started, 4)
+
+
 class GraphService:
     def __init__(self):
         self.uri = os.getenv("NEO4J_URI", "bolt://localhost:7687")
         self.user = os.getenv("NEO4J_USERNAME", "neo4j")
         self.pwd = os.getenv("NEO4J_PASSWORD", "neo4j")
         self.embedder: Optional[Embedder] = None
+        self.embedding_service: Optional[EmbeddingService] = None
         self.writer: Optional[Neo4jWriter] = None
+        self._init_lock = threading.Lock()
+        self._embedder_lock = threading.Lock()
         # Choose a workspaces root OUTSIDE the project tree to avoid reload watchers
         # picking up changes and reloading the app during sync.
         ws_root_env = os.getenv("GRAPH_WORKSPACES_ROOT")
@@ -910,8 +3447,20 @@ class GraphService:
             else:
                 self.workspaces_root = os.path.join(tempfile.gettempdir(), "graphrag_server_workspaces")
         os.makedirs(self.workspaces_root, exist_ok=True)
-        # Embedding cache stored across workspaces
-        self.emb_cache = EmbeddingCache(os.path.join(self.workspaces_root, "_embed_cache.v1.json"))
+        self.parse_cache: Optional[ParseCache] = None
+        # Last-access times drive idle-workspace eviction
+        self.access_log = WorkspaceAccessLog(os.path.join(self.workspaces_root, "_access.v1.json"))
+        # Mirror files are hard links into one content-addressed store shared by all workspaces
+        self.store = ContentStore(os.path.join(self.workspaces_root, "_blobs.v1"))
+        # Per-workspace hash trees over the mirror, loaded on first use
+        self._manifests: Dict[str, MerkleManifest] = {}
+        self._manifests_lock = threading.Lock()
+        # Cross-process locks: one per workspace (sync, clear, evict) and one for the eviction sweep
+        if fcntl is None and multiprocessing.parent_process() is not None:
+            warnings.warn("fcntl is unavailable on this platform, so workspace locks only exclude threads "
+                          "of one process; run a single server worker (no --workers)", RuntimeWarning)
+        self._workspace_locks: Dict[str, FileLock] = {}
+        self._sweep_lock = FileLock(os.path.join(self.workspaces_root, "_locks", "_sweep.lock"))
         # Load tunables from config.yaml if present
         self.conf = {
             "graphrag": {
@@ -921,7 +3470,79 @@ class GraphService:
                 "max_context_tokens": 8192,
                 "prelude_enabled": True,
                 "workspace_scope": True,
-            }
+                # Fractions of request_timeout_seconds each stage may use
+                "stage_budgets": {
+                    "digest": 0.1,
+                    "rewrite": 0.3,
+                    "embed": 0.1,
+                    "retrieval": 0.15,
+                    "generation": 1.0,
+                },
+                "rewrite_skip_below_seconds": 15,
+            },
+            "sync": {
+                # Nodes deleted per transaction when a workspace graph is replaced
+                "delete_batch_size": 5000,
+                # Size cap of the persistent parse-result cache (0 disables it)
+                "parse_cache_max_mb": 256,
+                # Size cap of the store holding class/function source outside the graph (0 = unbounded)
+                "source_store_max_mb": 1024,
+                # .gitignore-style patterns skipped on top of the built-in ones
+                "ignore_patterns": [],
+                # Admission limits for parsing; 0 disables a check
+                "max_file_kb": 1024,
+                "max_line_length": 5000,
+                "max_avg_line_length": 300,
+                "max_entropy": 6.0,
+                # Items buffered between sync stages (mirror write -> parse -> embed -> graph write)
+                "pipeline_queue_size": 16,
+                # Nodes embedded per backend call during sync
+                "embed_batch_size": 64,
+                # Block size for delta-sync signatures (0 picks about sqrt(file size))
+                "delta_block_size": 0,
+            },
+            "embeddings": {
+                # Precision of cached vectors: float64, float32, float16 or int8 (per-vector scale)
+                "storage": "float32",
+                # Reduce vectors to this many dimensions (0 keeps the model's)
+                "dimensions": 0,
+                # truncate (Matryoshka prefix) or pca (components from pca_path)
+                "reduction": "truncate",
+                "pca_path": "",
+                # EMBEDDING_BACKEND=openai: API base URL (empty uses OPENAI_BASE_URL or the public API),
+                # requests in flight, retries of transient errors, per-request timeout, and split limits
+                "openai_base_url": "",
+                "openai_concurrency": 4,
+                "openai_max_retries": 5,
+                "openai_timeout_seconds": 60,
+                "openai_max_inputs": 2048,
+                "openai_max_request_tokens": 300000,
+                # EMBEDDING_BACKEND=onnx: model directory (empty downloads it) and intra-op threads (0 = all cores)
+                "onnx_model_dir": "",
+                "onnx_threads": 0,
+                # Embed in this many worker processes (0 embeds in the request thread), coalescing
+                # concurrent requests for up to batch_window_ms or max_batch texts
+                "workers": 0,
+                "max_batch": 64,
+                "batch_window_ms": 5,
+            },
+            "near_duplicates": {
+                # Functions whose body SimHashes differ in at most max_distance of 64 bits share
+                # one vector and one dup_group, and count once in top-k
+                "enabled": True,
+                "max_distance": 5,
+                "max_entries": 500000,
+            },
+            "workspaces": {
+                # Evict workspaces not accessed for this many days (0 disables)
+                "ttl_days": 30,
+                # Evict least-recently-used workspaces while the mirror exceeds this size (0 disables)
+                "max_total_mb": 0,
+                # Never size-evict a workspace accessed within this window
+                "grace_seconds": 600,
+                # Background sweeper period (0 disables; the admin endpoint still works)
+                "sweep_interval_seconds": 3600,
+            },
         }
         try:
             # Optional config: yaml is only needed if a config file is present.
@@ -929,84 +3550,92 @@ class GraphService:
             import yaml  # type: ignore
             with open(os.path.join(os.path.dirname(__file__), "config.yaml"), "r", encoding="utf-8") as f:
                 data = yaml.safe_load(f) or {}
-                if isinstance(data, dict) and "graphrag" in data:
-                    self.conf["graphrag"].update(data["graphrag"] or {})
+                if isinstance(data, dict):
+                    for section, defaults in self.conf.items():
+                        user_conf = data.get(section)
+                        if not isinstance(user_conf, dict):
+                            continue
+                        for key, value in user_conf.items():
+                            # Nested tables (e.g. stage_budgets) merge key-by-key with the defaults
+                            if isinstance(defaults.get(key), dict) and isinstance(value, dict):
+                                defaults[key].update(value)
+                            else:
+                                defaults[key] = value
         except Exception:
             pass
+        sync_conf = self.conf["sync"]
+        self.admission = AdmissionFilter(
+            _DEFAULT_IGNORE_PATTERNS + [str(p) for p in sync_conf.get("ignore_patterns") or []],
+            max_bytes=int(float(sync_conf.get("max_file_kb", 0) or 0) * 1024),
+            max_line_length=int(sync_conf.get("max_line_length", 0) or 0),
+            max_avg_line_length=int(sync_conf.get("max_avg_line_length", 0) or 0),
+            max_entropy=float(sync_conf.get("max_entropy", 0) or 0),
+        )
+        # Embedding cache stored across workspaces and worker processes
+        self.emb_cache = EmbeddingCache(os.path.join(self.workspaces_root, "_embed_cache.v2"),
+                                        storage=str(self.conf["embeddings"].get("storage") or "float64"),
+                                        legacy_path=os.path.join(self.workspaces_root, "_embed_cache.v1.json"))
+        dup_conf = self.conf["near_duplicates"]
+        self.simhash_index: Optional[SimHashIndex] = None
+        if dup_conf.get("enabled", True):
+            # v1 entries did not record their node, so an edited function could match its old body
+            try:
+                os.remove(os.path.join(self.workspaces_root, "_simhash.v1.json"))
+            except OSError:
+                pass
+            self.simhash_index = SimHashIndex(os.path.join(self.workspaces_root, "_simhash.v2.json"),
+                                              max_distance=int(dup_conf.get("max_distance", 5)),
+                                              max_entries=int(dup_conf.get("max_entries", 500000) or 500000))
+        source_mb = float(self.conf["sync"].get("source_store_max_mb", 0) or 0)
+        self.source_store = SourceStore(os.path.join(self.workspaces_root, "_sources.v1"),
+                                        max_bytes=int(source_mb * 1024 * 1024))
+        cache_mb = float(self.conf["sync"].get("parse_cache_max_mb", 0) or 0)
+        if cache_mb > 0:
+            self.parse_cache = ParseCache(os.path.join(self.workspaces_root, "_parse_cache.v1"),
+                                          max_bytes=int(cache_mb * 1024 * 1024))
 
-    def _graph_digest(self, workspace_id: Optional[str]) -> str:
+    def _graph_digest(self, workspace_id: Optional[str], timeout: Optional[float] = None) -> str:
         """Summarize key graph aspects to steer query rewriting."""
         self._ensure_writer()
         parts: List[str] = []
+        stop_at = None if timeout is None else time.monotonic() + timeout
         try:
-            with self.writer.driver.session() as s:
-                # Languages
-                rows = s.run(
-                    """
-                    MATCH (f:File)
-                    WHERE $wid IS NULL OR f.workspaceId = $wid
-                    RETURN f.language AS lang, count(*) AS c
-                    ORDER BY c DESC
-                    LIMIT 5
-                    """,
-                    wid=workspace_id,
-                )
-                langs = ", ".join([f"{r['lang']}({r['c']})" for r in rows if r.get('lang')])
-                if langs:
-                    parts.append(f"languages: {langs}")
-
-                # Top libraries
-                rows = s.run(
-                    """
-                    MATCH (f:File)-[:IMPORTS]->(l:Library)
-                    WHERE $wid IS NULL OR f.workspaceId = $wid
-                    RETURN l.name AS lib, count(*) AS c
-                    ORDER BY c DESC
-                    LIMIT 8
-                    """,
-                    wid=workspace_id,
-                )
-                libs = ", ".join([str(r["lib"]) for r in rows])
-                if libs:
-                    parts.append(f"libraries: {libs}")
-
-                # Entry points (heuristic)
-                rows = s.run(
-                    """
-                    MATCH (fn:Function)
-                    WHERE ($wid IS NULL OR fn.workspaceId = $wid)
-                      AND (toLower(fn.name) CONTAINS 'main' OR toLower(fn.qualname) CONTAINS 'application')
-                    RETURN fn.qualname AS q
-                    LIMIT 10
-                    """,
-                    wid=workspace_id,
-                )
-                entries = [str(r["q"]) for r in rows]
-                if entries:
-                    parts.append("entry_points: " + "; ".join(entries))
+            for label, cypher in _DIGEST_QUERIES:
+                # Each digest query gets whatever is left of the stage budget
+                left = None if stop_at is None else stop_at - time.monotonic()
+                if left is not None and left <= 0:
+                    break
+                rows = self.writer.read(cypher, timeout=left, wid=workspace_id)
+                line = _digest_line(label, rows)
+                if line:
+                    parts.append(line)
+        except Exception:
+            pass
+        return " | ".join(parts)[:1000]
 
-                # High-degree functions by calls
-                rows = s.run(
-                    """
-                    MATCH (f:Function)
-                    WHERE $wid IS NULL OR f.workspaceId = $wid
-                    OPTIONAL MATCH (f)-[r:CALLS]->() WITH f, count(r) AS out
-                    OPTIONAL MATCH ()-[r2:CALLS]->(f) WITH f, out, count(r2) AS in
-                    RETURN f.qualname AS q, in+out AS deg
-                    ORDER BY deg DESC
-                    LIMIT 10
-                    """,
-                    wid=workspace_id,
-                )
-                hubs = ", ".join([str(r["q"]) for r in rows])
-                if hubs:
-                    parts.append(f"hubs: {hubs}")
+    async def _agraph_digest(self, workspace_id: Optional[str], timeout: Optional[float] = None) -> str:
+        parts: List[str] = []
+        stop_at = None if timeout is None else time.monotonic() + timeout
+        try:
+            for label, cypher in _DIGEST_QUERIES:
+                left = None if stop_at is None else stop_at - time.monotonic()
+                if left is not None and left <= 0:
+                    break
+                rows = await self.writer.aread(cypher, timeout=left, wid=workspace_id)
+                line = _digest_line(label, rows)
+                if line:
+                    parts.append(line)
         except Exception:
             pass
         return " | ".join(parts)[:1000]
 
-    def _rewrite_query(self, question: str, workspace_id: Optional[str], digest: Optional[str] = None) -> str:
+    def _rewrite_query(self, question: str, workspace_id: Optional[str], digest: Optional[str] = None,
+                       timeout: Optional[float] = None) -> str:
         digest = digest if digest is not None else self._graph_digest(workspace_id)
+        stop_at = None if timeout is None else time.monotonic() + timeout
+
+        def left() -> Optional[float]:
+            return None if stop_at is None else max(stop_at - time.monotonic(), 0.0)
 
         class RewriteSpec(BaseModel):
             rewritten_query: str = Field(..., description="Focused retrieval query")
@@ -1016,7 +3645,7 @@ class GraphService:
         try:
             from langchain_openai import ChatOpenAI  # type: ignore
             from langchain_core.prompts import ChatPromptTemplate  # type: ignore
-            llm = ChatOpenAI(model="gpt-4o-nano")
+            llm = ChatOpenAI(model="gpt-4o-nano", timeout=left(), max_retries=0 if stop_at else 2)
             Structured = llm.with_structured_output(RewriteSpec)
             tmpl = ChatPromptTemplate.from_messages([
                 ("system", "You rewrite user requests into focused retrieval queries for a code GraphRAG system. "
@@ -1031,7 +3660,7 @@ class GraphService:
             # Fallback to OpenAI Responses API
             try:
                 from openai import OpenAI  # type: ignore
-                client = OpenAI()
+                client = OpenAI(max_retries=0) if stop_at else OpenAI()
                 models = ["gpt-4o-nano", "gpt-4o-mini"]
                 sys = (
                     "You convert user requests into focused retrieval queries for a code GraphRAG system. "
@@ -1055,8 +3684,12 @@ class GraphService:
                     }
                 }
                 for m in models:
+                    budget = left()
+                    if budget is not None and budget <= 0:
+                        break
                     try:
                         resp = client.responses.create(
+                            timeout=budget,
                             model=m,
                             input=[
                                 {"role": "system", "content": sys},
@@ -1089,6 +3722,9 @@ class GraphService:
         except Exception:
             pass
 
+        return self._heuristic_rewrite(question, digest)
+
+    def _heuristic_rewrite(self, question: str, digest: Optional[str]) -> str:
         # Heuristic fallback with digest hint
         q_lower = question.lower()
         if ("summarize" in q_lower and "flow" in q_lower) or ("architecture" in q_lower):
@@ -1099,58 +3735,280 @@ class GraphService:
         return f"{base} [context: {digest}]" if digest else base
 
     def _ensure_embedder(self) -> None:
-        if self.embedder is None:
-            self.embedder = Embedder()
+        if self.embedder is not None:
+            return
+        with self._embedder_lock:
+            if self.embedder is not None:
+                return
+            econf = self.conf["embeddings"]
+            here = os.path.dirname(os.path.abspath(__file__))
+            pca_path = str(econf.get("pca_path") or "")
+            if pca_path and not os.path.isabs(pca_path):
+                pca_path = os.path.join(here, pca_path)
+            onnx_dir = str(econf.get("onnx_model_dir") or "")
+            if onnx_dir and not os.path.isabs(onnx_dir):
+                onnx_dir = os.path.join(here, onnx_dir)
+            kwargs = {
+                "dimensions": int(econf.get("dimensions", 0) or 0),
+                "reduction": str(econf.get("reduction") or "truncate"),
+                "pca_path": pca_path or None,
+                "onnx_model_dir": onnx_dir or None,
+                "onnx_threads": int(econf.get("onnx_threads", 0) or 0),
+                "openai_options": {
+                    "base_url": str(econf.get("openai_base_url") or "") or None,
+                    "concurrency": int(econf.get("openai_concurrency", 4) or 4),
+                    "max_retries": int(econf.get("openai_max_retries", 5) or 0),
+                    "timeout": float(econf.get("openai_timeout_seconds", 60) or 60),
+                    "max_inputs": int(econf.get("openai_max_inputs", 2048) or 2048),
+                    "max_request_tokens": int(econf.get("openai_max_request_tokens", 300000) or 300000),
+                },
+            }
+            workers = int(econf.get("workers", 0) or 0)
+            if workers > 0:
+                self.embedding_service = EmbeddingService(
+                    kwargs, workers=workers, max_batch=int(econf.get("max_batch", 64) or 64),
+                    window_ms=float(econf.get("batch_window_ms", 5) or 0))
+                self.embedder = self.embedding_service.client()
+            else:
+                self.embedder = Embedder(**kwargs)
 
     def _ensure_writer(self) -> None:
         if self.writer is None:
-            self._ensure_embedder()
-            self.writer = Neo4jWriter(self.uri, self.user, self.pwd, self.embedder, self.emb_cache)
+            with self._init_lock:
+                if self.writer is None:
+                    self._ensure_embedder()
+                    # Sync embeddings go in as bulk requests, behind queries waiting for a worker
+                    embedder = self.embedding_service.client(bulk=True) if self.embedding_service else self.embedder
+                    self.writer = Neo4jWriter(self.uri, self.user, self.pwd, embedder, self.emb_cache,
+                                              self.source_store)
+
+    async def _aensure_writer(self) -> None:
+        if self.writer is None:
+            # Driver creation and schema setup are blocking; keep them off the event loop
+            await asyncio.to_thread(self._ensure_writer)
+
+    def check_workspace_id(self, workspace_id: str) -> str:
+        """``workspace_id`` if it names a directory directly under workspaces_root, else ValueError.
+
+        Ids end up in rmtree and in manifest/lock paths, so path separators,
+        '.' and '..', and the '_'/'.' names of the service's own files are refused.
+        """
+        wid = str(workspace_id or "")
+        if (wid in ("", ".", "..") or "/" in wid or "\\" in wid or "\0" in wid
+                or wid.startswith(("_", "."))):
+            raise ValueError(f"invalid workspace id: {workspace_id!r}")
+        root = os.path.realpath(self.workspaces_root)
+        if os.path.dirname(os.path.realpath(os.path.join(root, wid))) != root:
+            raise ValueError(f"invalid workspace id: {workspace_id!r}")
+        return wid
 
     def _ws_dir(self, workspace_id: str) -> str:
-        d = os.path.join(self.workspaces_root, workspace_id)
+        d = os.path.join(self.workspaces_root, self.check_workspace_id(workspace_id))
         os.makedirs(d, exist_ok=True)
+        self._touch(workspace_id)
         return d
 
-    def clear_workspace(self, workspace_id: str) -> None:
-        # Remove all files in server mirror and clear graph nodes
-        root = self._ws_dir(workspace_id)
-        for dirpath, _, filenames in os.walk(root):
+    def _touch(self, workspace_id: Optional[str]) -> None:
+        if workspace_id:
+            self.access_log.touch(workspace_id)
+
+    def list_workspaces(self) -> List[str]:
+        try:
+            names = os.listdir(self.workspaces_root)
+        except Exception:
+            return []
+        # Skip service files such as _embed_cache.v2 / _access.v1.json / _locks
+        return [n for n in names if not n.startswith(("_", ".")) and os.path.isdir(os.path.join(self.workspaces_root, n))]
+
+    def _graph_workspaces(self) -> List[str]:
+        self._ensure_writer()
+        rows = self.writer.read("MATCH (f:File) WHERE f.workspaceId IS NOT NULL RETURN DISTINCT f.workspaceId AS wid")
+        return [str(r["wid"]) for r in rows]
+
+    @staticmethod
+    def _dir_size(path: str) -> int:
+        # Content shared through the blob store is split across the paths linking it
+        total = 0.0
+        for dirpath, _, filenames in os.walk(path):
             for fn in filenames:
                 try:
-                    os.remove(os.path.join(dirpath, fn))
+                    st = os.stat(os.path.join(dirpath, fn))
+                except OSError:
+                    continue
+                total += st.st_size / max(1, st.st_nlink - 1)
+        return int(total)
+
+    def workspace_lock(self, workspace_id: str) -> FileLock:
+        """Lock serializing writes to one workspace's mirror and graph across threads and worker processes."""
+        self.check_workspace_id(workspace_id)
+        with self._manifests_lock:
+            lock = self._workspace_locks.get(workspace_id)
+            if lock is None:
+                lock = FileLock(os.path.join(self.workspaces_root, "_locks", workspace_id + ".lock"))
+                self._workspace_locks[workspace_id] = lock
+            return lock
+
+    def _pending_marker(self, workspace_id: str) -> str:
+        # Workspaces with nodes whose embedding failed, retried after the next sync that embeds cleanly;
+        # kept on disk so whichever worker process syncs next sees it
+        return os.path.join(self.workspaces_root, "_pending.v1", self.check_workspace_id(workspace_id))
+
+    def _set_pending(self, workspace_id: str, pending: bool) -> None:
+        p = self._pending_marker(workspace_id)
+        try:
+            if pending:
+                os.makedirs(os.path.dirname(p), exist_ok=True)
+                open(p, "a").close()
+            else:
+                os.remove(p)
+        except OSError:
+            pass
+
+    def clear_workspace(self, workspace_id: str, gc: bool = True) -> Dict[str, int]:
+        # Remove the server mirror and the workspace's graph nodes
+        with self.workspace_lock(workspace_id):
+            root = os.path.join(self.workspaces_root, self.check_workspace_id(workspace_id))
+            shutil.rmtree(root, ignore_errors=True)
+            if gc:
+                self.store.gc()
+            with self._manifests_lock:
+                self._manifests.pop(workspace_id, None)
+            try:
+                os.remove(self._manifest_index_path(workspace_id))
+            except OSError:
+                pass
+            self.access_log.forget(workspace_id)
+            self._set_pending(workspace_id, False)
+            return self.clear_workspace_graph(workspace_id)
+
+    def evict_idle_workspaces(self, dry_run: bool = False) -> Dict[str, Any]:
+        """Evict workspaces idle past ttl_days, then LRU ones while the mirror exceeds max_total_mb.
+
+        Every worker process runs the sweeper; only one sweeps at a time, and a
+        workspace whose lock is held (a sync in progress) is skipped.
+        """
+        if not dry_run and not self._sweep_lock.acquire(blocking=False):
+            return {"dry_run": False, "workspaces": 0, "evicted": [], "cleared": {}, "busy": True}
+        try:
+            return self._evict_idle_workspaces(dry_run)
+        finally:
+            if not dry_run:
+                self._sweep_lock.release()
+
+    def _evict_idle_workspaces(self, dry_run: bool) -> Dict[str, Any]:
+        # Merge in the accesses other worker processes have recorded
+        self.access_log.flush()
+        wconf = self.conf["workspaces"]
+        now = time.time()
+        ttl = float(wconf.get("ttl_days", 0) or 0) * 86400
+        max_bytes = float(wconf.get("max_total_mb", 0) or 0) * 1024 * 1024
+        grace = float(wconf.get("grace_seconds", 600) or 0)
+
+        entries: List[Tuple[float, str, int]] = []
+        for wid in self.list_workspaces():
+            path = os.path.join(self.workspaces_root, wid)
+            last = self.access_log.last_access(wid)
+            if last is None:
+                # Untracked (pre-existing) workspace: fall back to the directory's mtime
+                try:
+                    last = os.path.getmtime(path)
+                except OSError:
+                    last = now
+            entries.append((last, wid, self._dir_size(path)))
+        # Graph-only workspaces (mirror already gone) start their TTL clock when first seen
+        try:
+            mirrored = {wid for _, wid, _ in entries}
+            for wid in self._graph_workspaces():
+                if wid in mirrored:
+                    continue
+                last = self.access_log.last_access(wid)
+                if last is None:
+                    self.access_log.touch(wid)
+                    last = now
+                entries.append((last, wid, 0))
+        except Exception:
+            pass
+
+        victims: List[str] = []
+        if ttl > 0:
+            victims = [wid for last, wid, _ in entries if now - last > ttl]
+        if max_bytes > 0:
+            kept = sorted(e for e in entries if e[1] not in victims)
+            total = sum(size for _, _, size in kept)
+            for last, wid, size in kept:
+                if total <= max_bytes:
+                    break
+                if now - last < grace:
+                    continue
+                victims.append(wid)
+                total -= size
+
+        evicted: Dict[str, Dict[str, int]] = {}
+        if not dry_run:
+            for wid in victims:
+                lock = self.workspace_lock(wid)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    evicted[wid] = self.clear_workspace(wid, gc=False)
                 except Exception:
-                    pass
+                    continue
+                finally:
+                    lock.release()
+            self.store.gc()
+            self.access_log.flush()
+        return {
+            "dry_run": dry_run,
+            "workspaces": len(entries),
+            "evicted": victims if dry_run else list(evicted.keys()),
+            "cleared": evicted,
+        }
+
+    def clear_workspace_graph(self, workspace_id: str,
+                              progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+        """Replace support: drop only this workspace's nodes, in bounded batches."""
         self._ensure_writer()
-        # Delete all nodes for this workspace's files
-        self.writer.run("""
-        MATCH (f:File) WHERE f.path STARTS WITH ''
-        WITH collect(f.path) AS fps
-        // We don't encode workspace id into node; safest is full reset between projects if requested
-        """)
+        batch = int(self.conf["sync"].get("delete_batch_size", 5000))
+        with self.workspace_lock(workspace_id):
+            deleted = self.writer.delete_workspace(workspace_id, batch_size=batch, progress=progress)
+        return {
+            "cleared_files": deleted.get("File", 0),
+            "cleared_classes": deleted.get("Class", 0),
+            "cleared_functions": deleted.get("Function", 0),
+        }
 
     def clear_all(self) -> None:
         # Hard reset graph (useful when switching projects)
         self._ensure_writer()
-        self.writer.run("MATCH (n) DETACH DELETE n")
+        self.writer.write("MATCH (n) DETACH DELETE n")
 
-    def compute_manifest(self, workspace_id: str) -> Dict[str, str]:
+    def _manifest_index_path(self, workspace_id: str) -> str:
+        return os.path.join(self.workspaces_root, "_manifest.v1", self.check_workspace_id(workspace_id) + ".json")
+
+    def _manifest(self, workspace_id: str) -> MerkleManifest:
         root = self._ws_dir(workspace_id)
-        out: Dict[str, str] = {}
-        for dirpath, _, filenames in os.walk(root):
-            for fn in filenames:
-                p = os.path.join(dirpath, fn)
-                rel = os.path.relpath(p, root).replace("\\", "/")
-                try:
-                    with open(p, "rb") as f:
-                        out[rel] = hashlib.sha256(f.read()).hexdigest()
-                except Exception:
-                    continue
-        return out
+        with self._manifests_lock:
+            m = self._manifests.get(workspace_id)
+            if m is None:
+                m = MerkleManifest(root, self._manifest_index_path(workspace_id))
+                self._manifests[workspace_id] = m
+            return m
+
+    def compute_manifest(self, workspace_id: str) -> Dict[str, str]:
+        return self._manifest(workspace_id).files()
+
+    def manifest_tree(self, workspace_id: str, rel_dir: str = "") -> Dict[str, Any]:
+        """Hash of a mirror directory (the workspace root by default) and of its direct children."""
+        m = self._manifest(workspace_id)
+        m.flush()
+        node = m.children(_normalize_rel(rel_dir))
+        if node is None:
+            return {"path": _normalize_rel(rel_dir), "hash": None, "children": []}
+        return node
 
     def get_file_content(self, workspace_id: str, rel_path: str) -> str:
         root = self._ws_dir(workspace_id)
-        rel = rel_path.replace("\\", "/").lstrip("./")
+        rel = _normalize_rel(rel_path)
         p = os.path.join(root, rel)
         try:
             with open(p, "r", encoding="utf-8") as f:
@@ -1158,58 +4016,174 @@ class GraphService:
         except Exception:
             return ""
 
-    def _write_text(self, abs_path: str, content: str) -> None:
-        dir_path = os.path.dirname(abs_path)
-        if dir_path and not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-        with open(abs_path, "w", encoding="utf-8") as f:
-            f.write(content)
+    def get_file_signature(self, workspace_id: str, rel_path: str) -> Dict[str, Any]:
+        """Block signature of the mirrored copy, for clients that upload only changed blocks."""
+        p = os.path.join(self._ws_dir(workspace_id), _normalize_rel(rel_path))
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        block_size = int(self.conf["sync"].get("delta_block_size", 0) or 0)
+        return block_signature(data, block_size)
 
-    def apply_changes(self, workspace_id: str, changes: List[Dict[str, str]]) -> Dict[str, int]:
-        root = self._ws_dir(workspace_id)
-        added = modified = deleted = upserts = 0
-        touched: List[str] = []
-        dmp = diff_match_patch() if diff_match_patch else None
-        ignore_dirs = {
-            "node_modules", ".git", ".venv", "venv", "env", "ENV", 
-            "Lib", "lib", "site-packages", "dist", "build", "out", "__pycache__", ".python_packages"
-        }
+    def _apply_delta(self, abs_path: str, ch: Dict[str, Any]) -> Optional[str]:
+        """New content for a ``mode: "delta"`` change, or None when it does not apply to the mirrored copy."""
+        try:
+            with open(abs_path, "rb") as f:
+                base = f.read()
+        except OSError:
+            base = b""
+        if ch.get("base") and hashlib.sha256(base).hexdigest() != ch["base"]:
+            return None
+        try:
+            # Same bound as a decompressed request body (compression.max_decompressed_mb)
+            max_mb = float((self.conf.get("compression") or {}).get("max_decompressed_mb", 256) or 0)
+            data = apply_block_delta(base, int(ch.get("block_size") or 0), ch.get("delta") or [],
+                                     max_size=int(max_mb * 1024 * 1024))
+            if ch.get("hash") and hashlib.sha256(data).hexdigest() != ch["hash"]:
+                return None
+            return data.decode("utf-8")
+        except (ValueError, TypeError, ZeroDivisionError):
+            return None
+
+    def _write_text(self, manifest: MerkleManifest, rel: str, abs_path: str, content: str) -> None:
+        """Mirror ``content`` at ``rel`` through the blob store; unchanged content is not rewritten."""
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        previous = manifest.hash_of(rel)
+        if previous == digest and os.path.exists(abs_path):
+            return
+        self.store.write(abs_path, data, digest)
+        manifest.record(rel, digest)
+        if previous != digest:
+            self.store.release(previous)
+
+    def _parse_cached(self, abs_path: str, root: str, text: Optional[str] = None) -> Tuple[FileInfo, bool]:
+        """Parse a mirrored file (or ``text`` in place of its content), reusing a cached
+        result for identical content. Returns (info, cache_hit)."""
+        entry = _parser_for(abs_path)
+        if entry is None or self.parse_cache is None:
+            return parse_file(abs_path, root, text), False
+        language = entry[0]
+        try:
+            if text is None:
+                with open(abs_path, "rb") as f:
+                    data = f.read()
+            else:
+                data = text.encode("utf-8")
+        except OSError:
+            return parse_file(abs_path, root), False
+        content_hash = hashlib.sha256(data).hexdigest()
+        rel = os.path.relpath(abs_path, root)
+        cached = self.parse_cache.get(content_hash, language, rel)
+        if cached is not None:
+            return cached, True
+        fi = parse_file(abs_path, root, text)
+        self.parse_cache.put(content_hash, language, fi)
+        return fi, False
+
+    def _admission_for(self, workspace_id: str, changes: Iterable[Dict[str, Any]]) -> AdmissionFilter:
+        """The configured filter plus the workspace's root .gitignore (as sent in this batch, or mirrored)."""
+        gitignore = None
+        # A streamed batch cannot be scanned ahead; its .gitignore applies from where it arrives
+        for ch in changes if isinstance(changes, list) else []:
+            if _normalize_rel(ch["path"]) == ".gitignore" and ch["status"] != "deleted" \
+                    and ch.get("mode", "full") != "patch":
+                gitignore = ch.get("content") or ""
+        if gitignore is None:
+            gitignore = self.get_file_content(workspace_id, ".gitignore")
+        return self.admission.with_patterns(gitignore.splitlines())
+
+    def _plan_partial(self, abs_path: str, root: str, old_text: str, counts: Dict[str, int]) -> Optional[_GraphPlan]:
+        """Plan rewriting only the nodes of a modified file whose span overlaps a changed line.
+
+        The previous mirror copy is diffed against the new one; nodes outside the
+        changed ranges keep their stored source and embedding. Returns None when
+        there is no usable previous parse, so the caller falls back to a full upsert.
+        """
+        if _parser_for(abs_path) is None:
+            return None
+        old_fi, _ = self._parse_cached(abs_path, root, old_text)
+        new_fi, hit = self._parse_cached(abs_path, root)
+        counts["parse_cache_hits"] += int(hit)
+        new_text = _read_text(abs_path)
+        ranges = _changed_line_ranges(old_text, new_text)
+        old_nodes = {node.qualname: node for _, node in _graph_nodes(old_fi)}
+        new_nodes = _graph_nodes(new_fi)
+
+        dirty, moved = [], []
+        for kind, node in new_nodes:
+            prev = old_nodes.get(node.qualname)
+            # Doc comments sit above a C-family node's span, so compare them directly; the
+            # source check catches edits the line ranges attribute to a neighbouring node
+            if (prev is None or prev.docstring != node.docstring or prev.source != node.source
+                    or _span_touched(node, ranges)):
+                dirty.append((kind, node))
+            elif (prev.lineno, prev.end_lineno) != (node.lineno, node.end_lineno):
+                # Untouched, but an edit above it shifted its lines: the stored span must follow
+                moved.append((kind, node.qualname, node.lineno, node.end_lineno))
+        counts["nodes_skipped"] += len(new_nodes) - len(dirty)
+        gone = set(old_nodes) - {node.qualname for _, node in new_nodes}
+        return _GraphPlan(new_fi, dirty, sorted(gone),
+                          upsert_file=new_fi.imports != old_fi.imports or new_fi.language != old_fi.language,
+                          moved=moved)
 
+    def _mirror_stage(self, workspace_id: str, root: str, changes: Iterable[Dict[str, Any]],
+                      incremental: bool, counts: Dict[str, int]) -> Iterator[Tuple]:
+        """Write each change into the mirror and yield the graph work it implies.
+
+        Yields ("file", abs_path, previous_text) for files to (re)parse and
+        ("clear", rel) for files whose nodes must go. Change contents are dropped
+        once mirrored so a long batch does not stay in memory twice.
+        """
+        dmp = diff_match_patch() if diff_match_patch else None
+        admission = self._admission_for(workspace_id, changes)
+        manifest = self._manifest(workspace_id)
         for ch in changes:
-            rel = ch["path"].replace("\\", "/").lstrip("./")
+            rel = _normalize_rel(ch["path"])
             abs_path = os.path.join(root, rel)
             status = ch["status"]
             mode = ch.get("mode", "full")
 
-            # Backend-side guard: skip venv/vendor/artifact paths
-            rel_norm = f"/{rel}/"
-            if any(f"/{seg}/" in rel_norm for seg in ignore_dirs):
+            # Backend-side guard: skip venv/vendor/artifact paths and ignored files
+            if admission.path_reason(rel):
+                counts["skipped_ignored"] += 1
                 continue
 
             if status in ("added", "modified"):
-                if mode == "patch" and dmp is not None:
-                    base = self.get_file_content(workspace_id, rel)
-                    patch_text = ch.get("patch", "")
+                base = self.get_file_content(workspace_id, rel)
+                content = ch.pop("content", None) or ""
+                patch_text = ch.pop("patch", None) or ""
+                if mode == "delta":
+                    rebuilt = self._apply_delta(abs_path, ch)
+                    ch.pop("delta", None)
+                    if rebuilt is None:
+                        # Mirror changed since the client fetched the signature; it resends in full
+                        counts["delta_failed"] += 1
+                        continue
+                    content = rebuilt
+                elif mode == "patch" and dmp is not None:
                     try:
                         patches = dmp.patch_fromText(patch_text)
                         new_text, results = dmp.patch_apply(patches, base)
-                        if not all(results):
-                            content = ch.get("content", "")
-                            self._write_text(abs_path, content)
-                        else:
-                            self._write_text(abs_path, new_text)
+                        if all(results):
+                            content = new_text
                     except Exception:
-                        content = ch.get("content", "")
-                        self._write_text(abs_path, content)
-                else:
-                    content = ch.get("content", "")
-                    self._write_text(abs_path, content)
-
-                touched.append(abs_path)
-                if status == "added":
-                    added += 1
-                else:
-                    modified += 1
+                        pass
+                # Mirrored either way, so the manifest matches and the client does not resend it
+                self._write_text(manifest, rel, abs_path, content)
+                if rel == ".gitignore":
+                    admission = self.admission.with_patterns(content.splitlines())
+                reason = admission.content_reason(content)
+                if reason:
+                    counts[f"skipped_{reason}"] += 1
+                    if status == "modified":
+                        # It may have been parsed before it grew past a limit
+                        yield ("clear", rel)
+                    continue
+                counts[status] += 1
+                yield ("file", abs_path, base if incremental and status == "modified" and base else None)
 
             elif status == "deleted":
                 try:
@@ -1217,97 +4191,301 @@ class GraphService:
                         os.remove(abs_path)
                 except Exception:
                     pass
+                self.store.release(manifest.remove(rel))
+                if _TREE_SITTER is not None:
+                    _TREE_SITTER.forget(abs_path)
                 # delete from graph too
-                self._ensure_writer()
-                self.writer.clear_file(rel, workspace_id)
-                deleted += 1
+                counts["deleted"] += 1
+                yield ("clear", rel)
+
+    def _parse_stage(self, root: str, items: Iterator[Tuple], counts: Dict[str, int]) -> Iterator[Tuple]:
+        for item in items:
+            if item[0] == "file":
+                _, abs_path, previous = item
+                plan = self._plan_partial(abs_path, root, previous, counts) if previous else None
+                if plan is None:
+                    fi, hit = self._parse_cached(abs_path, root)
+                    counts["parse_cache_hits"] += int(hit)
+                    plan = _GraphPlan(fi, _graph_nodes(fi), [], upsert_file=True)
+                item = ("plan", plan)
+            yield item
+
+    def _embed_stage(self, workspace_id: str, items: Iterator[Tuple], batch_size: int,
+                     counts: Dict[str, int]) -> Iterator[Tuple]:
+        """Group plans until ``batch_size`` nodes are pending, then embed them in one call."""
+        pending: List[Tuple] = []
+        n = 0
+        for item in items:
+            pending.append(item)
+            if item[0] == "plan":
+                n += len(item[1].nodes)
+            if n >= batch_size:
+                yield from self._embed_plans(workspace_id, pending, counts)
+                pending, n = [], 0
+        yield from self._embed_plans(workspace_id, pending, counts)
+
+    def _embed_plans(self, workspace_id: str, items: List[Tuple], counts: Dict[str, int]) -> Iterator[Tuple]:
+        plans = [item[1] for item in items if item[0] == "plan" and item[1].nodes]
+        if plans:
+            self._ensure_writer()
+            nodes = [(kind, node) for plan in plans for kind, node in plan.nodes]
+            texts = [self.writer.class_text(node) if kind == "class" else self.writer.function_text(node)
+                     for kind, node in nodes]
+            embs, groups = self._embed_deduplicated(workspace_id, nodes, texts, counts)
+            i = 0
+            for plan in plans:
+                plan.embs = embs[i:i + len(plan.nodes)]
+                plan.groups = groups[i:i + len(plan.nodes)]
+                i += len(plan.nodes)
+        yield from items
+
+    def _embed_deduplicated(self, workspace_id: str, nodes: List[Tuple[str, Any]], texts: List[str],
+                            counts: Dict[str, int]) -> Tuple[List[List[float]], List[Optional[str]]]:
+        """Embed ``texts``, reusing the vector of an indexed or earlier near-duplicate function.
+
+        Returns the vectors and each node's dup_group. A function whose body
+        SimHash is close to one already indexed (in any workspace) joins its
+        group and takes its cached vector; one close to another function of
+        this batch waits for that function's vector. A function never takes
+        the vector of its own earlier body. Groups are only registered for
+        functions that actually got a vector.
+        """
+        index = self.simhash_index
+        n = len(texts)
+        out: List[Optional[List[float]]] = [None] * n
+        groups: List[Optional[str]] = [None] * n
+        follows: Dict[int, int] = {}
+        leaders: List[Tuple[int, int]] = []
+        sigs = [node.simhash if kind == "function" and index is not None else 0 for kind, node in nodes]
+        owners = [f"{workspace_id}:{node.qualname}" for _, node in nodes]
+        for i, sig in enumerate(sigs):
+            if not sig:
+                continue
+            hit = index.lookup(sig, owners[i])
+            if hit is not None:
+                # Embedded anew when the vector was evicted or came from another model
+                groups[i], key = hit
+                out[i] = self.writer.cached_embedding(key)
+                continue
+            near = next((j for s, j in leaders if bin(s ^ sig).count("1") <= index.max_distance), None)
+            if near is not None:
+                groups[i] = groups[near]
+                follows[i] = near
+            else:
+                groups[i] = f"{sig:016x}"
+                leaders.append((sig, i))
+        counts["embed_reused"] += sum(1 for v in out if v is not None)
+
+        todo = [i for i in range(n) if out[i] is None and i not in follows]
+        for i, vec in zip(todo, self.writer.embed_many([texts[i] for i in todo])):
+            out[i] = vec
+            if sigs[i] and vec:
+                index.add(sigs[i], groups[i], self.writer.embedder.cache_key_for_text(texts[i]), owners[i])
+        for i, j in follows.items():
+            out[i] = out[j]
+            counts["embed_reused"] += int(bool(out[j]))
+        return out, groups  # type: ignore[return-value]
+
+    def _write_stage(self, workspace_id: str, items: Iterator[Tuple], counts: Dict[str, int],
+                     progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Iterator[Tuple]:
+        for item in items:
+            self._ensure_writer()
+            if item[0] == "clear":
+                self.writer.clear_file(item[1], workspace_id)
+            else:
+                plan = item[1]
+                if plan.upsert_file:
+                    self.writer.upsert_file(plan.fi, workspace_id)
+                embs = plan.embs or [None] * len(plan.nodes)
+                groups = plan.groups or [None] * len(plan.nodes)
+                for (kind, node), emb, group in zip(plan.nodes, embs, groups):
+                    counts["embed_failed"] += int(emb == [])
+                    if kind == "class":
+                        self.writer.upsert_class(plan.fi, node, workspace_id, emb)
+                    else:
+                        self.writer.upsert_function(plan.fi, node, workspace_id, emb, group)
+                self.writer.delete_nodes(plan.gone, workspace_id)
+                if plan.moved:
+                    self.writer.set_spans(plan.moved, workspace_id)
+                counts["nodes_written"] += len(plan.nodes)
+                counts["upserts"] += 1
+            if progress is not None:
+                progress(dict(counts))
+            yield item
+
+    def apply_changes(self, workspace_id: str, changes: Iterable[Dict[str, Any]],
+                      incremental: bool = True,
+                      progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+        """Mirror ``changes`` into the workspace and update its graph.
+
+        Mirror writes, parsing, embedding and graph writes run as a pipeline of
+        threads joined by bounded queues (``sync.pipeline_queue_size``), so a slow
+        stage holds back the ones before it and memory stays proportional to the
+        queue and embedding batch sizes rather than to the number of changes.
+        ``changes`` may be any iterable, including a generator fed from a stream.
+
+        With ``incremental`` set, a modified file only rewrites the nodes its edit
+        touches; pass False when the graph was just cleared and every node is needed.
+        ``progress`` receives a snapshot of the counts after each graph write.
 
-        if touched:
+        Runs under the workspace's lock (see workspace_lock), so syncs of one
+        workspace arriving at different worker processes take turns.
+        """
+        with self.workspace_lock(workspace_id):
+            return self._apply_changes(workspace_id, changes, incremental, progress)
+
+    def _apply_changes(self, workspace_id: str, changes: Iterable[Dict[str, Any]], incremental: bool,
+                       progress: Optional[Callable[[Dict[str, int]], None]]) -> Dict[str, int]:
+        root = self._ws_dir(workspace_id)
+        counts = {"added": 0, "modified": 0, "deleted": 0, "upserts": 0,
+                  "parse_cache_hits": 0, "nodes_written": 0, "nodes_skipped": 0, "delta_failed": 0,
+                  "embed_failed": 0, "embed_reused": 0}
+        skip_keys = [f"skipped_{reason}" for reason in ("ignored", "size", "binary", "minified", "generated")]
+        counts.update({k: 0 for k in skip_keys})
+        sync_conf = self.conf["sync"]
+        queue_size = int(sync_conf.get("pipeline_queue_size", 16) or 16)
+        batch_size = int(sync_conf.get("embed_batch_size", 64) or 64)
+
+        _run_pipeline(
+            self._mirror_stage(workspace_id, root, changes, incremental, counts),
+            [
+                lambda items: self._parse_stage(root, items, counts),
+                lambda items: self._embed_stage(workspace_id, items, batch_size, counts),
+                lambda items: self._write_stage(workspace_id, items, counts, progress),
+            ],
+            maxsize=queue_size,
+        )
+        self._manifest(workspace_id).flush()
+
+        if counts["upserts"] or counts["deleted"]:
             self._ensure_writer()
-        for p in touched:
-            fi = parse_file(p, root)
-            self.writer.upsert_file(fi, workspace_id)
-            for c in fi.classes:
-                self.writer.upsert_class(fi, c, workspace_id)
-            for fn in fi.functions:
-                self.writer.upsert_function(fi, fn, workspace_id)
-            # Fallback: if no functions parsed, create pseudo functions from classes for RAG visibility
-            if not fi.functions and fi.classes:
-                for c in fi.classes:
-                    pseudo_fun = FunctionInfo(
-                        name=c.name,
-                        qualname=c.qualname + ".__class__",
-                        lineno=c.lineno,
-                        docstring=c.docstring,
-                        source=c.source,
-                        file_path=fi.path,
-                        class_name=None,
-                        calls=set(),
-                    )
-                    self.writer.upsert_function(fi, pseudo_fun, workspace_id)
-            upserts += 1
-
-        if touched or deleted:
             self.writer.link_calls(workspace_id)
+            if counts["embed_failed"]:
+                self._set_pending(workspace_id, True)
+            elif counts["nodes_written"] and os.path.exists(self._pending_marker(workspace_id)):
+                # The backend is embedding again; catch up on nodes an earlier sync left without vectors
+                self.reembed_pending(workspace_id)
             # Best-effort flush of embedding cache after a batch sync
             try:
                 if hasattr(self, "emb_cache") and self.emb_cache is not None:
                     self.emb_cache.flush()
+                if self.simhash_index is not None:
+                    self.simhash_index.flush()
             except Exception:
                 pass
 
-        return {"added": added, "modified": modified, "deleted": deleted, "upserts": upserts}
+        order = ["added", "modified", "deleted", "upserts", "parse_cache_hits", "nodes_written", "nodes_skipped",
+                 "delta_failed", "embed_failed", "embed_reused"]
+        return {**{k: counts[k] for k in order}, "skipped": sum(counts[k] for k in skip_keys),
+                **{k: counts[k] for k in skip_keys}}
 
-    def rag_answer(self, question: str, workspace_id: Optional[str] = None) -> str:
+    def reembed_pending(self, workspace_id: str) -> Dict[str, int]:
+        """Embed the workspace's nodes marked ``embedding_pending`` by a sync whose embedding failed.
+
+        Runs in ``sync.embed_batch_size`` batches until none are left, or stops
+        at the first batch the backend still fails on.
+        """
         self._ensure_writer()
-        digest = self._graph_digest(workspace_id)
-        rq = self._rewrite_query(question, workspace_id, digest)
-        if GraphRAG is None or VectorRetriever is None or OpenAILLM is None:
-            try:
-                self._ensure_embedder()
-                vec = self.embedder.embed([rq])[0]
-                with self.writer.driver.session() as s:
-                    res = s.run(
-                        """
-                        WITH $v AS q
-                        MATCH (fn:Function) WHERE fn.embedding IS NOT NULL AND ($wid IS NULL OR fn.workspaceId = $wid)
-                        CALL db.index.vector.queryNodes('function_embedding', $k, q) YIELD node, score
-                        WITH node, score WHERE ($wid IS NULL OR node.workspaceId = $wid)
-                        RETURN node.qualname AS q, score
+        with self.workspace_lock(workspace_id):
+            batch_size = int(self.conf["sync"].get("embed_batch_size", 64) or 64)
+            done = {"reembedded": 0, "failed": 0}
+            for label in ("Class", "Function"):
+                while True:
+                    rows = [dict(r) for r in self.writer.read(
+                        f"""
+                        MATCH (n:{label} {{workspaceId:$wid}}) WHERE n.embedding_pending
+                        RETURN n.qualname AS q, n.name AS name, n.docstring AS doc, n.source AS src,
+                               n.source_hash AS h, n.file_path AS fp, n.lineno AS ln, n.end_lineno AS eln
+                        LIMIT $limit
                         """,
-                        v=vec, wid=workspace_id, k=int(self.conf["graphrag"].get("fallback_top_k", 5)),
-                    )
-                    rows = [f"{r['q']} (score={r['score']:.4f})" for r in res]
-                answer_text = "Top functions:\n" + "\n".join(rows)
-                if bool(self.conf["graphrag"].get("debug_output", False)):
-                    debug_block = (
-                        "\n\n---\n"
-                        "# Debug Information\n"
-                        f"Graph Digest:\n{digest}\n\n"
-                        f"User Query:\n{question}\n\n"
-                        f"Optimized Query:\n{rq}\n"
-                    )
-                    return (answer_text or "") + debug_block
-                return answer_text
-            except Exception:
-                return "GraphRAG not available and no vector index reachable."
+                        wid=workspace_id, limit=batch_size,
+                    )]
+                    if not rows:
+                        break
+                    sources = self._node_sources(rows, workspace_id)
+                    nodes = [SimpleNamespace(qualname=r["q"], name=r["name"], docstring=r["doc"], source=src)
+                             for r, src in zip(rows, sources)]
+                    text = self.writer.class_text if label == "Class" else self.writer.function_text
+                    vecs = self.writer.embed_many([text(n) for n in nodes])
+                    ok = [{"q": r["q"], "emb": v} for r, v in zip(rows, vecs) if v]
+                    if ok:
+                        self.writer.set_embeddings(label, ok, workspace_id)
+                    done["reembedded"] += len(ok)
+                    if len(ok) < len(rows):
+                        done["failed"] += len(rows) - len(ok)
+                        return done
+            self._set_pending(workspace_id, False)
+            return done
 
-        with self.writer.driver.session() as s:
-            c = s.run("MATCH (n:Function) WHERE n.embedding IS NOT NULL AND ($wid IS NULL OR n.workspaceId = $wid) RETURN count(n) AS c", wid=workspace_id).single()["c"]
-            if not c:
-                return "No functions with embeddings found."
+    # ---- Async API for the FastAPI handlers ----
+    # Graph reads go through the async driver; parsing, embedding and mirror
+    # file I/O are blocking and run in worker threads.
 
-        llm = OpenAILLM(model_name="gpt-4o-mini")
-        retriever = VectorRetriever(self.writer.driver, index_name="function_embedding", embedder=GraphRAGEmbedderAdapter(self.embedder))
-        rag = GraphRAG(llm=llm, retriever=retriever)
-        # Provide a workspace-scoped prelude to steer retrieval (optional)
-        prelude_enabled = bool(self.conf["graphrag"].get("prelude_enabled", True))
-        prelude = ""
-        if prelude_enabled and workspace_id:
-            prelude = f"Only use functions where workspaceId={workspace_id}.\n"
-        # Best-effort: apply top_k to retriever if supported (VectorRetriever top_k param not exposed here, rely on index query default)
-        result = rag.search(f"{prelude}{rq}")
-        answer_text = getattr(result, "answer", str(result))
+    async def astatus(self) -> Dict[str, int]:
+        await self._aensure_writer()
+        rows = await self.writer.aread("""
+        CALL { MATCH (n:File) RETURN count(n) AS files }
+        CALL { MATCH (n:Class) RETURN count(n) AS classes }
+        CALL { MATCH (n:Function) RETURN count(n) AS functions }
+        RETURN files, classes, functions
+        """)
+        r = rows[0]
+        return {"files": r["files"], "classes": r["classes"], "functions": r["functions"]}
+
+    async def areembed_pending(self, workspace_id: str) -> Dict[str, int]:
+        return await asyncio.to_thread(self.reembed_pending, workspace_id)
+
+    async def aclear_workspace_graph(self, workspace_id: str) -> Dict[str, int]:
+        return await asyncio.to_thread(self.clear_workspace_graph, workspace_id)
+
+    async def aevict_idle_workspaces(self, dry_run: bool = False) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.evict_idle_workspaces, dry_run)
+
+    async def aclear_all(self) -> None:
+        await self._aensure_writer()
+        await self.writer.awrite("MATCH (n) DETACH DELETE n")
+
+    async def acompute_manifest(self, workspace_id: str) -> Dict[str, str]:
+        return await asyncio.to_thread(self.compute_manifest, workspace_id)
+
+    async def amanifest_tree(self, workspace_id: str, rel_dir: str = "") -> Dict[str, Any]:
+        return await asyncio.to_thread(self.manifest_tree, workspace_id, rel_dir)
+
+    async def aget_file_content(self, workspace_id: str, rel_path: str) -> str:
+        return await asyncio.to_thread(self.get_file_content, workspace_id, rel_path)
+
+    async def aget_file_signature(self, workspace_id: str, rel_path: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.get_file_signature, workspace_id, rel_path)
+
+    async def aapply_changes(self, workspace_id: str, changes: Iterable[Dict[str, Any]],
+                             incremental: bool = True,
+                             progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+        return await asyncio.to_thread(self.apply_changes, workspace_id, changes, incremental, progress)
+
+    async def aclose(self) -> None:
+        if self.writer is not None:
+            await self.writer.aclose()
+            await asyncio.to_thread(self.writer.close)
+        if self.embedding_service is not None:
+            await asyncio.to_thread(self.embedding_service.close)
+
+    def _vector_search(self, vec: List[float], workspace_id: Optional[str], k: int,
+                       timeout: Optional[float] = None) -> List[Tuple[str, float]]:
+        rows = self.writer.read(_VECTOR_SEARCH_CYPHER, timeout=timeout, v=vec, wid=workspace_id, k=k,
+                                kk=k * _DUP_OVERFETCH)
+        return [(str(r["q"]), float(r["score"])) for r in rows]
+
+    async def _avector_search(self, vec: List[float], workspace_id: Optional[str], k: int,
+                              timeout: Optional[float] = None) -> List[Tuple[str, float]]:
+        rows = await self.writer.aread(_VECTOR_SEARCH_CYPHER, timeout=timeout, v=vec, wid=workspace_id, k=k,
+                                       kk=k * _DUP_OVERFETCH)
+        return [(str(r["q"]), float(r["score"])) for r in rows]
+
+    @staticmethod
+    def _format_hits(hits: List[Tuple[str, float]]) -> str:
+        return "Top functions:\n" + "\n".join([f"{q} (score={score:.4f})" for q, score in hits])
+
+    def _with_debug(self, answer_text: str, digest: str, question: str, rq: str) -> str:
         if bool(self.conf["graphrag"].get("debug_output", False)):
             debug_block = (
                 "\n\n---\n"
@@ -1319,4 +4497,286 @@ class GraphService:
             return (answer_text or "") + debug_block
         return answer_text or ""
 
+    def new_deadline(self) -> Deadline:
+        gconf = self.conf["graphrag"]
+        return Deadline(float(gconf.get("request_timeout_seconds", 60)), gconf.get("stage_budgets"))
+
+    def rag_answer(self, question: str, workspace_id: Optional[str] = None) -> str:
+        return self.rag_search(question, workspace_id).answer
+
+    def _skip_rewrite(self, deadline: Deadline) -> bool:
+        # Skip the LLM rewrite when it would eat the time left for retrieval and generation
+        return deadline.remaining() < float(self.conf["graphrag"].get("rewrite_skip_below_seconds", 15))
+
+    def _retrieve(self, question: str, workspace_id: Optional[str], deadline: Deadline, k: int,
+                  timings: Dict[str, float]) -> Tuple[str, str, List[float], List[Tuple[str, float]]]:
+        """Run digest, rewrite, embedding and vector search under the deadline."""
+        self._touch(workspace_id)
+        self._ensure_writer()
+        t = time.monotonic()
+        digest = self._graph_digest(workspace_id, timeout=deadline.budget("digest"))
+        timings["digest"] = _elapsed(t)
+
+        t = time.monotonic()
+        if self._skip_rewrite(deadline):
+            rq = self._heuristic_rewrite(question, digest)
+        else:
+            budget = deadline.budget("rewrite")
+            try:
+                rq = _run_with_timeout(self._rewrite_query, budget, question, workspace_id, digest, budget)
+            except StageTimeout:
+                rq = self._heuristic_rewrite(question, digest)
+        timings["rewrite"] = _elapsed(t)
+
+        t = time.monotonic()
+        self._ensure_embedder()
+        vec = _run_with_timeout(self.embedder.embed, deadline.budget("embed"), [rq])[0]
+        timings["embed"] = _elapsed(t)
+        t = time.monotonic()
+        hits = self._vector_search(vec, workspace_id, k, timeout=deadline.budget("retrieval"))
+        timings["retrieval"] = _elapsed(t)
+        return digest, rq, vec, hits
+
+    async def _aretrieve(self, question: str, workspace_id: Optional[str], deadline: Deadline, k: int,
+                         timings: Dict[str, float]) -> Tuple[str, str, List[float], List[Tuple[str, float]]]:
+        """Async counterpart of _retrieve: Neo4j reads are awaited, model calls run in worker threads."""
+        self._touch(workspace_id)
+        await self._aensure_writer()
+        t = time.monotonic()
+        digest = await self._agraph_digest(workspace_id, timeout=deadline.budget("digest"))
+        timings["digest"] = _elapsed(t)
+
+        t = time.monotonic()
+        if self._skip_rewrite(deadline):
+            rq = self._heuristic_rewrite(question, digest)
+        else:
+            budget = deadline.budget("rewrite")
+            try:
+                rq = await asyncio.wait_for(
+                    asyncio.to_thread(self._rewrite_query, question, workspace_id, digest, budget), budget)
+            except asyncio.TimeoutError:
+                rq = self._heuristic_rewrite(question, digest)
+        timings["rewrite"] = _elapsed(t)
+
+        t = time.monotonic()
+        self._ensure_embedder()
+        try:
+            vecs = await asyncio.wait_for(self.embedder.aembed([rq]), deadline.budget("embed"))
+        except asyncio.TimeoutError:
+            raise StageTimeout("embed budget exhausted")
+        vec = vecs[0]
+        timings["embed"] = _elapsed(t)
+        t = time.monotonic()
+        hits = await self._avector_search(vec, workspace_id, k, timeout=deadline.budget("retrieval"))
+        timings["retrieval"] = _elapsed(t)
+        return digest, rq, vec, hits
+
+    def _graphrag_ready(self) -> bool:
+        return not (GraphRAG is None or VectorRetriever is None or OpenAILLM is None)
+
+    def _retrieval_failed(self, deadline: Deadline, timings: Dict[str, float]) -> Optional[RagResult]:
+        if deadline.expired():
+            return RagResult("Request deadline exceeded before retrieval completed.", partial=True, timings=timings)
+        if not self._graphrag_ready():
+            return RagResult("GraphRAG not available and no vector index reachable.", timings=timings)
+        return None
+
+    def _generate(self, question: str, workspace_id: Optional[str], deadline: Deadline, digest: str, rq: str,
+                  vec: List[float], hits: List[Tuple[str, float]], timings: Dict[str, float]) -> RagResult:
+        if not self._graphrag_ready():
+            return RagResult(self._with_debug(self._format_hits(hits), digest, question, rq), timings=timings)
+        if not hits:
+            return RagResult("No functions with embeddings found.", timings=timings)
+
+        # Provide a workspace-scoped prelude to steer retrieval (optional)
+        prelude_enabled = bool(self.conf["graphrag"].get("prelude_enabled", True))
+        prelude = ""
+        if prelude_enabled and workspace_id:
+            prelude = f"Only use functions where workspaceId={workspace_id}.\n"
+        query_text = f"{prelude}{rq}"
+        t = time.monotonic()
+        budget = deadline.budget("generation")
+        try:
+            llm = OpenAILLM(model_name="gpt-4o-mini", timeout=budget, max_retries=0)
+            retriever = (DedupVectorRetriever or VectorRetriever)(
+                self.writer.driver,
+                index_name="function_embedding",
+                embedder=GraphRAGEmbedderAdapter(self.embedder, known={query_text: vec}),
+                result_formatter=lambda record: self._format_retrieved(record, workspace_id),
+            )
+            rag = GraphRAG(llm=llm, retriever=retriever)
+            result = _run_with_timeout(rag.search, budget, query_text)
+        except StageTimeout:
+            timings["generation"] = _elapsed(t)
+            partial = self._format_hits(hits) + "\n\n(Answer generation timed out; showing retrieval results only.)"
+            return RagResult(self._with_debug(partial, digest, question, rq), partial=True, timings=timings)
+        timings["generation"] = _elapsed(t)
+        answer_text = getattr(result, "answer", str(result))
+        return RagResult(self._with_debug(answer_text, digest, question, rq), timings=timings)
+
+    def _top_k(self) -> int:
+        key = "top_k" if self._graphrag_ready() else "fallback_top_k"
+        return int(self.conf["graphrag"].get(key, 5))
+
+    def rag_search(self, question: str, workspace_id: Optional[str] = None,
+                   deadline: Optional[Deadline] = None) -> RagResult:
+        """Answer a question within the request deadline.
+
+        Each stage gets a sub-budget; when generation runs out of time the
+        retrieval hits are returned as a partial answer.
+        """
+        deadline = deadline or self.new_deadline()
+        timings: Dict[str, float] = {}
+        try:
+            digest, rq, vec, hits = self._retrieve(question, workspace_id, deadline, self._top_k(), timings)
+        except StageTimeout:
+            return RagResult("Request deadline exceeded before retrieval completed.", partial=True, timings=timings)
+        except Exception:
+            failed = self._retrieval_failed(deadline, timings)
+            if failed is None:
+                raise
+            return failed
+        return self._generate(question, workspace_id, deadline, digest, rq, vec, hits, timings)
+
+    async def arag_search(self, question: str, workspace_id: Optional[str] = None,
+                          deadline: Optional[Deadline] = None) -> RagResult:
+        """Async rag_search for the FastAPI handlers; never blocks the event loop."""
+        deadline = deadline or self.new_deadline()
+        timings: Dict[str, float] = {}
+        try:
+            digest, rq, vec, hits = await self._aretrieve(question, workspace_id, deadline, self._top_k(), timings)
+        except StageTimeout:
+            return RagResult("Request deadline exceeded before retrieval completed.", partial=True, timings=timings)
+        except Exception:
+            failed = self._retrieval_failed(deadline, timings)
+            if failed is None:
+                raise
+            return failed
+        return await asyncio.to_thread(self._generate, question, workspace_id, deadline, digest, rq, vec, hits, timings)
+
+    def _node_sources(self, rows: List[Dict[str, Any]], workspace_id: Optional[str]) -> List[str]:
+        """Source text for retrieved nodes, read in one pass from the source store.
+
+        Rows carry ``src`` (nodes written before sources moved out of the graph),
+        ``h`` (source hash), ``fp``, ``ln`` and ``eln``. An entry evicted from the
+        store is recovered from the node's span in the mirror when its hash still matches.
+        """
+        stored = self.source_store.get_many(r.get("h") for r in rows if not r.get("src"))
+        out: List[str] = []
+        for r in rows:
+            src = r.get("src") or stored.get(r.get("h") or "")
+            if src is None and r.get("h") and r.get("fp") and workspace_id and (r.get("ln") or 0) > 0:
+                lines = self.get_file_content(workspace_id, r["fp"]).splitlines(keepends=True)
+                span = "".join(lines[r["ln"] - 1:(r.get("eln") or r["ln"])])
+                # Parsers differ on whether the final newline belongs to the node
+                for candidate in (span, span.rstrip("\n")):
+                    if SourceStore.digest(candidate) == r["h"]:
+                        src = candidate
+                        break
+            out.append(src or "")
+        return out
+
+    def _format_retrieved(self, record: Any, workspace_id: Optional[str]) -> Any:
+        """VectorRetriever result formatter: the node's properties with its source filled back in."""
+        node = dict(record.get("node") or {})
+        if not node.get("source") and node.get("source_hash"):
+            node["source"] = self._node_sources([{
+                "h": node["source_hash"], "fp": node.get("file_path"),
+                "ln": node.get("lineno"), "eln": node.get("end_lineno"),
+            }], workspace_id)[0]
+        node.pop("source_hash", None)
+        metadata = {"score": record.get("score"), "nodeLabels": record.get("nodeLabels"), "id": record.get("id")}
+        return RetrieverResultItem(content=str(node), metadata=metadata)
+
+    def _fetch_context(self, qualnames: List[str], workspace_id: Optional[str],
+                       timeout: Optional[float] = None) -> str:
+        """Build an LLM context block from the retrieved functions, trimmed to max_context_tokens."""
+        rows = self.writer.read(
+            """
+            UNWIND $qs AS q
+            MATCH (fn:Function {qualname:q})
+            WHERE $wid IS NULL OR fn.workspaceId = $wid
+            RETURN fn.qualname AS q, fn.docstring AS doc, fn.source AS src, fn.source_hash AS h,
+                   fn.file_path AS fp, fn.lineno AS ln, fn.end_lineno AS eln
+            """,
+            timeout=timeout, qs=qualnames, wid=workspace_id,
+        )
+        sources = self._node_sources(rows, workspace_id)
+        # Rough 4 chars/token budget; keep retrieval order so the best hits survive trimming
+        by_q = {r["q"]: {**r, "src": sources[i]} for i, r in enumerate(rows)}
+        budget = int(self.conf["graphrag"].get("max_context_tokens", 8192)) * 4
+        parts: List[str] = []
+        for q in qualnames:
+            r = by_q.get(q)
+            if r is None:
+                continue
+            block = f"# {q}\n{r['doc'] or ''}\n{r['src'] or ''}".strip()
+            if len(block) > budget:
+                block = block[:budget]
+            parts.append(block)
+            budget -= len(block)
+            if budget <= 0:
+                break
+        return "\n\n".join(parts)
+
+    def rag_stream(self, question: str, workspace_id: Optional[str] = None,
+                   deadline: Optional[Deadline] = None) -> Iterator[Dict[str, Any]]:
+        """Streaming variant of rag_search.
+
+        Yields a ``retrieval`` event with the top hits as soon as vector search
+        finishes, then ``token`` events as the LLM produces them, and finally a
+        ``done`` event whose payload matches ``RagResponse``.
+        """
+        gconf = self.conf["graphrag"]
+        deadline = deadline or self.new_deadline()
+        timings: Dict[str, float] = {}
+        k = int(gconf.get("top_k", 8))
+        try:
+            digest, rq, _, hits = self._retrieve(question, workspace_id, deadline, k, timings)
+        except Exception:
+            msg = ("Request deadline exceeded before retrieval completed." if deadline.expired()
+                   else "GraphRAG not available and no vector index reachable.")
+            yield {"event": "done", "data": {"success": True, "answer": msg, "partial": deadline.expired()}}
+            return
+        yield {"event": "retrieval", "data": {"hits": [{"qualname": q, "score": score} for q, score in hits], "query": rq}}
+        if not hits:
+            yield {"event": "done", "data": {"success": True, "answer": "No functions with embeddings found.", "partial": False}}
+            return
+
+        answer_parts: List[str] = []
+        partial = False
+        t = time.monotonic()
+        try:
+            from openai import OpenAI  # type: ignore
+            context = self._fetch_context([q for q, _ in hits], workspace_id, timeout=deadline.budget("retrieval"))
+            client = OpenAI(timeout=deadline.budget("generation"), max_retries=0)
+            stream = client.chat.completions.create(
+                model="gpt-4o-mini",
+                stream=True,
+                messages=[
+                    {"role": "system", "content": "Answer the user question using only the provided code context."},
+                    {"role": "user", "content": f"Context:\n{context}\n\nQuestion:\n{question}\n\nAnswer:"},
+                ],
+            )
+            try:
+                for chunk in stream:
+                    if deadline.expired():
+                        partial = True
+                        break
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        answer_parts.append(delta)
+                        yield {"event": "token", "data": {"text": delta}}
+            finally:
+                # Closing the stream drops the HTTP connection, cancelling generation upstream
+                stream.close()
+        except Exception:
+            partial = True
+        timings["generation"] = round(time.monotonic() - t, 4)
 
+        answer_text = "".join(answer_parts)
+        if partial and not answer_text:
+            reason = "timed out" if deadline.expired() else "unavailable"
+            answer_text = self._format_hits(hits) + f"\n\n(Answer generation {reason}; showing retrieval results only.)"
+        yield {"event": "done", "data": {"success": True, "answer": self._with_debug(answer_text, digest, question, rq),
+                                         "partial": partial, "timings": timings}}
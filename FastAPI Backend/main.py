@@ -1,15 +1,21 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from pydantic import BaseModel
 import google.generativeai as genai
 import yaml
 import os
 import time
-from typing import Optional, List, Dict, Literal
+from typing import Optional, List, Dict, Literal, Union
 from datetime import datetime
 from dotenv import load_dotenv
 import json
 import re
+import asyncio
+import queue
+import functools
+from content_encoding import ContentEncodingMiddleware
 
 # Load environment variables from .env file
 load_dotenv()
@@ -36,6 +42,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/zstd request bodies on the upload endpoints, compressed responses everywhere
+_compression = config.get("compression") or {}
+app.add_middleware(
+    ContentEncodingMiddleware,
+    decode_paths=["/api/graph/sync", "/api/graph/sync/stream", "/api/generate-header"],
+    max_body_bytes=int(float(_compression.get("max_decompressed_mb", 256)) * 1024 * 1024),
+    minimum_size=int(_compression.get("min_response_bytes", 1024)),
+    levels={"gzip": _compression.get("gzip_level"), "zstd": _compression.get("zstd_level")},
+)
+
 class CodeRequest(BaseModel):
     content: str
     filename: str
@@ -217,6 +233,8 @@ async def health_check():
 # Optional GraphRAG integration: keep this import guarded so the API can
 # start and serve core endpoints even if Neo4j/GraphRAG dependencies
 # are not installed or reachable.
+# One per worker process under `uvicorn --workers N`; the workers share caches, manifests and
+# per-workspace locks through files under the workspaces root.
 try:
     from graphrag_service import GraphService
     _graph_service = GraphService()
@@ -224,12 +242,46 @@ except Exception as _e:
     _graph_service = None
 
 
+async def _workspace_sweeper(interval: float):
+    # Periodically evict idle workspaces (mirror + graph nodes); errors never stop the loop
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await _graph_service.aevict_idle_workspaces()
+        except Exception:
+            pass
+
+
+@app.on_event("startup")
+async def _start_workspace_sweeper():
+    if _graph_service is None:
+        return
+    interval = float(_graph_service.conf["workspaces"].get("sweep_interval_seconds", 0) or 0)
+    if interval > 0:
+        app.state.workspace_sweeper = asyncio.create_task(_workspace_sweeper(interval))
+
+
+@app.on_event("shutdown")
+async def _close_graph_service():
+    sweeper = getattr(app.state, "workspace_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+    if _graph_service is not None:
+        await _graph_service.aclose()
+
+
 class ChangeItem(BaseModel):
     path: str
     status: Literal["added", "modified", "deleted"]
-    mode: Optional[Literal["full", "patch"]] = "full"
+    mode: Optional[Literal["full", "patch", "delta"]] = "full"
     content: Optional[str] = None
     patch: Optional[str] = None
+    # mode "delta": [first_block, n_blocks] copies from the mirrored copy and base64 literals,
+    # against the signature from /api/graph/file/signature
+    delta: Optional[List[Union[List[int], str]]] = None
+    block_size: Optional[int] = None
+    base: Optional[str] = None
+    hash: Optional[str] = None
 
 
 class SyncRequest(BaseModel):
@@ -251,6 +303,8 @@ class RagRequest(BaseModel):
 class RagResponse(BaseModel):
     success: bool
     answer: str
+    # True when the request deadline cut generation short and only retrieval results are returned
+    partial: bool = False
 
 
 @app.get("/api/graph/status")
@@ -258,11 +312,7 @@ async def graph_status():
     if _graph_service is None:
         raise HTTPException(status_code=500, detail="Graph service not initialized.")
     try:
-        with _graph_service.writer.driver.session() as s:
-            c_files = s.run("MATCH (n:File) RETURN count(n) AS c").single()["c"]
-            c_classes = s.run("MATCH (n:Class) RETURN count(n) AS c").single()["c"]
-            c_funcs = s.run("MATCH (n:Function) RETURN count(n) AS c").single()["c"]
-        return {"files": c_files, "classes": c_classes, "functions": c_funcs}
+        return await _graph_service.astatus()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -271,35 +321,55 @@ async def graph_status():
 async def graph_manifest(workspaceId: str = Query(...)):
     if _graph_service is None:
         raise HTTPException(status_code=500, detail="Graph service not initialized.")
-    return {"manifest": _graph_service.compute_manifest(workspaceId)}
+    return {"manifest": await _graph_service.acompute_manifest(workspaceId)}
+
+
+@app.get("/api/graph/manifest/tree")
+async def graph_manifest_tree(workspaceId: str = Query(...), path: str = Query("")):
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    return await _graph_service.amanifest_tree(workspaceId, path)
 
 
 @app.get("/api/graph/file")
 async def graph_file(workspaceId: str = Query(...), path: str = Query(...)):
     if _graph_service is None:
         raise HTTPException(status_code=500, detail="Graph service not initialized.")
-    content = _graph_service.get_file_content(workspaceId, path)
+    content = await _graph_service.aget_file_content(workspaceId, path)
     return {"content": content}
 
 
+@app.get("/api/graph/file/signature")
+async def graph_file_signature(workspaceId: str = Query(...), path: str = Query(...)):
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    return await _graph_service.aget_file_signature(workspaceId, path)
+
+
 @app.post("/api/graph/sync", response_model=SyncResponse)
 async def sync_graph(req: SyncRequest) -> SyncResponse:
     if _graph_service is None:
         raise HTTPException(status_code=500, detail="Graph service not initialized.")
     try:
-        # Optional full replacement if extension switches to a different workspace
+        # Optional full replacement of this workspace's graph (e.g. first sync of a new workspace)
         replace = False
         try:
             # Backwards-compatible: SyncRequest may not have 'replace'
             replace = bool(getattr(req, 'replace', False))  # type: ignore
         except Exception:
             replace = False
+        cleared: Dict[str, int] = {}
         if replace:
+            # Only this workspace's nodes are removed; other workspaces sharing the graph are untouched
             try:
-                _graph_service.clear_all()
+                cleared = await _graph_service.aclear_workspace_graph(req.workspaceId)
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Failed to clear graph: {e}")
-        counts = _graph_service.apply_changes(req.workspaceId, [c.model_dump() for c in req.changes])
+        changes = [c.model_dump() for c in req.changes]
+        # The service drops each change's content once mirrored; let it be the only reference
+        req.changes.clear()
+        counts = await _graph_service.aapply_changes(req.workspaceId, changes, incremental=not replace)
+        counts.update(cleared)
         return SyncResponse(success=True, counts=counts)
     except RuntimeError as e:
         if str(e) == "NEO4J_UNAVAILABLE":
@@ -307,18 +377,212 @@ async def sync_graph(req: SyncRequest) -> SyncResponse:
         raise
 
 
+class _UploadStreamingResponse(StreamingResponse):
+    """StreamingResponse whose generator may still be reading the request body.
+
+    Starlette's default also listens for a client disconnect on the receive
+    channel, which would swallow the upload's body messages.
+    """
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+
+
+# Parsed changes buffered ahead of the sync pipeline; a full buffer stops reading the upload
+_SYNC_STREAM_BUFFER = 16
+# Longest NDJSON line (one ChangeItem) the streamed sync will hold while waiting for its newline
+_SYNC_STREAM_MAX_LINE = int(float((config.get("sync") or {}).get("max_line_mb", 64)) * 1024 * 1024)
+
+
+@app.post("/api/graph/sync/stream")
+async def sync_graph_stream(request: Request, workspaceId: str = Query(...), replace: bool = Query(False)):
+    """Apply an NDJSON upload of ChangeItems (one per line) as it arrives.
+
+    Responds with NDJSON ``progress`` events carrying the running sync counts,
+    then a SyncResponse-shaped ``done`` event (or an ``error`` event).
+    """
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    loop = asyncio.get_running_loop()
+    inbox: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=_SYNC_STREAM_BUFFER)
+    latest: Dict[str, Dict[str, int]] = {}
+
+    def changes():
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            yield item
+
+    def progress(counts: Dict[str, int]) -> None:
+        loop.call_soon_threadsafe(latest.__setitem__, "counts", counts)
+
+    def event(name: str, data) -> str:
+        return json.dumps({"event": name, "data": data}) + "\n"
+
+    def error_detail(e: BaseException) -> str:
+        if isinstance(e, RuntimeError) and str(e) == "NEO4J_UNAVAILABLE":
+            return "Neo4j is not reachable at NEO4J_URI. Start Neo4j and retry."
+        return str(e)
+
+    async def run():
+        cleared: Dict[str, int] = {}
+        if replace:
+            try:
+                cleared = await _graph_service.aclear_workspace_graph(workspaceId)
+            except Exception as e:
+                yield event("error", {"detail": f"Failed to clear graph: {error_detail(e)}"})
+                return
+        task = asyncio.create_task(
+            _graph_service.aapply_changes(workspaceId, changes(), incremental=not replace, progress=progress))
+        sent: List[Optional[Dict[str, int]]] = [None]
+
+        async def offer(item) -> None:
+            # Backpressure: wait for the pipeline rather than buffering the upload. The blocking
+            # put times out so a pipeline that has stopped consuming cannot strand the thread.
+            try:
+                inbox.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            while not task.done():
+                try:
+                    await loop.run_in_executor(None, functools.partial(inbox.put, item, timeout=0.5))
+                    return
+                except queue.Full:
+                    pass
+
+        def pending_progress() -> Optional[str]:
+            if latest.get("counts") is sent[0]:
+                return None
+            sent[0] = latest.get("counts")
+            return event("progress", sent[0])
+
+        failure: Optional[str] = None
+        buf = bytearray()
+        scanned = lineno = 0
+        try:
+            async for chunk in request.stream():
+                buf.extend(chunk)
+                start = 0
+                while failure is None and not task.done():
+                    end = buf.find(b"\n", scanned)
+                    if end < 0:
+                        scanned = len(buf)
+                        break
+                    line, start = bytes(buf[start:end]), end + 1
+                    scanned = start
+                    lineno += 1
+                    if not line.strip():
+                        continue
+                    try:
+                        await offer(ChangeItem.model_validate_json(line).model_dump())
+                    except ValueError as e:
+                        failure = f"Invalid change: line {lineno}: {e}"
+                del buf[:start]
+                scanned -= start
+                if failure is None and len(buf) > _SYNC_STREAM_MAX_LINE:
+                    failure = f"Invalid change: line {lineno + 1} is longer than {_SYNC_STREAM_MAX_LINE} bytes"
+                if failure is not None or task.done():
+                    break
+                update = pending_progress()
+                if update:
+                    yield update
+            if failure is None and buf.strip():
+                try:
+                    await offer(ChangeItem.model_validate_json(bytes(buf)).model_dump())
+                except ValueError as e:
+                    failure = f"Invalid change: line {lineno + 1}: {e}"
+        except StarletteHTTPException as e:
+            # A body the decoding middleware rejects mid-upload; the response has already started
+            failure = e.detail
+        finally:
+            await offer(None)
+        while not task.done():
+            await asyncio.wait({task}, timeout=0.5)
+            update = pending_progress()
+            if update:
+                yield update
+        try:
+            counts = task.result()
+        except Exception as e:
+            yield event("error", {"detail": error_detail(e)})
+            return
+        if failure is not None:
+            yield event("error", {"detail": failure, "counts": counts})
+            return
+        counts.update(cleared)
+        yield event("done", SyncResponse(success=True, counts=counts).model_dump())
+
+    return _UploadStreamingResponse(run(), media_type="application/x-ndjson",
+                                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/api/graph/rag", response_model=RagResponse)
 async def rag(req: RagRequest) -> RagResponse:
     if _graph_service is None:
         raise HTTPException(status_code=500, detail="Graph service not initialized.")
     try:
-        ans = _graph_service.rag_answer(req.question, getattr(req, 'workspaceId', None))
-        return RagResponse(success=True, answer=ans)
+        res = await _graph_service.arag_search(req.question, getattr(req, 'workspaceId', None))
+        return RagResponse(success=True, answer=res.answer, partial=res.partial)
     except RuntimeError as e:
         if str(e) == "NEO4J_UNAVAILABLE":
             raise HTTPException(status_code=503, detail="Neo4j is not reachable at NEO4J_URI. Start Neo4j and retry.")
         raise
 
+
+@app.post("/api/graph/reembed")
+async def reembed_workspace(workspaceId: str = Query(...)):
+    """Embed the workspace's nodes that a sync stored without a vector because embedding failed."""
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    try:
+        return await _graph_service.areembed_pending(workspaceId)
+    except RuntimeError as e:
+        if str(e) == "NEO4J_UNAVAILABLE":
+            raise HTTPException(status_code=503, detail="Neo4j is not reachable at NEO4J_URI. Start Neo4j and retry.")
+        raise
+
+
+@app.post("/api/graph/admin/evict")
+async def evict_workspaces(workspaceId: Optional[str] = Query(None), dryRun: bool = Query(False)):
+    """Run the idle-workspace sweep now, or evict one workspace when workspaceId is given."""
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    if workspaceId:
+        try:
+            _graph_service.check_workspace_id(workspaceId)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        if workspaceId:
+            if dryRun:
+                return {"dry_run": True, "evicted": [workspaceId], "cleared": {}}
+            cleared = await asyncio.to_thread(_graph_service.clear_workspace, workspaceId)
+            return {"dry_run": False, "evicted": [workspaceId], "cleared": {workspaceId: cleared}}
+        return await _graph_service.aevict_idle_workspaces(dry_run=dryRun)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Eviction failed: {e}")
+
+
+@app.post("/api/graph/rag/stream")
+async def rag_stream(req: RagRequest, format: Literal["sse", "ndjson"] = Query("sse")):
+    """Stream retrieval hits, then answer tokens, then a final RagResponse-shaped ``done`` event."""
+    if _graph_service is None:
+        raise HTTPException(status_code=500, detail="Graph service not initialized.")
+    events = _graph_service.rag_stream(req.question, getattr(req, 'workspaceId', None))
+
+    def encode():
+        for ev in events:
+            if format == "ndjson":
+                yield json.dumps(ev) + "\n"
+            else:
+                yield f"event: {ev['event']}\ndata: {json.dumps(ev['data'])}\n\n"
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+    # Disable proxy buffering so the first event reaches the client as soon as retrieval finishes
+    return StreamingResponse(encode(), media_type=media_type,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == "__main__":
     # Import uvicorn only when running this module directly to avoid
     # forcing the dependency at import time (e.g., when used by another
@@ -5,7 +5,15 @@ import * as vscode from 'vscode';
 import * as http from 'http';
 import { API_BASE_URL } from './constants';
 
-type ChangeItem = { path: string; status: 'added'|'modified'|'deleted'; mode?: 'full'|'patch'; content?: string; patch?: string };
+type DeltaOp = [number, number] | string;
+type ChangeItem = {
+  path: string; status: 'added'|'modified'|'deleted'; mode?: 'full'|'patch'|'delta'; content?: string; patch?: string;
+  delta?: DeltaOp[]; block_size?: number; base?: string; hash?: string;
+};
+type Signature = { size: number; hash: string; block_size: number; weak: number[]; strong: string[] };
+
+// Modified files at least this large are sent as a block delta against the server copy
+const DELTA_MIN_BYTES = 16 * 1024;
 
 function sha256(data: Buffer | string): string {
   const h = crypto.createHash('sha256');
@@ -78,6 +86,130 @@ async function fetchServerManifest(root: string): Promise<Record<string,string>>
   return (res && res.manifest) ? res.manifest as Record<string,string> : {};
 }
 
+type TreeNode = { path: string; hash: string|null; children: { name: string; type: 'file'|'dir'; hash: string }[] };
+
+async function fetchServerTree(root: string, dir: string): Promise<TreeNode> {
+  const wsid = workspaceIdFor(root);
+  return await fetchJSON(`${API_BASE_URL}/api/graph/manifest/tree?workspaceId=${encodeURIComponent(wsid)}&path=${encodeURIComponent(dir)}`);
+}
+
+// Same scheme as the server: a directory hashes its children's "<f|d> <name> <hash>" lines sorted by name
+function localDirHashes(localMap: Record<string,string>): Record<string,string> {
+  const children: Record<string, Record<string, string>> = { '': {} };
+  for (const rel of Object.keys(localMap)) {
+    const parts = rel.split('/');
+    for (let i = 0; i < parts.length; i++) {
+      const parent = parts.slice(0, i).join('/');
+      children[parent] = children[parent] || {};
+      children[parent][parts[i]] = i === parts.length - 1 ? 'f' : 'd';
+    }
+  }
+  const out: Record<string,string> = {};
+  function hashDir(dir: string): string {
+    if (dir in out) return out[dir];
+    const names = Object.keys(children[dir] || {}).sort((a, b) => (a < b ? -1 : a > b ? 1 : 0));
+    const h = crypto.createHash('sha256');
+    for (const name of names) {
+      const kind = children[dir][name];
+      const child = dir ? `${dir}/${name}` : name;
+      h.update(`${kind} ${name} ${kind === 'f' ? localMap[child] : hashDir(child)}\n`, 'utf8');
+    }
+    return (out[dir] = h.digest('hex'));
+  }
+  hashDir('');
+  return out;
+}
+
+// Server file hashes under the directories whose hash differs from the local one; equal subtrees are never fetched
+async function fetchChangedServerFiles(root: string, localDirs: Record<string,string>):
+    Promise<{ files: Record<string,string>; visited: Set<string>; dirs: Set<string>; empty: boolean }> {
+  const files: Record<string,string> = {};
+  const visited = new Set<string>();
+  const dirs = new Set<string>(['']);
+  const top = await fetchServerTree(root, '');
+  const empty = !top.children || top.children.length === 0;
+  if (top.hash && top.hash === localDirs['']) return { files, visited, dirs, empty };
+  const pending: TreeNode[] = [top];
+  while (pending.length) {
+    const node = pending.pop()!;
+    visited.add(node.path);
+    const differing: string[] = [];
+    for (const c of node.children || []) {
+      const child = node.path ? `${node.path}/${c.name}` : c.name;
+      if (c.type === 'file') {
+        files[child] = c.hash;
+      } else {
+        dirs.add(child);
+        if (localDirs[child] !== c.hash) differing.push(child);
+      }
+    }
+    pending.push(...await Promise.all(differing.map(d => fetchServerTree(root, d))));
+  }
+  return { files, visited, dirs, empty };
+}
+
+async function fetchServerSignature(root: string, rel: string): Promise<Signature> {
+  const wsid = workspaceIdFor(root);
+  return await fetchJSON(`${API_BASE_URL}/api/graph/file/signature?workspaceId=${encodeURIComponent(wsid)}&path=${encodeURIComponent(rel)}`);
+}
+
+// rsync rolling checksum over data[start, start + n): a = sum(x_i), b = sum((n - i) * x_i), both mod 2^16
+function weakSums(data: Buffer, start: number, n: number): [number, number] {
+  let a = 0, b = 0;
+  for (let i = 0; i < n; i++) {
+    a = (a + data[start + i]) & 0xffff;
+    b = (b + a) & 0xffff;
+  }
+  return [a, b];
+}
+
+// Copies of server blocks ([first, count]) plus base64 literals for everything that did not match a block
+function blockDelta(data: Buffer, sig: Signature): { ops: DeltaOp[]; literal: number } {
+  const bs = sig.block_size;
+  const byWeak = new Map<number, number[]>();
+  sig.weak.forEach((w, i) => {
+    const list = byWeak.get(w);
+    if (list) list.push(i); else byWeak.set(w, [i]);
+  });
+  const ops: DeltaOp[] = [];
+  let literal = 0;
+  let litStart = 0;
+  const flushLiteral = (end: number) => {
+    if (end > litStart) {
+      ops.push(data.subarray(litStart, end).toString('base64'));
+      literal += end - litStart;
+    }
+  };
+  let i = 0;
+  let [a, b] = data.length >= bs ? weakSums(data, 0, bs) : [0, 0];
+  while (i + bs <= data.length) {
+    const candidates = byWeak.get((a | (b << 16)) >>> 0);
+    let match = -1;
+    if (candidates) {
+      const strong = crypto.createHash('md5').update(data.subarray(i, i + bs)).digest('hex');
+      match = candidates.find(c => sig.strong[c] === strong) ?? -1;
+    }
+    if (match >= 0) {
+      flushLiteral(i);
+      const last = ops[ops.length - 1];
+      if (Array.isArray(last) && last[0] + last[1] === match) last[1]++;
+      else ops.push([match, 1]);
+      i += bs;
+      litStart = i;
+      if (i + bs <= data.length) [a, b] = weakSums(data, i, bs);
+      continue;
+    }
+    if (i + bs < data.length) {
+      const out = data[i];
+      a = (a - out + data[i + bs]) & 0xffff;
+      b = (b - bs * out + a) & 0xffff;
+    }
+    i++;
+  }
+  flushLiteral(data.length);
+  return { ops, literal };
+}
+
 async function fetchServerFile(root: string, rel: string): Promise<string> {
   const wsid = workspaceIdFor(root);
   const res = await fetchJSON(`${API_BASE_URL}/api/graph/file?workspaceId=${encodeURIComponent(wsid)}&path=${encodeURIComponent(rel)}`);
@@ -96,24 +228,66 @@ export async function runRag(question: string): Promise<string> {
 }
 
 export async function syncGraph(root: string): Promise<{added:number;modified:number;deleted:number;upserts:number}> {
-  const serverMan = await fetchServerManifest(root);
   const files = await readAllFiles(root);
   const localMap: Record<string,string> = {};
-  const changes: ChangeItem[] = [];
-
+  const localAbs: Record<string,string> = {};
   for (const abs of files) {
     const rel = path.relative(root, abs).replace(/\\/g,'/');
     if (rel === '.graphrag-manifest.json') continue;
     const buf = await fs.promises.readFile(abs);
-    const text = buf.toString('utf-8');
-    const hash = sha256(buf);
-    localMap[rel] = hash;
+    localMap[rel] = sha256(buf);
+    localAbs[rel] = abs;
+  }
+
+  // Descend the server's hash tree only where it differs; a no-op sync is one request
+  const localDirs = localDirHashes(localMap);
+  let serverMan: Record<string,string>;
+  let serverEmpty: boolean;
+  let unchanged = (_rel: string) => false;
+  try {
+    const tree = await fetchChangedServerFiles(root, localDirs);
+    serverMan = tree.files;
+    serverEmpty = tree.empty;
+    // A file is unchanged when the first directory on its path that was not fetched exists on the server (hash matched)
+    unchanged = (rel: string) => {
+      const parts = rel.split('/');
+      for (let i = 0; i < parts.length; i++) {
+        const dir = parts.slice(0, i).join('/');
+        if (!tree.visited.has(dir)) return tree.dirs.has(dir);
+      }
+      return false;
+    };
+  } catch {
+    // Older backend without /api/graph/manifest/tree: compare the flat manifest
+    serverMan = await fetchServerManifest(root);
+    serverEmpty = Object.keys(serverMan).length === 0;
+  }
+
+  const changes: ChangeItem[] = [];
+  const deltaPaths: string[] = [];
+  for (const rel of Object.keys(localMap)) {
+    if (unchanged(rel) || serverMan[rel] === localMap[rel]) continue;
+    const buf = await fs.promises.readFile(localAbs[rel]);
     if (!(rel in serverMan)) {
-      changes.push({ path: rel, status: 'added', mode: 'full', content: text });
-    } else if (serverMan[rel] !== hash) {
-      // Try to fetch server version and compute simple content fallback (we skip patch generation for now to reduce client complexity)
-      changes.push({ path: rel, status: 'modified', mode: 'full', content: text });
+      changes.push({ path: rel, status: 'added', mode: 'full', content: buf.toString('utf-8') });
+      continue;
     }
+    if (buf.length >= DELTA_MIN_BYTES) {
+      // Upload only the blocks that differ from the server copy when that saves most of the file
+      try {
+        const sig = await fetchServerSignature(root, rel);
+        const { ops, literal } = blockDelta(buf, sig);
+        if (literal < buf.length / 2) {
+          changes.push({ path: rel, status: 'modified', mode: 'delta', delta: ops, block_size: sig.block_size,
+                         base: sig.hash, hash: localMap[rel] });
+          deltaPaths.push(rel);
+          continue;
+        }
+      } catch {
+        // Older backend without signatures: send the full content
+      }
+    }
+    changes.push({ path: rel, status: 'modified', mode: 'full', content: buf.toString('utf-8') });
   }
 
   for (const rel of Object.keys(serverMan)) {
@@ -128,14 +302,30 @@ export async function syncGraph(root: string): Promise<{added:number;modified:nu
   }
 
   const wsid = workspaceIdFor(root);
-  const doReplace = Object.keys(serverMan || {}).length === 0;
+  const doReplace = serverEmpty;
   const payload = JSON.stringify({ workspaceId: wsid, changes, replace: doReplace });
   const res = await fetchJSON(`${API_BASE_URL}/api/graph/sync`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json', 'Content-Length': Buffer.byteLength(payload).toString() },
     body: payload
   });
-  return (res && res.counts) ? res.counts : {added:0,modified:0,deleted:0,upserts:0};
+  const counts = (res && res.counts) ? res.counts : {added:0,modified:0,deleted:0,upserts:0};
+  if (counts.delta_failed && deltaPaths.length) {
+    // A server copy changed after its signature was fetched; resend the delta'd files in full
+    const retry: ChangeItem[] = [];
+    for (const rel of deltaPaths) {
+      const content = (await fs.promises.readFile(localAbs[rel])).toString('utf-8');
+      retry.push({ path: rel, status: 'modified', mode: 'full', content });
+    }
+    const retryPayload = JSON.stringify({ workspaceId: wsid, changes: retry, replace: false });
+    const again = await fetchJSON(`${API_BASE_URL}/api/graph/sync`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Content-Length': Buffer.byteLength(retryPayload).toString() },
+      body: retryPayload
+    });
+    for (const k of ['modified', 'upserts']) counts[k] = (counts[k] || 0) + ((again && again.counts && again.counts[k]) || 0);
+  }
+  return counts;
 }
 
 